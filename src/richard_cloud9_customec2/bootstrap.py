@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from time import time
+from typing import MutableMapping, Optional, Sequence
+
+from cloudformation_cli_python_lib import SessionProxy
+
+from .clients import get_client
+from .throttling import error_code
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Where account-level prerequisites are remembered once verified:
+#   memory                      only for the life of the Lambda process (default)
+#   file:<path>                 a JSON file, for tests and local runs
+#   ssm:<parameter path>        one SSM parameter per account under the path
+BOOTSTRAP_CACHE = os.environ.get("BOOTSTRAP_CACHE", "memory")
+# Errors that mean a prerequisite verified earlier has since gone away
+MISSING_CODES = ("AccessDenied", "AccessDeniedException", "NoSuchEntity", "NotFoundException")
+
+
+class BootstrapCache(ABC):
+    @abstractmethod
+    def verified(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def mark_verified(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def invalidate(self, key: str) -> None:
+        ...
+
+
+class MemoryCache(BootstrapCache):
+    def __init__(self):
+        self.entries: MutableMapping[str, float] = {}
+
+    def verified(self, key: str) -> bool:
+        return key in self.entries
+
+    def mark_verified(self, key: str) -> None:
+        self.entries[key] = time()
+
+    def invalidate(self, key: str) -> None:
+        self.entries.pop(key, None)
+
+
+class FileCache(BootstrapCache):
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self) -> MutableMapping[str, float]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _store(self, entries: MutableMapping[str, float]) -> None:
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(entries, f, sort_keys=True)
+        os.replace(temporary, self.path)
+
+    def verified(self, key: str) -> bool:
+        return key in self._load()
+
+    def mark_verified(self, key: str) -> None:
+        with self._lock:
+            entries = self._load()
+            entries[key] = time()
+            self._store(entries)
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            entries = self._load()
+            if entries.pop(key, None) is not None:
+                self._store(entries)
+
+
+class SsmParameterCache(BootstrapCache):
+    def __init__(self, session: SessionProxy, path: str):
+        self.session = session
+        self.path = path.rstrip("/")
+
+    def _name(self, key: str) -> str:
+        return f"{self.path}/{key}"
+
+    def verified(self, key: str) -> bool:
+        ssm_client = get_client(self.session, "ssm")
+        try:
+            ssm_client.get_parameter(Name=self._name(key))
+        except ssm_client.exceptions.ParameterNotFound:
+            return False
+        return True
+
+    def mark_verified(self, key: str) -> None:
+        get_client(self.session, "ssm").put_parameter(
+            Name=self._name(key),
+            Value=str(int(time())),
+            Type='String',
+            Overwrite=True,
+        )
+
+    def invalidate(self, key: str) -> None:
+        ssm_client = get_client(self.session, "ssm")
+        try:
+            ssm_client.delete_parameter(Name=self._name(key))
+        except ssm_client.exceptions.ParameterNotFound:
+            pass
+
+
+_MEMORY = MemoryCache()
+
+
+class LayeredCache(BootstrapCache):
+    # The process-wide memory cache in front of a persistent one, so warm
+    # invocations don't even read the persistent store.
+    def __init__(self, persistent: BootstrapCache):
+        self.persistent = persistent
+
+    def verified(self, key: str) -> bool:
+        if _MEMORY.verified(key):
+            return True
+        if self.persistent.verified(key):
+            _MEMORY.mark_verified(key)
+            return True
+        return False
+
+    def mark_verified(self, key: str) -> None:
+        _MEMORY.mark_verified(key)
+        self.persistent.mark_verified(key)
+
+    def invalidate(self, key: str) -> None:
+        _MEMORY.invalidate(key)
+        self.persistent.invalidate(key)
+
+
+def bootstrap_cache(session: SessionProxy, spec: Optional[str] = None) -> BootstrapCache:
+    spec = spec or BOOTSTRAP_CACHE
+    if spec.startswith("file:"):
+        return LayeredCache(FileCache(spec[len("file:"):]))
+    if spec.startswith("ssm:"):
+        return LayeredCache(SsmParameterCache(session, spec[len("ssm:"):]))
+    return _MEMORY
+
+
+def prerequisite_key(account_id: str, role_name: str, policies: Sequence[str]) -> str:
+    # Changing the role's managed policies changes the key, so the new set is
+    # verified once rather than trusted from an older entry.
+    fingerprint = hashlib.sha256(json.dumps(sorted(policies)).encode()).hexdigest()[:12]
+    return f"{account_id}/{role_name}/{fingerprint}"
+
+
+def prerequisite_missing(error: Exception) -> bool:
+    return error_code(error) in MISSING_CODES
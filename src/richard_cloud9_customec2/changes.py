@@ -0,0 +1,95 @@
+import logging
+from dataclasses import dataclass, field, fields
+from typing import Dict, List, Mapping, Optional
+
+from cloudformation_cli_python_lib import exceptions
+
+from .models import ResourceModel
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Key of the tag the handlers put on everything they create; never removed by an update
+MANAGED_TAG_KEY = "AWSQS-ENVIRONMENT"
+# Instance tag naming the instance profile the environment was given, so update
+# and delete find the role without the create's callback context
+PROFILE_TAG = "AWSQS-INSTANCE-PROFILE"
+# Claim state of a pooled instance profile (see profiles)
+PROFILE_POOL_TAG = "AWSQS-PROFILE-POOL"
+# Claim state and template hash of a warm pool environment (see pool)
+POOL_TAG = "AWSQS-POOL"
+POOL_PROFILE_TAG = "AWSQS-POOL-PROFILE"
+# Owner a claimed warm pool environment was handed to; Cloud9 keeps reporting
+# the pool's owner as the environment's ownerArn
+OWNER_TAG = "AWSQS-OWNER"
+# PROFILE_POOL_TAG and POOL_TAG values: UNCLAIMED, or CLAIMED:<client request token>
+UNCLAIMED = "unclaimed"
+CLAIMED = "claimed"
+# The handlers' own bookkeeping tags: never reported as the model's Tags and never
+# removed by an update
+INTERNAL_TAG_KEYS = frozenset({MANAGED_TAG_KEY, PROFILE_TAG, PROFILE_POOL_TAG, POOL_TAG, POOL_PROFILE_TAG, OWNER_TAG})
+
+
+def _tags(model: Optional[ResourceModel]) -> Dict[str, str]:
+    return {tag.Key: tag.Value for tag in (model.Tags if model is not None and model.Tags else [])}
+
+
+@dataclass
+class UpdatePlan:
+    # The operations that take an environment from the previous model to the
+    # desired one. Every field left empty is a no-op.
+    environment: Dict[str, str] = field(default_factory=dict)
+    instance_type: Optional[str] = None
+    volume_size: Optional[int] = None
+    tags_to_set: Dict[str, str] = field(default_factory=dict)
+    tags_to_remove: List[str] = field(default_factory=list)
+    policy_to_attach: Optional[str] = None
+    policy_to_detach: Optional[str] = None
+
+    def describe(self) -> List[str]:
+        steps = []
+        if self.environment:
+            steps.append(f"update {', '.join(sorted(self.environment))}")
+        if self.instance_type:
+            steps.append(f"resize instance to {self.instance_type}")
+        if self.volume_size:
+            steps.append(f"grow volume to {self.volume_size} GiB")
+        if self.tags_to_set or self.tags_to_remove:
+            steps.append(f"set tags {sorted(self.tags_to_set)}, remove tags {self.tags_to_remove}")
+        if self.policy_to_attach or self.policy_to_detach:
+            steps.append(f"swap policy {self.policy_to_detach} for {self.policy_to_attach}")
+        return steps
+
+
+def plan_update(previous: Optional[ResourceModel], desired: ResourceModel) -> UpdatePlan:
+    # Diff the previous model against the desired one. Properties that can only
+    # be set at create are createOnlyProperties in the schema, so CloudFormation
+    # replaces the resource rather than calling update for them.
+    plan = UpdatePlan()
+    if previous is None:
+        # nothing to diff against; treat every set property as changed
+        previous = ResourceModel(**{model_field.name: None for model_field in fields(ResourceModel)})
+    if desired.Name is not None and desired.Name != previous.Name:
+        plan.environment["name"] = desired.Name
+    if desired.Description != previous.Description:
+        plan.environment["description"] = desired.Description or ""
+    if desired.InstanceType is not None and desired.InstanceType != previous.InstanceType:
+        plan.instance_type = desired.InstanceType
+    if desired.VolumeSize is not None and desired.VolumeSize != previous.VolumeSize:
+        if previous.VolumeSize is not None and desired.VolumeSize < previous.VolumeSize:
+            raise exceptions.InvalidRequest(
+                f"VolumeSize can't shrink from {previous.VolumeSize} to {desired.VolumeSize} GiB; EBS volumes only grow"
+            )
+        plan.volume_size = desired.VolumeSize
+    previous_tags, desired_tags = _tags(previous), _tags(desired)
+    plan.tags_to_set = {key: value for key, value in desired_tags.items() if previous_tags.get(key) != value}
+    plan.tags_to_remove = sorted(key for key in previous_tags if key not in desired_tags and key not in INTERNAL_TAG_KEYS)
+    if desired.PermissionsPolicy != previous.PermissionsPolicy:
+        plan.policy_to_attach = desired.PermissionsPolicy
+        plan.policy_to_detach = previous.PermissionsPolicy
+    LOG.info(f"update plan for {desired.Arn}: {plan.describe() or 'no changes'}")
+    return plan
+
+
+def tag_list(tags: Mapping[str, str]) -> List[Dict[str, str]]:
+    return [{"Key": key, "Value": value} for key, value in tags.items()]
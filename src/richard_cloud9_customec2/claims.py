@@ -0,0 +1,102 @@
+import logging
+import os
+from time import time
+from typing import Dict, Optional
+
+from cloudformation_cli_python_lib import SessionProxy
+
+from .clients import get_client
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Claims on pooled resources and the locks around refilling the pools are SSM
+# parameters under this path. A claim is created with Overwrite=False, so of
+# several claimers racing for the same resource exactly one put succeeds.
+CLAIM_PATH = os.environ.get("CLAIM_PARAMETER_PATH", "/awsqs-cloud9/claims").rstrip("/")
+# Kinds of claim: a pooled instance profile, a warm pool environment, a lock
+PROFILE = "profile"
+ENVIRONMENT = "environment"
+LOCK = "lock"
+# A lock older than this is taken to belong to a holder that died without releasing it
+LOCK_SECONDS = 900
+
+
+def _parameter(kind: str, name: str) -> str:
+    return f"{CLAIM_PATH}/{kind}/{name}"
+
+
+def claim(session: SessionProxy, kind: str, name: str, holder: str) -> bool:
+    # True if `holder` now owns `name`, including when an earlier attempt by the
+    # same holder (a re-invocation of the same request) claimed it already.
+    ssm_client = get_client(session, "ssm")
+    try:
+        ssm_client.put_parameter(Name=_parameter(kind, name), Value=holder, Type='String', Overwrite=False)
+        return True
+    except ssm_client.exceptions.ParameterAlreadyExists:
+        pass
+    return claimant(session, kind, name) == holder
+
+
+def claimant(session: SessionProxy, kind: str, name: str) -> Optional[str]:
+    ssm_client = get_client(session, "ssm")
+    try:
+        return ssm_client.get_parameter(Name=_parameter(kind, name))['Parameter']['Value']
+    except ssm_client.exceptions.ParameterNotFound:
+        return None
+
+
+def record_claim(session: SessionProxy, kind: str, name: str, holder: str) -> None:
+    # For resources claimed before claims were kept in SSM
+    get_client(session, "ssm").put_parameter(Name=_parameter(kind, name), Value=holder, Type='String', Overwrite=True)
+
+
+def release(session: SessionProxy, kind: str, name: str) -> None:
+    ssm_client = get_client(session, "ssm")
+    try:
+        ssm_client.delete_parameter(Name=_parameter(kind, name))
+    except ssm_client.exceptions.ParameterNotFound:
+        pass
+
+
+def claimed(session: SessionProxy, kind: str) -> Dict[str, str]:
+    # Holder of everything of `kind` currently claimed, by name
+    ssm_client = get_client(session, "ssm")
+    prefix = f"{CLAIM_PATH}/{kind}/"
+    holders = {}
+    parameters = {'Path': prefix.rstrip("/"), 'Recursive': False, 'MaxResults': 10}
+    while True:
+        response = ssm_client.get_parameters_by_path(**parameters)
+        holders.update((parameter['Name'][len(prefix):], parameter['Value']) for parameter in response['Parameters'])
+        if not response.get('NextToken'):
+            break
+        parameters['NextToken'] = response['NextToken']
+    return holders
+
+
+def acquire_lock(session: SessionProxy, name: str, holder: str, seconds: float = LOCK_SECONDS) -> bool:
+    # Single-writer lock: True if `holder` now holds `name` until release_lock, or
+    # for `seconds` at most. An expired lock is taken over; two holders can only
+    # both get it if they take over the same expired lock at the same moment.
+    ssm_client = get_client(session, "ssm")
+    value = f"{int(time() + seconds)}:{holder}"
+    for attempt in range(2):
+        try:
+            ssm_client.put_parameter(Name=_parameter(LOCK, name), Value=value, Type='String', Overwrite=False)
+            return True
+        except ssm_client.exceptions.ParameterAlreadyExists:
+            if attempt:
+                return False
+        current = claimant(session, LOCK, name)
+        if current is not None and int(current.split(":", 1)[0]) > time():
+            return False
+        if current is not None:
+            LOG.info(f"taking over expired lock {name} ({current})")
+            release(session, LOCK, name)
+    return False
+
+
+def release_lock(session: SessionProxy, name: str, holder: str) -> None:
+    current = claimant(session, LOCK, name)
+    if current is not None and current.split(":", 1)[1] == holder:
+        release(session, LOCK, name)
@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Any, List, Optional, Tuple
+
+from cloudformation_cli_python_lib import SessionProxy
+
+from .instrumentation import instrument_client
+from .throttling import CLIENT_CONFIG, ThrottledClient
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Clients for static credentials are kept this long; clients for credentials with
+# a known expiry are dropped a little before the credentials expire.
+CLIENT_TTL_SECONDS = 900
+EXPIRY_MARGIN_SECONDS = 60
+# Each client holds its own connection pool, so a container serving many stacks
+# or roles keeps only the most recently used ones.
+MAX_CLIENTS = 32
+
+# (service, region, credential identity) -> (client, monotonic eviction time),
+# least recently used first
+_CLIENTS: "OrderedDict[Tuple[str, Optional[str], str], Tuple[Any, float]]" = OrderedDict()
+# boto3 sessions are not thread-safe, so client construction is serialized.
+_LOCK = threading.Lock()
+# botocore parses service models and endpoint data once per loader. Every request
+# arrives with a new boto3 session, so all of them share the first one's loader
+# instead of re-reading the model files for each new set of credentials.
+_LOADER: List[Any] = [None]
+
+
+def _identity(boto_session) -> Tuple[Optional[str], float]:
+    credentials = boto_session.get_credentials()
+    if credentials is None:
+        return None, CLIENT_TTL_SECONDS
+    frozen = credentials.get_frozen_credentials()
+    identity = hashlib.sha256(f"{frozen.access_key}:{frozen.token or ''}".encode()).hexdigest()
+    ttl = CLIENT_TTL_SECONDS
+    expiry = getattr(credentials, "_expiry_time", None)
+    if expiry is not None:
+        remaining = (expiry - datetime.now(timezone.utc)).total_seconds() - EXPIRY_MARGIN_SECONDS
+        ttl = max(0, min(ttl, remaining))
+    return identity, ttl
+
+
+def _evict_expired(now: float) -> None:
+    for key in [key for key, (_, evict_at) in _CLIENTS.items() if evict_at <= now]:
+        del _CLIENTS[key]
+
+
+def _share_loader(boto_session) -> None:
+    core = getattr(boto_session, "_session", None)
+    if core is None:
+        return
+    if _LOADER[0] is None:
+        _LOADER[0] = core.get_component("data_loader")
+    elif core.get_component("data_loader") is not _LOADER[0]:
+        core.register_component("data_loader", _LOADER[0])
+
+
+def get_client(session: SessionProxy, service_name: str):
+    # Return a rate-limited client for `service_name` built from `session`, reusing
+    # one from a previous (warm) invocation when the region and credentials are
+    # the same.
+    boto_session = getattr(session, "session", None)
+    if boto_session is None or not hasattr(boto_session, "get_credentials"):
+        return ThrottledClient(session.client(service_name, config=CLIENT_CONFIG), service_name)
+    identity, ttl = _identity(boto_session)
+    if identity is None:
+        return ThrottledClient(session.client(service_name, config=CLIENT_CONFIG), service_name)
+    key = (service_name, boto_session.region_name, identity)
+    with _LOCK:
+        now = monotonic()
+        _evict_expired(now)
+        cached = _CLIENTS.get(key)
+        if cached is not None:
+            _CLIENTS.move_to_end(key)
+            return cached[0]
+        LOG.info(f"creating {service_name} client for {boto_session.region_name}")
+        _share_loader(boto_session)
+        client = boto_session.client(service_name, config=CLIENT_CONFIG)
+        instrument_client(client)
+        client = ThrottledClient(client, service_name)
+        if ttl > 0:
+            _CLIENTS[key] = (client, now + ttl)
+            while len(_CLIENTS) > MAX_CLIENTS:
+                _CLIENTS.popitem(last=False)
+        return client
@@ -0,0 +1,212 @@
+import logging
+from typing import Any, Callable, Dict, Iterator, List, Mapping, MutableMapping, Optional, Tuple
+
+from .executor import DONE
+from .interface import ProvisioningStatus
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+CONTEXT_VERSION = 2
+VERSION_KEY = "v"
+# All timestamps are stored as offsets, in tenths of a second, from this epoch second
+EPOCH_KEY = "z"
+EXTRA_KEY = "x"
+
+# (key the handlers use, attribute, key in the encoded context). The encoded keys
+# are part of the stored format: never reuse one for a different field.
+FIELDS: Tuple[Tuple[str, str, str], ...] = (
+    ("LOCAL_STATUS", "stage", "s"),
+    ("ENVIRONMENT_ID", "environment_id", "e"),
+    ("INSTANCE_ID", "instance_id", "i"),
+    ("VOLUME_ID", "volume_id", "vo"),
+    ("DEFAULT_ASSOCIATION_ID", "default_association_id", "da"),
+    ("ASSOCIATION_ID", "association_id", "a"),
+    ("COMMAND_ID", "command_id", "c"),
+    ("RESIZE_COMMAND_ID", "resize_command_id", "rc"),
+    ("DOCUMENTS", "documents", "d"),
+    ("INSTANCE_PROFILE_ID", "instance_profile_id", "pi"),
+    ("INSTANCE_PROFILE_NAME", "instance_profile_name", "pn"),
+    ("INSTANCE_PROFILE_CREATED", "instance_profile_created", "pc"),
+    ("LEGACY_PROFILE", "legacy_profile", "lp"),
+    ("SUBNETS", "subnets", "sb"),
+    ("RESOURCE_IDS", "resource_ids", "r"),
+    ("TASKS", "tasks", "t"),
+    ("POLL", "poll", "p"),
+    ("THROTTLED", "throttled", "th"),
+    ("TIMELINE", "timeline", "tl"),
+)
+_ATTRIBUTES = {key: attribute for key, attribute, _ in FIELDS}
+
+
+def _timestamps(context: "CallbackContext") -> List[float]:
+    stamps = []
+    if context.instance_profile_created is not None:
+        stamps.append(context.instance_profile_created)
+    if context.poll:
+        stamps.append(context.poll["Started"])
+    if context.throttled:
+        stamps.append(context.throttled["Started"])
+    for entry in (context.timeline or {}).values():
+        stamps.append(entry[0])
+    return stamps
+
+
+class CallbackContext(MutableMapping[str, Any]):
+    # Typed callback context. Fields are read and written as attributes, or through
+    # the mapping interface under the key names stored by earlier handler versions
+    # (ENVIRONMENT_ID, LOCAL_STATUS, ...); a field that is None is absent from the
+    # mapping. Keys that aren't fields are kept as they are in `extra`.
+    __slots__ = tuple(attribute for _, attribute, _ in FIELDS) + ("extra",)
+
+    def __init__(self, **values: Any):
+        for _, attribute, _ in FIELDS:
+            setattr(self, attribute, None)
+        self.extra: Dict[str, Any] = {}
+        for key, value in values.items():
+            setattr(self, key, value)
+
+    # mapping interface
+
+    def __getitem__(self, key: str) -> Any:
+        attribute = _ATTRIBUTES.get(key)
+        if attribute is None:
+            return self.extra[key]
+        value = getattr(self, attribute)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        attribute = _ATTRIBUTES.get(key)
+        if attribute is None:
+            self.extra[key] = value
+        elif attribute == "stage" and value is not None and not isinstance(value, ProvisioningStatus):
+            self.stage = ProvisioningStatus._deserialize(value)
+        else:
+            setattr(self, attribute, value)
+
+    def __delitem__(self, key: str) -> None:
+        attribute = _ATTRIBUTES.get(key)
+        if attribute is None:
+            del self.extra[key]
+        elif getattr(self, attribute) is None:
+            raise KeyError(key)
+        else:
+            setattr(self, attribute, None)
+
+    def __iter__(self) -> Iterator[str]:
+        for key, attribute, _ in FIELDS:
+            if getattr(self, attribute) is not None:
+                yield key
+        yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"CallbackContext({dict(self)!r})"
+
+    # encoding
+
+    def _serialize(self) -> Mapping[str, Any]:
+        # Compact form written to CloudFormation: short keys, absent fields left
+        # out, stage as its Stage code, done tasks as a sorted list and timestamps
+        # as tenths of a second from one base. Key order is fixed, so the same
+        # context always encodes to the same JSON.
+        encoded: Dict[str, Any] = {VERSION_KEY: CONTEXT_VERSION}
+        stamps = _timestamps(self)
+        epoch = int(min(stamps)) if stamps else 0
+        if stamps:
+            encoded[EPOCH_KEY] = epoch
+
+        def offset(stamp: float) -> int:
+            return int(round((stamp - epoch) * 10))
+
+        for _, attribute, short in FIELDS:
+            value = getattr(self, attribute)
+            if value is None:
+                continue
+            if attribute == "stage":
+                value = int(value.STAGE)
+            elif attribute == "instance_profile_created":
+                value = offset(value)
+            elif attribute == "tasks":
+                value = sorted(name for name, outcome in value.items() if outcome == DONE)
+            elif attribute == "poll":
+                value = [value["Stage"], value["Attempt"], offset(value["Started"])]
+            elif attribute == "throttled":
+                value = [value["Attempt"], offset(value["Started"])]
+            elif attribute == "timeline":
+                value = [
+                    [stage, offset(entry[0]), offset(entry[1]), entry[2], entry[3]]
+                    for stage, entry in sorted(value.items(), key=lambda item: item[1][0])
+                ]
+            encoded[short] = value
+        if self.extra:
+            encoded[EXTRA_KEY] = self.extra
+        return encoded
+
+    @classmethod
+    def _decode(cls, encoded: Mapping[str, Any]) -> "CallbackContext":
+        context = cls()
+        epoch = encoded.get(EPOCH_KEY, 0)
+
+        def stamp(offset: int) -> float:
+            return epoch + offset / 10
+
+        for _, attribute, short in FIELDS:
+            value = encoded.get(short)
+            if value is None:
+                continue
+            if attribute == "stage":
+                value = ProvisioningStatus.from_stage(value)
+            elif attribute == "instance_profile_created":
+                value = stamp(value)
+            elif attribute == "tasks":
+                value = {name: DONE for name in value}
+            elif attribute == "poll":
+                value = {"Stage": value[0], "Attempt": value[1], "Started": stamp(value[2])}
+            elif attribute == "throttled":
+                value = {"Attempt": value[0], "Started": stamp(value[1])}
+            elif attribute == "timeline":
+                value = {entry[0]: [stamp(entry[1]), stamp(entry[2]), entry[3], entry[4]] for entry in value}
+            setattr(context, attribute, value)
+        context.extra = dict(encoded.get(EXTRA_KEY) or {})
+        return context
+
+    @classmethod
+    def load(cls, raw: Optional[Mapping[str, Any]]) -> "CallbackContext":
+        # The context CloudFormation handed back, in whatever version wrote it
+        if isinstance(raw, CallbackContext):
+            return raw
+        if not raw:
+            return cls()
+        encoded = dict(raw)
+        version = encoded.get(VERSION_KEY, 1) if isinstance(encoded.get(VERSION_KEY), int) else 1
+        if version > CONTEXT_VERSION:
+            raise ValueError(f"callback context version {version} is newer than this handler ({CONTEXT_VERSION})")
+        while version < CONTEXT_VERSION:
+            LOG.info(f"migrating callback context from version {version}")
+            encoded = MIGRATIONS[version](encoded)
+            version = encoded[VERSION_KEY]
+        return cls._decode(encoded)
+
+
+def _from_legacy(raw: Mapping[str, Any]) -> Mapping[str, Any]:
+    # Version 1 is the plain dict the handlers used to store, keyed by the long
+    # names, with LOCAL_STATUS as {"Type": "<stage class name>"}.
+    context = CallbackContext()
+    for key, value in raw.items():
+        context[key] = value
+    if context.stage is not None:
+        # a create that started there may already have its per-environment role;
+        # it finishes on that role rather than claiming a pooled profile
+        context.legacy_profile = True
+    return context._serialize()
+
+
+# version -> function taking the encoded context of that version to the next one
+MIGRATIONS: Dict[int, Callable[[Mapping[str, Any]], Mapping[str, Any]]] = {
+    1: _from_legacy,
+}
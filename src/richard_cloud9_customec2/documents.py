@@ -0,0 +1,185 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from time import time
+from typing import Any, List, Mapping, MutableMapping, Optional, Sequence, Tuple
+
+from cloudformation_cli_python_lib import SessionProxy, exceptions
+
+from .clients import get_client
+from .instrumentation import TIMELINE_KEY, finish_span, run_in_context, start_span
+from .models import BootstrapDocument, ResourceModel
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# When set, SSM also sends the full output of every bootstrap document to this
+# CloudWatch Logs group.
+BOOTSTRAP_LOG_GROUP = os.environ.get("BOOTSTRAP_LOG_GROUP", "")
+# Characters of a document's latest output kept in the progress message
+TAIL_CHARACTERS = 300
+MAX_WORKERS = 4
+
+RUNNING_STATUSES = ("Pending", "InProgress", "Delayed", "Cancelling")
+SUCCEEDED, RUNNING, FAILED = "SUCCEEDED", "RUNNING", "FAILED"
+
+# Per document in the callback context: [command id, status, stdout characters
+# already logged, stderr characters already logged]
+COMMAND, STATUS, STDOUT_SEEN, STDERR_SEEN = range(4)
+
+
+@dataclass
+class BootstrapStep:
+    key: str
+    document: str
+    parameters: Optional[Mapping[str, Sequence[str]]]
+    depends_on: List[str]
+    timeout: Optional[int]
+
+    @property
+    def span(self) -> str:
+        return f"Document:{self.key}"
+
+
+def bootstrap_steps(model: ResourceModel) -> List[BootstrapStep]:
+    # BootstrapDocumentName followed by BootstrapDocuments. A document without
+    # DependsOn waits for the one before it; DependsOn names earlier documents.
+    documents = []
+    if model.BootstrapDocumentName is not None:
+        documents.append(BootstrapDocument(Name=model.BootstrapDocumentName, Parameters=None, DependsOn=None, TimeoutSeconds=None))
+    documents.extend(model.BootstrapDocuments or [])
+    steps: List[BootstrapStep] = []
+    keys_by_name: MutableMapping[str, List[str]] = {}
+    for index, document in enumerate(documents):
+        key = document.Name if document.Name not in keys_by_name else f"{document.Name}#{index}"
+        if document.DependsOn is None:
+            depends_on = [steps[-1].key] if steps else []
+        else:
+            depends_on = []
+            for name in document.DependsOn:
+                if name not in keys_by_name:
+                    raise exceptions.InvalidRequest(f"bootstrap document {document.Name} depends on {name}, which isn't listed before it")
+                depends_on.extend(keys_by_name[name])
+        keys_by_name.setdefault(document.Name, []).append(key)
+        steps.append(BootstrapStep(key, document.Name, document.Parameters, depends_on, document.TimeoutSeconds))
+    return steps
+
+
+def _tail(text: str) -> str:
+    text = text.strip()
+    return text if len(text) <= TAIL_CHARACTERS else f"...{text[-TAIL_CHARACTERS:]}"
+
+
+def _send(session: SessionProxy, instance_id: str, step: BootstrapStep) -> str:
+    ssm_client = get_client(session, "ssm")
+    try:
+        ssm_client.describe_document(Name=step.document)
+    except ssm_client.exceptions.InvalidDocument as e:
+        raise exceptions.InvalidRequest(f"Document named {step.document} doesn't exist") from e
+    parameters = {
+        'InstanceIds': [instance_id],
+        'DocumentName': step.document,
+        'Comment': f"bootstrap {step.key}"[:100],
+    }
+    if step.parameters:
+        parameters['Parameters'] = {name: list(values) for name, values in step.parameters.items()}
+    if BOOTSTRAP_LOG_GROUP:
+        parameters['CloudWatchOutputConfig'] = {'CloudWatchOutputEnabled': True, 'CloudWatchLogGroupName': BOOTSTRAP_LOG_GROUP}
+    response = ssm_client.send_command(**parameters)
+    LOG.info(f"started bootstrap document {step.key} as command {response['Command']['CommandId']}")
+    return response['Command']['CommandId']
+
+
+def _poll(session: SessionProxy, instance_id: str, command_id: str) -> Mapping[str, Any]:
+    ssm_client = get_client(session, "ssm")
+    try:
+        return ssm_client.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+    except ssm_client.exceptions.InvocationDoesNotExist:
+        # not visible for a moment after send_command
+        return {'Status': 'Pending', 'StandardOutputContent': '', 'StandardErrorContent': ''}
+
+
+def _log_new_output(step: BootstrapStep, state: List[Any], invocation: Mapping[str, Any]) -> None:
+    # Forward only the output that arrived since the last poll; Lambda ships it to
+    # CloudWatch Logs.
+    for index, stream in ((STDOUT_SEEN, 'StandardOutputContent'), (STDERR_SEEN, 'StandardErrorContent')):
+        text = invocation.get(stream) or ''
+        # get_command_invocation keeps the first 24000 characters; start over if it shrank
+        new = text[state[index]:] if len(text) >= state[index] else text
+        for line in new.splitlines():
+            LOG.info(f"[{step.key}] {line}")
+        state[index] = len(text)
+
+
+def _run_all(fn, items) -> Tuple[List[Any], Optional[Exception]]:
+    # fn(item) for every item concurrently. Every call finishes before the first
+    # error is handed back, so sends that went through are still recorded.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = [run_in_context(pool, fn, item) for item in items]
+    results, errors = [], []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(None)
+            errors.append(e)
+    return results, (errors[0] if errors else None)
+
+
+def advance_documents(session: SessionProxy, instance_id: str, steps: Sequence[BootstrapStep], callback_context) -> Tuple[str, str]:
+    # Poll the documents that are running, start every document whose
+    # dependencies have all succeeded, and return (SUCCEEDED|RUNNING|FAILED,
+    # message). Documents with no dependency between them run side by side.
+    states = callback_context.documents
+    if states is None:
+        states = callback_context.documents = {}
+        if callback_context.command_id is not None and steps:
+            # a single document sent by an earlier handler version
+            states[steps[0].key] = [callback_context.command_id, "InProgress", 0, 0]
+    now = time()
+    timeline = callback_context.get(TIMELINE_KEY) or {}
+
+    running = [step for step in steps if step.key in states and states[step.key][STATUS] in RUNNING_STATUSES]
+    results, error = _run_all(lambda step: _poll(session, instance_id, states[step.key][COMMAND]), running)
+    latest = None
+    for step, invocation in zip(running, results):
+        if invocation is None:
+            continue
+        state = states[step.key]
+        _log_new_output(step, state, invocation)
+        state[STATUS] = invocation['Status']
+        if state[STATUS] not in RUNNING_STATUSES:
+            seconds = finish_span(callback_context, step.span)
+            LOG.info(f"bootstrap document {step.key} {state[STATUS]} after {seconds:.1f}s")
+        if state[STATUS] == 'Success':
+            continue
+        if state[STATUS] not in RUNNING_STATUSES:
+            return FAILED, f"bootstrap document {step.key} {state[STATUS]}: {_tail(invocation.get('StandardErrorContent') or invocation.get('StandardOutputContent') or '')}"
+        started = timeline.get(step.span, [now])[0]
+        if step.timeout is not None and now - started > step.timeout:
+            get_client(session, "ssm").cancel_command(CommandId=state[COMMAND], InstanceIds=[instance_id])
+            return FAILED, f"bootstrap document {step.key} still {state[STATUS]} after {step.timeout}s: {_tail(invocation.get('StandardOutputContent') or '')}"
+        output = (invocation.get('StandardOutputContent') or '').strip()
+        latest = f"{step.key} {state[STATUS]} {int(now - started)}s" + (f": {_tail(output.splitlines()[-1])}" if output else "")
+    if error is not None:
+        raise error
+
+    ready = [
+        step for step in steps
+        if step.key not in states and all(states.get(key, [None, None])[STATUS] == 'Success' for key in step.depends_on)
+    ]
+    results, error = _run_all(lambda step: _send(session, instance_id, step), ready)
+    for step, command_id in zip(ready, results):
+        if command_id is not None:
+            states[step.key] = [command_id, "Pending", 0, 0]
+            start_span(callback_context, step.span, now)
+    if error is not None:
+        raise error
+
+    if all(states.get(step.key, [None, None])[STATUS] == 'Success' for step in steps):
+        # per-document times are in the stage summary as Document:<name>
+        return SUCCEEDED, f"{len(steps)} bootstrap document(s) succeeded"
+    if ready:
+        return RUNNING, f"started {', '.join(step.key for step in ready)}"
+    return RUNNING, latest or "waiting on bootstrap documents"
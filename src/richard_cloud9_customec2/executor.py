@@ -0,0 +1,63 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, List, Mapping, MutableMapping, Sequence, Tuple
+
+from .instrumentation import run_in_context
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Callback context key recording which tasks have already completed, so a
+# re-invocation only runs the remaining ones.
+TASKS_KEY = "TASKS"
+DONE = "DONE"
+MAX_WORKERS = 4
+
+Task = Tuple[Callable[[], Any], Sequence[str]]
+
+
+class TaskNotReady(Exception):
+    # Raised by a task whose inputs are not available yet (e.g. the instance has
+    # not been launched); the task and its dependents are retried on a later pass.
+    pass
+
+
+def run_tasks(tasks: Mapping[str, Task], callback_context: MutableMapping[str, Any], max_workers: int = MAX_WORKERS) -> List[str]:
+    # Run `tasks` ({name: (fn, dependency names)}) on a thread pool, starting each
+    # one as soon as its dependencies are done. Returns the names of tasks that
+    # could not run yet. The first error raised by a task is re-raised once every
+    # independent task has finished.
+    outcomes = callback_context.setdefault(TASKS_KEY, {})
+    done = {name for name in tasks if outcomes.get(name) == DONE}
+    blocked = set()
+    errors = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while True:
+            for name, (fn, dependencies) in tasks.items():
+                if name in done or name in blocked or name in running.values():
+                    continue
+                if any(dependency in blocked for dependency in dependencies):
+                    blocked.add(name)
+                elif all(dependency in done for dependency in dependencies):
+                    running[run_in_context(pool, fn)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except TaskNotReady as e:
+                    LOG.info(f"task {name} not ready: {e}")
+                    blocked.add(name)
+                except Exception as e:
+                    LOG.info(f"task {name} failed: {e}")
+                    blocked.add(name)
+                    errors.append(e)
+                else:
+                    done.add(name)
+                    outcomes[name] = DONE
+    if errors:
+        raise errors[0]
+    return [name for name in tasks if name not in done]
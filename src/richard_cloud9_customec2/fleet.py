@@ -0,0 +1,188 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields, replace
+from time import monotonic, sleep
+from typing import Any, List, Optional, Sequence, Tuple
+from uuid import uuid4
+
+from cloudformation_cli_python_lib import (
+    OperationStatus,
+    ProgressEvent,
+    SessionProxy,
+)
+
+from .clients import get_client
+from .context import CallbackContext
+from .executor import DONE
+from .handlers import create, ensure_service_role
+from .interface import (
+    EnvironmentCreated,
+    InstanceStable,
+    ResizedInstance,
+    RoleCreated,
+)
+from .models import ResourceHandlerRequest, ResourceModel
+from .preflight import preflight
+from .readiness import probe_for
+from .scheduler import reschedule
+from .tagging import instance_resources
+from .throttling import is_throttle, reset_retry_budget, throttled
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Stage steps in flight at once across the fleet; keeps create_environment_ec2
+# and the IAM calls behind it under the Cloud9/IAM rate limits.
+MAX_CONCURRENCY = 8
+TICK_SECONDS = 5
+# ec2 describe_instances filter value limit
+INSTANCE_FILTER_BATCH_SIZE = 40
+
+
+class FleetMember:
+    def __init__(self, request: ResourceHandlerRequest):
+        self.request = request
+        self.callback_context = CallbackContext(tasks={"ServiceRole": DONE, "Preflight": DONE})
+        self.progress = ProgressEvent(
+            status=OperationStatus.IN_PROGRESS,
+            resourceModel=request.desiredResourceState,
+            callbackContext=self.callback_context,
+        )
+        self.due = 0.0
+
+    @property
+    def stage(self):
+        return self.callback_context.stage
+
+    @property
+    def in_progress(self) -> bool:
+        return self.progress.status == OperationStatus.IN_PROGRESS
+
+
+def _member_request(template: ResourceModel, name: str, owner: str, account_id: Optional[str], region: Optional[str]) -> ResourceHandlerRequest:
+    values = {field.name: None for field in fields(ResourceHandlerRequest)}
+    values.update(
+        clientRequestToken=str(uuid4()),
+        desiredResourceState=replace(template, Name=name, Owner=owner, Arn=None, EnvironmentId=None),
+        awsAccountId=account_id,
+        region=region,
+    )
+    return ResourceHandlerRequest(**values)
+
+
+def _batches(items: Sequence[Any], size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _lookup_instances(session: SessionProxy, members: Sequence[FleetMember]) -> None:
+    # One describe_instances per batch of environments still waiting for their
+    # instance; fills INSTANCE_ID/VOLUME_ID/RESOURCE_IDS so the per-member Volume
+    # task skips it.
+    waiting = {
+        member.callback_context.environment_id: member
+        for member in members
+        if isinstance(member.stage, (EnvironmentCreated, RoleCreated)) and member.callback_context.volume_id is None
+    }
+    if not waiting:
+        return
+    ec2_client = get_client(session, "ec2")
+    for environment_ids in _batches(list(waiting), INSTANCE_FILTER_BATCH_SIZE):
+        response = ec2_client.describe_instances(
+            Filters=[{'Name': 'tag:aws:cloud9:environment', 'Values': environment_ids}]
+        )
+        for reservation in response['Reservations']:
+            for instance in reservation['Instances']:
+                tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+                member = waiting.get(tags.get('aws:cloud9:environment'))
+                if member is None or not instance.get('BlockDeviceMappings'):
+                    continue
+                member.callback_context.instance_id = instance['InstanceId']
+                member.callback_context.volume_id = instance['BlockDeviceMappings'][0]['Ebs']['VolumeId']
+                member.callback_context.resource_ids = instance_resources(instance)
+                member.due = 0.0
+
+
+def _poll_readiness(session: SessionProxy, members: Sequence[FleetMember]) -> None:
+    # One bulk readiness probe per strategy for every instance waiting for SSM;
+    # members whose instance is managed move straight on to InstanceStable.
+    waiting = {}
+    for member in members:
+        if isinstance(member.stage, ResizedInstance):
+            strategy = member.request.desiredResourceState.ReadinessProbe
+            waiting.setdefault(strategy, {})[member.callback_context.instance_id] = member
+    for strategy, by_instance in waiting.items():
+        ready = probe_for(strategy, session).ready(list(by_instance))
+        for instance_id, member in by_instance.items():
+            if instance_id in ready:
+                member.callback_context.stage = InstanceStable()
+                member.due = 0.0
+            else:
+                # still counts against the stage deadline
+                member.progress = reschedule(member.progress, member.stage)
+
+
+def _step(member: FleetMember, session: SessionProxy) -> None:
+    stage = member.stage
+    try:
+        progress = create(stage, member.request, member.callback_context, session)
+    except Exception as e:
+        if is_throttle(e):
+            member.progress = throttled(member.request, member.callback_context, e)
+            member.due = monotonic() + member.progress.callbackDelaySeconds
+            return
+        LOG.info(f"{member.request.desiredResourceState.Name} failed: {e}")
+        progress = ProgressEvent(
+            status=OperationStatus.FAILED,
+            resourceModel=member.request.desiredResourceState,
+            callbackContext=member.callback_context,
+            message=str(e),
+        )
+    member.progress = progress
+    advanced = type(member.stage) is not type(stage)
+    member.due = monotonic() + (0 if advanced else progress.callbackDelaySeconds)
+
+
+def provision_fleet(
+    session: SessionProxy,
+    template: ResourceModel,
+    members: Sequence[Tuple[str, str]],
+    account_id: Optional[str] = None,
+    region: Optional[str] = None,
+    max_concurrency: int = MAX_CONCURRENCY,
+    tick_seconds: float = TICK_SECONDS,
+) -> List[ProgressEvent]:
+    # Create one environment per (name, owner) in `members`, all from `template`,
+    # driving them through the create stages together. The template is checked
+    # and the service role set up once for the whole fleet, and instance/SSM
+    # polling is batched per tick. Returns the final ProgressEvent of every
+    # member, in order.
+    fleet = [FleetMember(_member_request(template, name, owner, account_id, region)) for name, owner in members]
+    if fleet:
+        preflight(session, fleet[0].request.desiredResourceState, region)
+    ensure_service_role(session, account_id)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        while True:
+            active = [member for member in fleet if member.in_progress]
+            if not active:
+                break
+            reset_retry_budget()
+            try:
+                _lookup_instances(session, active)
+                _poll_readiness(session, active)
+            except Exception as e:
+                if not is_throttle(e):
+                    raise
+                # members are looked up and probed again next tick
+                LOG.info(f"fleet polling throttled: {e}")
+            now = monotonic()
+            due = [
+                member for member in active
+                if member.due <= now and not isinstance(member.stage, ResizedInstance)
+            ]
+            # ResizedInstance members are only advanced by the batched readiness probe
+            list(pool.map(lambda member: _step(member, session), due))
+            LOG.info(f"fleet tick: {len(active)} in progress, {len(due)} stepped")
+            if not due:
+                sleep(tick_seconds)
+    return [member.progress for member in fleet]
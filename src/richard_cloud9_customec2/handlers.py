@@ -1,10 +1,8 @@
-import inspect
 import logging
-from time import sleep
-import json
-import base64
-import botocore
+import os
+from time import monotonic, sleep, time
 from typing import Any, MutableMapping, Optional
+from dataclasses import fields, replace
 from functools import singledispatch
 
 from cloudformation_cli_python_lib import (
@@ -27,35 +25,56 @@ from .interface import (
     ProfileAttached,
     CommandSent,
     InstanceStable,
-    ResizedInstance
+    ResizedInstance,
+    EnvironmentDeleting,
+    EnvironmentDeleted,
+    InstanceStopping,
+    InstanceStarting,
+    VolumeModifying,
+    FilesystemGrowing,
+    ProfileAssociating,
 )
 
+from . import claims
+from .bootstrap import bootstrap_cache, prerequisite_key, prerequisite_missing
+from .changes import MANAGED_TAG_KEY, PROFILE_TAG, UpdatePlan, plan_update, tag_list
+from .clients import get_client
+from .context import CallbackContext
+from .documents import FAILED, SUCCEEDED, advance_documents, bootstrap_steps
+from .executor import DONE, TaskNotReady, run_tasks
+from .instrumentation import finish_span, start_span, summary, timed_stage
 from .models import ResourceHandlerRequest, ResourceModel
+from .placement import choose_subnet, is_capacity_error
+from .policies import reconcile_policies, reset_policy_cache, swap_policy
+from .preflight import IMAGE_IDS, candidate_subnets, preflight
+from .profiles import EC2_TRUST_POLICY, PROFILE_PROPAGATION_SECONDS, acquire_profile, claimed_tag, legacy_names, profile_names, trim_profiles
+from .readiness import probe_for
+from .scheduler import STAGE_SCHEDULES, reschedule
+from .snapshot import environment_id_from_arn, invalidate_snapshot, list_environments, read_snapshot
+from .tagging import instance_resources, resource_tags, tag_tasks
+from .throttling import THROTTLED_KEY, is_throttle, reset_retry_budget, throttled
+from .volumes import RESIZED_STATES, send_grow_filesystem, volume_modification
 
 # Use this logger to forward log messages to CloudWatch Logs.
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
 TYPE_NAME = "Richard::Cloud9::CustomEC2"
 
+# Seconds a single invocation may keep advancing through create stages before
+# handing back to CloudFormation. 0 advances exactly one stage per invocation.
+CREATE_TIME_BUDGET_SECONDS = float(os.environ.get("CREATE_TIME_BUDGET_SECONDS", "30"))
+# Longest sleep between in-invocation polls of a stage that is still waiting.
+SHORT_POLL_SECONDS = float(os.environ.get("SHORT_POLL_SECONDS", "5"))
+
 resource = Resource(TYPE_NAME, ResourceModel)
 test_entrypoint = resource.test_entrypoint
 
-def get_or_create_role(iam_client, role_name) -> str:
+def get_or_create_role(iam_client, role_name, tags) -> str:
     parameters = {}
     parameters['Path'] = '/service-role/'
     parameters['RoleName'] = role_name
-    parameters['AssumeRolePolicyDocument'] = json.dumps(
-      {
-        'Version': '2012-10-17',
-        'Statement': {
-          'Effect': 'Allow',
-          'Principal': {'Service': 'ec2.amazonaws.com'},
-          'Action': 'sts:AssumeRole'
-        }
-      }
-    )
-    parameters['Tags'] = []
-    parameters['Tags'].append({"Key": "AWSQS-ENVIRONMENT", "Value": "True"})
+    parameters['AssumeRolePolicyDocument'] = EC2_TRUST_POLICY
+    parameters['Tags'] = tags
     parameters['Description'] = 'EC2 Instance Profile Role'
     try:
         response = iam_client.create_role(**parameters)
@@ -64,131 +83,216 @@ def get_or_create_role(iam_client, role_name) -> str:
     return response['Role']['RoleName']
 
 def get_or_attach_managed_policies(iam_client, managed_policies, role_name: str) -> None:
-    iam_response = iam_client.list_attached_role_policies(RoleName=role_name)
-    attached_policies = iam_response['AttachedPolicies']
-    flattened_attached_policies = list(map(lambda x: x['PolicyArn'], attached_policies))
-    for policy in managed_policies:
-        if policy not in flattened_attached_policies:
-            LOG.info(f"Attaching policy: {policy}")
-            iam_client.attach_role_policy(
-                RoleName=role_name,
-                PolicyArn=policy
-            )
-        else:
-            LOG.info("The managed policy was already attached so we're going to do nothing")
+    reconcile_policies(iam_client, role_name, managed_policies)
     return
+
+def drive(dispatch, provisioning_state, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy, time_budget: float) -> ProgressEvent:
+    # Run consecutive stages of a singledispatch state machine in this invocation.
+    # A stage that advances LOCAL_STATUS is followed immediately by the next one. A
+    # polling stage (one with a schedule in STAGE_SCHEDULES) that is still waiting
+    # is short-polled; any other stage's delay, such as InstanceStable's IAM
+    # propagation wait, is waited out in full. Once the next step would overrun
+    # the time budget the last progress event is returned to CloudFormation as-is.
+    # A stage that stays throttled after its retries is handed back to be re-run
+    # after a backoff.
+    deadline = monotonic() + time_budget
+    while True:
+        with timed_stage(callback_context, type(provisioning_state).__name__ if provisioning_state is not None else "Started"):
+            try:
+                progress = dispatch(provisioning_state, request, callback_context, session)
+            except Exception as e:
+                if not is_throttle(e):
+                    raise
+                LOG.info(f"{type(provisioning_state).__name__} throttled: {e}")
+                return throttled(request, callback_context, e)
+        callback_context.pop(THROTTLED_KEY, None)
+        if progress.status != OperationStatus.IN_PROGRESS:
+            timings = summary(callback_context)
+            progress.message = f"{progress.message} ({timings})" if progress.message else timings
+            return progress
+        callback_context = progress.callbackContext
+        next_state = callback_context.stage
+        if type(next_state) is not type(provisioning_state):
+            delay = 0
+        elif type(next_state).__name__ in STAGE_SCHEDULES:
+            delay = min(progress.callbackDelaySeconds, SHORT_POLL_SECONDS)
+        else:
+            delay = progress.callbackDelaySeconds
+        if monotonic() + delay >= deadline:
+            return progress
+        LOG.info(f"continuing in-invocation from {type(provisioning_state).__name__} to {type(next_state).__name__} after {delay}s")
+        sleep(delay)
+        provisioning_state = next_state
     
 
-@singledispatch
-def create(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: MutableMapping[str, Any], session: SessionProxy):
-    LOG.info("starting NEW RESOURCE with request\n{}".format(request))
-    progress: ProgressEvent = ProgressEvent(
-        status=OperationStatus.IN_PROGRESS,
-        resourceModel=request.desiredResourceState,
-        callbackContext=callback_context,
-        callbackDelaySeconds=15
-    )
+SERVICE_ROLE_NAME = 'AWSCloud9SSMAccessRole'
+MANAGED_POLICIES = [
+    'arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore',
+    'arn:aws:iam::aws:policy/CloudWatchAgentServerPolicy'
+    ]
+
+def ensure_service_role(session: SessionProxy, account_id: Optional[str] = None) -> None:
+    # Once the role has been verified for an account it is trusted until an
+    # access-denied or not-found error says otherwise (see forget_service_role)
+    key = prerequisite_key(account_id, SERVICE_ROLE_NAME, MANAGED_POLICIES) if account_id else None
+    cache = bootstrap_cache(session)
+    if key is not None and cache.verified(key):
+        LOG.info(f"{SERVICE_ROLE_NAME} already verified for {account_id}")
+        return
     # Check if service-linked role exists
-    iam_client = session.client("iam")
-    role_name = get_or_create_role(iam_client, 'AWSCloud9SSMAccessRole')
-    
+    iam_client = get_client(session, "iam")
+    # shared by every environment in the account, so it only gets the managed tag
+    role_name = get_or_create_role(iam_client, SERVICE_ROLE_NAME, tag_list({MANAGED_TAG_KEY: "True"}))
     # Check Role for managed policies, attach them if they don't exist
-    managed_policies = [
-        'arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore',
-        'arn:aws:iam::aws:policy/CloudWatchAgentServerPolicy'
-        ]
-    get_or_attach_managed_policies(iam_client, managed_policies, role_name)
+    get_or_attach_managed_policies(iam_client, MANAGED_POLICIES, role_name)
+    if key is not None:
+        cache.mark_verified(key)
 
+def forget_service_role(session: SessionProxy, account_id: Optional[str]) -> None:
+    if account_id:
+        bootstrap_cache(session).invalidate(prerequisite_key(account_id, SERVICE_ROLE_NAME, MANAGED_POLICIES))
+
+def create_environment(request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy) -> None:
     # Create SSM instance
-    cloud9_client = session.client("cloud9")
+    cloud9_client = get_client(session, "cloud9")
     # TODO: If Name isn't supplied, generate one (maybe ensure we don't duplicate names)
     # TODO: Expose stop time
     # TODO: Expose VPC configuration
-    # TODO: Expose Description
     parameters = {}
     parameters['name'] = request.desiredResourceState.Name
     parameters['instanceType'] = request.desiredResourceState.InstanceType
     parameters['ownerArn'] = request.desiredResourceState.Owner
     parameters['connectionType'] ='CONNECT_SSM'
-    if request.desiredResourceState.OperatingSystem == 'AMAZON_LINUX_2':
-        parameters['imageId'] = 'amazonlinux-2-x86_64'
-    elif request.desiredResourceState.OperatingSystem == 'AMAZON_LINUX':
-        parameters['imageId'] = 'amazonlinux-1-x86_64'
-    elif request.desiredResourceState.OperatingSystem == 'UBUNTU_18_04':
-        parameters['imageId'] = 'ubuntu-18.04-x86_64'
-    else:
-        # Something is wrong
-        pass
-    if request.desiredResourceState.Tags is not None:
-        parameters['tags'] = request.desiredResourceState._serialize_list(request.desiredResourceState.Tags)
-    else:
-        parameters['tags'] = []
-    parameters['tags'].append({"Key": "AWSQS-ENVIRONMENT", "Value": "True"})
+    if request.desiredResourceState.OperatingSystem not in IMAGE_IDS:
+        raise exceptions.InvalidRequest(f"OperatingSystem {request.desiredResourceState.OperatingSystem} isn't supported; use one of {', '.join(IMAGE_IDS)}")
+    parameters['imageId'] = IMAGE_IDS[request.desiredResourceState.OperatingSystem]
+    parameters['tags'] = tag_list(resource_tags(request.desiredResourceState))
     if True:
         parameters['automaticStopTimeMinutes'] = 123
-    if False:
-        parameters['description'] = ''
-        parameters['subnetId'] = ''
-    LOG.info(f"parameters: {parameters}")
-    response = cloud9_client.create_environment_ec2(**parameters)
+    if request.desiredResourceState.Description is not None:
+        parameters['description'] = request.desiredResourceState.Description
+    candidates = candidate_subnets(request.desiredResourceState)
+    while True:
+        if candidates:
+            # Subnets already tried for this resource are out of capacity or addresses
+            tried = callback_context.subnets or []
+            subnet_id = choose_subnet(session, request.region, parameters['instanceType'], candidates, tried)
+            if subnet_id is None:
+                raise exceptions.GeneralServiceException(
+                    f"no capacity for {parameters['instanceType']} in any subnet (tried {', '.join(tried) or 'none with free addresses'})"
+                )
+            parameters['subnetId'] = subnet_id
+        LOG.info(f"parameters: {parameters}")
+        try:
+            response = cloud9_client.create_environment_ec2(**parameters)
+        except Exception as e:
+            if not candidates or is_throttle(e) or not is_capacity_error(str(e)):
+                raise
+            LOG.info(f"{parameters['subnetId']} can't take the environment ({e}), trying the next subnet")
+            callback_context.subnets = (callback_context.subnets or []) + [parameters['subnetId']]
+            continue
+        break
+    if candidates:
+        # the last subnet tried is the one the environment is being created in
+        callback_context.subnets = (callback_context.subnets or []) + [parameters['subnetId']]
+    callback_context.environment_id = response['environmentId']
+
+def retry_placement(progress: ProgressEvent, callback_context: CallbackContext, session: SessionProxy) -> ProgressEvent:
+    # Cloud9 accepts a create and only fails the environment once its instance
+    # can't be launched. A capacity failure in a subnet sends the resource back
+    # to create the environment in the next-best candidate; anything else fails it.
+    cloud9_client = get_client(session, "cloud9")
+    response = cloud9_client.describe_environments(environmentIds=[callback_context.environment_id])
+    lifecycle = response['environments'][0].get('lifecycle', {}) if response['environments'] else {}
+    if lifecycle.get('status') != 'CREATE_FAILED':
+        return progress
+    reason = lifecycle.get('reason', '')
+    if not callback_context.subnets or not is_capacity_error(reason):
+        progress.status = OperationStatus.FAILED
+        progress.errorCode = HandlerErrorCode.GeneralServiceException
+        progress.message = f"environment {callback_context.environment_id} failed: {reason}"
+        return progress
+    LOG.info(f"environment {callback_context.environment_id} failed in {callback_context.subnets[-1]} ({reason}), placing it again")
+    ignore_missing(lambda: cloud9_client.delete_environment(environmentId=callback_context.environment_id))
+    callback_context.environment_id = None
+    callback_context.tasks.pop("Environment", None)
+    callback_context.poll = None
+    progress.resourceModel.Arn = None
+    progress.callbackContext.stage = None
+    progress.callbackDelaySeconds = 0
+    return progress
 
-    progress.callbackContext["ENVIRONMENT_ID"] = response['environmentId']
+def ensure_environment_policies(request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy) -> None:
+    iam_client = get_client(session, "iam")
+    managed_policies = list(MANAGED_POLICIES)
+    if request.desiredResourceState.PermissionsPolicy is not None:
+        managed_policies.append(request.desiredResourceState.PermissionsPolicy)
+    get_or_attach_managed_policies(iam_client, managed_policies, profile_names(callback_context)[1])
 
-    response = cloud9_client.describe_environments(environmentIds=[progress.callbackContext["ENVIRONMENT_ID"]])
-    if len(response['environments']) > 0:
-        environment_arn = response['environments'][0]['arn']
-        progress.resourceModel.Arn = environment_arn
-        progress.callbackContext["LOCAL_STATUS"] = EnvironmentCreated()
+def ensure_instance_profile(request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy) -> None:
+    tags = tag_list(resource_tags(request.desiredResourceState))
+    if callback_context.legacy_profile:
+        ensure_legacy_profile(tags, callback_context, session)
     else:
-        progress.status = OperationStatus.FAILED
-        progress.message = f"no environments found for environmnet id: {progress.callbackContext['ENVIRONMENT_ID']}"
+        acquire_profile(session, request.clientRequestToken, MANAGED_POLICIES, tags, callback_context)
 
-    return progress
+def ensure_legacy_profile(tags, callback_context: CallbackContext, session: SessionProxy) -> None:
+    # The per-environment role and profile earlier handler versions created (see
+    # profiles.legacy_names), for creates that started on one of them
+    iam_client = get_client(session, "iam")
+    instance_profile_name, role_name = legacy_names(callback_context.environment_id)
+    get_or_create_role(iam_client, role_name, tags)
+    try:
+        iam_client.create_instance_profile(InstanceProfileName=instance_profile_name, Tags=tags)
+        callback_context.instance_profile_created = time()
+    except iam_client.exceptions.EntityAlreadyExistsException:
+        pass
+    try:
+        iam_client.add_role_to_instance_profile(InstanceProfileName=instance_profile_name, RoleName=role_name)
+        callback_context.instance_profile_created = time()
+    except iam_client.exceptions.LimitExceededException:
+        # the role is already in it
+        pass
 
-@create.register(EnvironmentCreated)
-def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: MutableMapping[str, Any], session: SessionProxy):
-    progress: ProgressEvent = ProgressEvent(
-        status=OperationStatus.IN_PROGRESS,
-        resourceModel=request.desiredResourceState,
-        callbackContext=callback_context,
-        callbackDelaySeconds=15
-    )
-    # Create new IAM Role
-    iam_client = session.client("iam")
-    role_name = get_or_create_role(iam_client, f'{callback_context["ENVIRONMENT_ID"]}-instance-role')
-    progress.callbackContext["LOCAL_STATUS"] = RoleCreated()
-    return progress
-    
-@create.register(RoleCreated)
-def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: MutableMapping[str, Any], session: SessionProxy):
-    progress: ProgressEvent = ProgressEvent(
-        status=OperationStatus.IN_PROGRESS,
-        resourceModel=request.desiredResourceState,
-        callbackContext=callback_context,
-        callbackDelaySeconds=15
-    )
-    # Get instance id
-    ec2_client = session.client("ec2")
+def trim_profile_pool(session: SessionProxy) -> None:
+    # Best effort: a surplus profile only costs an unused role
+    try:
+        trim_profiles(session)
+    except Exception as e:
+        LOG.info(f"could not trim the instance profile pool: {e}")
+
+def locate_instance(callback_context: CallbackContext, session: SessionProxy) -> None:
+    # Get instance id, unless a batched fleet lookup already found it
+    if callback_context.volume_id is not None:
+        return
+    ec2_client = get_client(session, "ec2")
     response = ec2_client.describe_instances(
         Filters=[
             {
                 'Name': 'tag:aws:cloud9:environment',
                 'Values': [
-                    callback_context['ENVIRONMENT_ID'],
+                    callback_context.environment_id,
                 ]
             },
         ]
     )
     try:
-        instance_id = response['Reservations'][0]['Instances'][0]['InstanceId']
-        ebs_volume_id = response['Reservations'][0]['Instances'][0]['BlockDeviceMappings'][0]['Ebs']['VolumeId']
-        progress.callbackContext["INSTANCE_ID"] = instance_id
-        progress.callbackContext["VOLUME_ID"] = ebs_volume_id
-    except Exception as e:
-        LOG.info(f"Unable to determine EC2 Instance ID or EBS Volume ID for environment {callback_context['ENVIRONMENT_ID']}")
-        LOG.info(f"error: {e}")
-        progress.status = OperationStatus.FAILED
-        return progress
+        instance = response['Reservations'][0]['Instances'][0]
+        instance_id = instance['InstanceId']
+        ebs_volume_id = instance['BlockDeviceMappings'][0]['Ebs']['VolumeId']
+    except (IndexError, KeyError) as e:
+        raise TaskNotReady(f"no EC2 Instance ID or EBS Volume ID yet for environment {callback_context.environment_id}") from e
+    callback_context.instance_id = instance_id
+    callback_context.volume_id = ebs_volume_id
+    callback_context.resource_ids = instance_resources(instance)
+    if callback_context.instance_profile_name is None:
+        # None for environments created before profiles were pooled
+        callback_context.instance_profile_name = next((tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == PROFILE_TAG), None)
+
+def resize_volume(request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy) -> None:
+    ec2_client = get_client(session, "ec2")
+    locate_instance(callback_context, session)
+    ebs_volume_id = callback_context.volume_id
     if request.desiredResourceState.VolumeSize is not None:
         # resize EBS Volume
         response = ec2_client.modify_volume(
@@ -199,122 +303,249 @@ def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context
     else:
         # No need to resize instance
         pass
-    progress.callbackContext["LOCAL_STATUS"] = ResizedInstance()
+
+def environment_tasks(request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    # Per-environment setup that only depends on the environment id. The instance
+    # profile and its policies are independent of the instance lookup and volume
+    # resize, so the two chains run side by side. Once both are done the model's
+    # tags are put on the instance, volume, network interfaces and security
+    # groups, together with the profile name, and on the role and profile.
+    tags = resource_tags(request.desiredResourceState)
+    tasks = {
+        "InstanceProfile": (lambda: ensure_instance_profile(request, callback_context, session), []),
+        "EnvironmentRolePolicies": (lambda: ensure_environment_policies(request, callback_context, session), ["InstanceProfile"]),
+        "Volume": (lambda: resize_volume(request, callback_context, session), []),
+    }
+    tasks.update(tag_tasks(
+        session, callback_context, tags,
+        ec2_dependencies=["Volume", "InstanceProfile"],
+        iam_dependencies=["InstanceProfile"],
+        iam_tags=dict(tags, **claimed_tag(request.clientRequestToken)),
+        # a legacy profile is found by its name (see profiles.profile_names)
+        record_profile=not callback_context.legacy_profile,
+    ))
+    return tasks
+
+def swap_instance_profile(callback_context: CallbackContext, session: SessionProxy) -> str:
+    # Put the environment's profile in place of the one Cloud9 launched the
+    # instance with, in one call; returns the new association id.
+    ec2_client = get_client(session, "ec2")
+    instance_profile_name = profile_names(callback_context)[0]
+    response = ec2_client.describe_iam_instance_profile_associations(
+        Filters=[{'Name': 'instance-id', 'Values': [callback_context.instance_id]}]
+    )
+    current = [
+        association for association in response['IamInstanceProfileAssociations']
+        if association['State'] in ('associating', 'associated')
+    ]
+    if current and current[0]['IamInstanceProfile']['Arn'].endswith(f'/{instance_profile_name}'):
+        # already swapped by an earlier attempt
+        return current[0]['AssociationId']
+    if current:
+        response = ec2_client.replace_iam_instance_profile_association(
+            IamInstanceProfile={'Name': instance_profile_name},
+            AssociationId=current[0]['AssociationId']
+        )
+    else:
+        response = ec2_client.associate_iam_instance_profile(
+            IamInstanceProfile={'Name': instance_profile_name},
+            InstanceId=callback_context.instance_id
+        )
+    LOG.info(f"associating {instance_profile_name} with {callback_context.instance_id}")
+    return response['IamInstanceProfileAssociation']['AssociationId']
+
+def discard_pool_environment(progress: ProgressEvent, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy, error: Exception) -> ProgressEvent:
+    # A claimed pool environment that couldn't be set up for this resource may be
+    # half changed, so rather than going back to the pool it's deleted along with
+    # its role and profile, and the claim released.
+    LOG.info(f"could not set up pool environment {callback_context.environment_id}: {error}")
+    cloud9_client = get_client(session, "cloud9")
+    ignore_missing(lambda: cloud9_client.delete_environment(environmentId=callback_context.environment_id))
+    run_tasks(teardown_tasks(callback_context, session, warm_pool=True), callback_context)
+    progress.resourceModel.Arn = None
+    progress.resourceModel.EnvironmentId = None
+    progress.status = OperationStatus.FAILED
+    progress.errorCode = HandlerErrorCode.GeneralServiceException
+    progress.message = f"could not set up warm pool environment {callback_context.environment_id}: {error}"
     return progress
 
-@create.register(ResizedInstance)
-def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: MutableMapping[str, Any], session: SessionProxy):
+@singledispatch
+def create(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    LOG.info("starting NEW RESOURCE with request\n{}".format(request))
     progress: ProgressEvent = ProgressEvent(
         status=OperationStatus.IN_PROGRESS,
         resourceModel=request.desiredResourceState,
         callbackContext=callback_context,
         callbackDelaySeconds=15
     )
-    ssm_client = session.client('ssm')
-    response = ssm_client.get_inventory(
-        Filters=[
-            {
-                'Key': 'AWS:InstanceInformation.InstanceId',
-                'Values': [
-                    callback_context['INSTANCE_ID'],
-                ],
-                'Type': 'Equal'
-            },
-        ],
+    # Fail a request that can't succeed before anything is created for it
+    run_tasks({"Preflight": (lambda: preflight(session, request.desiredResourceState, request.region), [])}, callback_context)
+    if request.desiredResourceState.WarmPool:
+        # only warm pool resources need the pool module
+        from .pool import claim_environment, holds_pool_environment
+        if callback_context.environment_id is None or holds_pool_environment(callback_context):
+            try:
+                claimed = claim_environment(session, request, callback_context)
+            except Exception as e:
+                if is_throttle(e) or not holds_pool_environment(callback_context):
+                    raise
+                return discard_pool_environment(progress, request, callback_context, session, e)
+            if claimed is not None:
+                return claimed
+            LOG.info("warm pool is empty, creating a new environment")
+    # The account-level service role and the environment don't depend on each other
+    tasks = {
+        "ServiceRole": (lambda: ensure_service_role(session, request.awsAccountId), []),
+        "Environment": (lambda: create_environment(request, callback_context, session), []),
+    }
+    try:
+        run_tasks(tasks, callback_context)
+    except Exception as e:
+        if not prerequisite_missing(e):
+            raise
+        # The service role may have been removed since it was cached as verified;
+        # set it up again before retrying the environment.
+        LOG.info(f"prerequisite missing ({e}), re-verifying {SERVICE_ROLE_NAME}")
+        forget_service_role(session, request.awsAccountId)
+        ensure_service_role(session, request.awsAccountId)
+        callback_context.tasks["ServiceRole"] = DONE
+        run_tasks(tasks, callback_context)
+
+    cloud9_client = get_client(session, "cloud9")
+    response = cloud9_client.describe_environments(environmentIds=[progress.callbackContext.environment_id])
+    if len(response['environments']) > 0:
+        environment_arn = response['environments'][0]['arn']
+        progress.resourceModel.Arn = environment_arn
+        progress.callbackContext.stage = EnvironmentCreated()
+    else:
+        progress.status = OperationStatus.FAILED
+        progress.message = f"no environments found for environmnet id: {progress.callbackContext.environment_id}"
+
+    return progress
+
+@create.register(EnvironmentCreated)
+@create.register(RoleCreated)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
     )
-    if len(response['Entities']) > 0:
+    # RoleCreated is only reached by resources that started on an older handler;
+    # both stages run the same (idempotent) task graph.
+    pending = run_tasks(environment_tasks(request, callback_context, session), callback_context)
+    if pending and callback_context.instance_id is None:
+        progress = retry_placement(progress, callback_context, session)
+        if callback_context.stage is None or progress.status != OperationStatus.IN_PROGRESS:
+            return progress
+    if pending:
+        LOG.info(f"waiting on {pending}")
+        progress = reschedule(progress, obj)
+    else:
+        progress.callbackContext.stage = ResizedInstance()
+    return progress
+
+@create.register(ResizedInstance)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    probe = probe_for(request.desiredResourceState.ReadinessProbe, session)
+    if callback_context.instance_id in probe.ready([callback_context.instance_id]):
         progress.message = "instance stable"
-        progress.callbackContext["LOCAL_STATUS"] = InstanceStable()
+        progress.callbackContext.stage = InstanceStable()
     else:
         LOG.info(f"Instance not ready")
-        LOG.info(f"response: {response}")
-        progress.callbackDelaySeconds=30
+        progress = reschedule(progress, obj)
     return progress
     
     
 @create.register(InstanceStable)
-def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: MutableMapping[str, Any], session: SessionProxy):
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
     progress: ProgressEvent = ProgressEvent(
         status=OperationStatus.IN_PROGRESS,
         resourceModel=request.desiredResourceState,
         callbackContext=callback_context,
         callbackDelaySeconds=15
     )
-    # Attach Role to instance
-    iam_client = session.client("iam")
-    role_name = get_or_create_role(iam_client, f'{callback_context["ENVIRONMENT_ID"]}-instance-role')
-    # Attach required policies
-    managed_policies = [
-        'arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore',
-        'arn:aws:iam::aws:policy/CloudWatchAgentServerPolicy'
-        ]
-    if progress.resourceModel.PermissionsPolicy is not None:
-        managed_policies.append(progress.resourceModel.PermissionsPolicy)
-    get_or_attach_managed_policies(iam_client, managed_policies, role_name)
-    
+    # The instance profile and its policies were normally set up back in
+    # EnvironmentCreated; this only does work for resources that skipped it.
+    tasks = environment_tasks(request, callback_context, session)
+    del tasks["Volume"]
     try:
-        parameters = {}
-        parameters['InstanceProfileName'] = f'{callback_context["ENVIRONMENT_ID"]}-instance-profile'
-        if request.desiredResourceState.Tags is not None:
-            parameters['Tags'] = request.desiredResourceState._serialize_list(request.desiredResourceState.Tags)
-        else:
-            parameters['Tags'] = []
-        parameters['Tags'].append({"Key": "AWSQS-ENVIRONMENT", "Value": "True"})
-        LOG.info(parameters)
-        response = iam_client.create_instance_profile(**parameters)
-
-        LOG.info(f"Instance Profile created, waiting to stabilize")
-        LOG.info(f"response: {response}")
-        progress.callbackDelaySeconds=30
-        # progress.callbackContext["INSTANCE_PROFILE_ID"] = response['InstanceProfile']['InstanceProfileId']
-
-    except iam_client.exceptions.EntityAlreadyExistsException as _:
-        get_instance_response = iam_client.get_instance_profile(InstanceProfileName=f'{callback_context["ENVIRONMENT_ID"]}-instance-profile')
-        instance_profile_name = get_instance_response['InstanceProfile']['InstanceProfileName']
-        attached = False
-        for role in get_instance_response['InstanceProfile']['Roles']:
-            if role_name == role['RoleName']:
-                attached = True
-        if attached == False:
-            response = iam_client.add_role_to_instance_profile(
-                InstanceProfileName=instance_profile_name,
-                RoleName=role_name
-            )
-        progress.callbackContext["INSTANCE_PROFILE_ID"] = get_instance_response['InstanceProfile']['InstanceProfileId']
-        progress.callbackContext["LOCAL_STATUS"] = NewProfileCreated()
-        return progress
-
+        run_tasks(tasks, callback_context)
     except Exception as e:
         LOG.info(f"error creating instance profile: {e}")
         progress.message = f"error creating instance profile: {e}"
         progress.status = OperationStatus.FAILED
+        return progress
 
+    # Only a profile created for this environment (the pool was empty) still has
+    # to propagate; a pooled one was propagated before it was claimed.
+    waited = time() - (callback_context.instance_profile_created or 0)
+    if waited < PROFILE_PROPAGATION_SECONDS:
+        LOG.info(f"Instance Profile created, waiting to stabilize")
+        progress.callbackDelaySeconds = int(PROFILE_PROPAGATION_SECONDS - waited) + 1
+    else:
+        progress.callbackContext.association_id = swap_instance_profile(callback_context, session)
+        progress.callbackContext.stage = ProfileAssociating()
     return progress
 
+@create.register(ProfileAssociating)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    ec2_client = get_client(session, "ec2")
+    response = ec2_client.describe_iam_instance_profile_associations(
+        AssociationIds=[
+            callback_context.association_id,
+        ]
+    )
+    state = response['IamInstanceProfileAssociations'][0]['State']
+    if state == 'associating':
+        progress = reschedule(progress, obj)
+    elif state == 'associated':
+        progress.callbackContext.stage = ProfileAttached()
+    else:
+        progress.status = OperationStatus.FAILED
+        progress.errorCode = HandlerErrorCode.NotStabilized
+        progress.message = f"associating {profile_names(callback_context)[0]} with {callback_context.instance_id} ended {state}"
+    return progress
+
+# NewProfileCreated and DefaultProfileDetached swap the profile in two steps; they
+# are only reached by resources that started on an older handler.
 @create.register(NewProfileCreated)
-def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: MutableMapping[str, Any], session: SessionProxy):
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
     progress: ProgressEvent = ProgressEvent(
         status=OperationStatus.IN_PROGRESS,
         resourceModel=request.desiredResourceState,
         callbackContext=callback_context,
         callbackDelaySeconds=15
     )
-    ec2_client = session.client("ec2")
-    if 'DEFAULT_ASSOCIATION_ID' in callback_context:
+    ec2_client = get_client(session, "ec2")
+    if callback_context.default_association_id is not None:
         try:
             response = ec2_client.describe_iam_instance_profile_associations(
                 AssociationIds=[
-                    callback_context['DEFAULT_ASSOCIATION_ID'],
+                    callback_context.default_association_id,
                 ]
             )
             if response['IamInstanceProfileAssociations'][0]['State'] != 'disassociated':
-                progress.callbackDelaySeconds=60
+                progress = reschedule(progress, obj)
             else:
-                progress.callbackContext["LOCAL_STATUS"] = DefaultProfileDetached()
-        except botocore.exceptions.ClientError as error:
+                progress.callbackContext.stage = DefaultProfileDetached()
+        except ec2_client.exceptions.ClientError as error:
             if error.response['Error']['Code'] == 'InvalidAssociationID.NotFound':
                 LOG.info(f"error getting association status: {error}")
-                progress.callbackContext["LOCAL_STATUS"] = DefaultProfileDetached()
+                progress.callbackContext.stage = DefaultProfileDetached()
             else:
                 LOG.info(error.response['Error'])
                 return progress
@@ -324,7 +555,7 @@ def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context
             Filters=[
                 {
                     'Name': 'instance-id',
-                    'Values': [callback_context['INSTANCE_ID']]
+                    'Values': [callback_context.instance_id]
                 },
             ]
         )
@@ -332,92 +563,409 @@ def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context
         disassociate_response = ec2_client.disassociate_iam_instance_profile(
             AssociationId=default_association_id
         )
-        progress.callbackContext["DEFAULT_ASSOCIATION_ID"] = default_association_id
+        progress.callbackContext.default_association_id = default_association_id
         return progress
 
 
 @create.register(DefaultProfileDetached)
-def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: MutableMapping[str, Any], session: SessionProxy):
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
     progress: ProgressEvent = ProgressEvent(
         status=OperationStatus.IN_PROGRESS,
         resourceModel=request.desiredResourceState,
         callbackContext=callback_context,
         callbackDelaySeconds=15
     )
-    ec2_client = session.client("ec2")
-    if 'ASSOCIATION_ID' in callback_context:
+    ec2_client = get_client(session, "ec2")
+    if callback_context.association_id is not None:
         response = ec2_client.describe_iam_instance_profile_associations(
             AssociationIds=[
-                callback_context['ASSOCIATION_ID'],
+                callback_context.association_id,
             ]
         )
         if response['IamInstanceProfileAssociations'][0]['State'] == 'associating':
-            progress.callbackDelaySeconds=60
+            progress = reschedule(progress, obj)
         else:
-            progress.callbackContext["LOCAL_STATUS"] = ProfileAttached()
+            progress.callbackContext.stage = ProfileAttached()
     else:
         response = ec2_client.associate_iam_instance_profile(
-            IamInstanceProfile={'Name': f'{callback_context["ENVIRONMENT_ID"]}-instance-profile'},
-            InstanceId=callback_context['INSTANCE_ID']
+            IamInstanceProfile={'Name': profile_names(callback_context)[0]},
+            InstanceId=callback_context.instance_id
         )
-        progress.callbackContext["ASSOCIATION_ID"] = response['IamInstanceProfileAssociation']['AssociationId']
+        progress.callbackContext.association_id = response['IamInstanceProfileAssociation']['AssociationId']
 
     return progress
 
 @create.register(ProfileAttached)
-def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: MutableMapping[str, Any], session: SessionProxy):
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
     progress: ProgressEvent = ProgressEvent(
         status=OperationStatus.IN_PROGRESS,
         resourceModel=request.desiredResourceState,
         callbackContext=callback_context,
         callbackDelaySeconds=15
     )
-    if progress.resourceModel.BootstrapDocumentName is not None:
-        document_name = progress.resourceModel.BootstrapDocumentName
-        ssm_client = session.client("ssm")
-        response = ssm_client.describe_document(Name=document_name)
-        if 'Document' in response and response['Document'] is not None:
-            if response['Document']['Name'] != document_name:
-                progress.message = "Document names don't match"
-                progress.status = OperationStatus.FAILED
-            else:
-                parameters = {}
-                parameters['InstanceIds'] = [progress.callbackContext["INSTANCE_ID"]]
-                parameters['DocumentName'] = document_name
-                response = ssm_client.send_command(**parameters)
-                command_id = response['Command']['CommandId']
-                progress.callbackContext["COMMAND_ID"] = command_id
-                progress.callbackContext["LOCAL_STATUS"] = CommandSent()
-        else:
-            progress.message = f"Document named {document_name} doesn't exist"
-            progress.status = OperationStatus.FAILED
-    else:
+    if request.desiredResourceState.VolumeSize is not None and (callback_context.tasks or {}).get("GrowFilesystem") != DONE:
+        # Grow the filesystem into the resized volume before anything runs on it
+        progress.callbackContext.stage = VolumeModifying()
+        return progress
+    if not bootstrap_steps(request.desiredResourceState):
         progress.message = "skipping send command because document was not provided"
         progress.status = OperationStatus.SUCCESS
-    
+        return progress
+    progress.callbackContext.stage = CommandSent()
     return progress
 
 @create.register(CommandSent)
-def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: MutableMapping[str, Any], session: SessionProxy):
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
     progress: ProgressEvent = ProgressEvent(
         status=OperationStatus.IN_PROGRESS,
         resourceModel=request.desiredResourceState,
         callbackContext=callback_context,
         callbackDelaySeconds=15
     )
-    ssm_client = session.client("ssm")
-    response = ssm_client.get_command_invocation(
-        CommandId=progress.callbackContext["COMMAND_ID"],
-        InstanceId=progress.callbackContext["INSTANCE_ID"]
+    steps = bootstrap_steps(request.desiredResourceState)
+    outcome, message = advance_documents(session, callback_context.instance_id, steps, callback_context)
+    progress.message = message
+    if outcome == SUCCEEDED:
+        progress.status = OperationStatus.SUCCESS
+    elif outcome == FAILED:
+        progress.status = OperationStatus.FAILED
+    else:
+        progress = reschedule(progress, obj)
+    return progress
+
+def wait_for_volume(obj: ProvisioningStatus, progress: ProgressEvent, callback_context: CallbackContext, session: SessionProxy) -> ProgressEvent:
+    # modify_volume was called back in EnvironmentCreated, so the modification has
+    # normally reached optimizing while the IAM and profile stages ran. The new
+    # size is usable from then on, even before optimization completes.
+    modification = volume_modification(session, callback_context.volume_id)
+    state = modification['ModificationState'] if modification is not None else None
+    if state == 'failed':
+        progress.status = OperationStatus.FAILED
+        progress.errorCode = HandlerErrorCode.GeneralServiceException
+        progress.message = f"modifying volume {callback_context.volume_id} failed: {modification.get('StatusMessage')}"
+        return progress
+    if state is not None and state not in RESIZED_STATES:
+        LOG.info(f"volume {callback_context.volume_id} is {state} ({modification.get('Progress', 0)}%)")
+        return reschedule(progress, obj)
+    started = modification['StartTime'].timestamp() if modification is not None and modification.get('StartTime') else time()
+    start_span(callback_context, "VolumeResize", started)
+    callback_context.resize_command_id = send_grow_filesystem(session, callback_context.instance_id)
+    progress.callbackContext.stage = FilesystemGrowing()
+    return progress
+
+def filesystem_grown(obj: ProvisioningStatus, progress: ProgressEvent, callback_context: CallbackContext, session: SessionProxy) -> bool:
+    # True once the grow command has succeeded; otherwise `progress` has been
+    # rescheduled or failed.
+    ssm_client = get_client(session, "ssm")
+    try:
+        response = ssm_client.get_command_invocation(
+            CommandId=callback_context.resize_command_id,
+            InstanceId=callback_context.instance_id
+        )
+    except ssm_client.exceptions.InvocationDoesNotExist:
+        # not visible for a moment after send_command
+        reschedule(progress, obj)
+        return False
+    if response['Status'] in ['Pending', 'InProgress', 'Delayed']:
+        reschedule(progress, obj)
+        return False
+    if response['Status'] != 'Success':
+        progress.status = OperationStatus.FAILED
+        progress.message = f"growing the root filesystem of {callback_context.instance_id} failed ({response['Status']}): {response.get('StandardErrorContent', '')[-500:]}"
+        return False
+    seconds = finish_span(callback_context, "VolumeResize")
+    LOG.info(f"root filesystem of {callback_context.instance_id} grown {seconds:.0f}s after the volume modification started")
+    callback_context.tasks["GrowFilesystem"] = DONE
+    return True
+
+@create.register(VolumeModifying)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
     )
-    
-    if response['Status'] == 'Success':
+    return wait_for_volume(obj, progress, callback_context, session)
+
+@create.register(FilesystemGrowing)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    if filesystem_grown(obj, progress, callback_context, session):
+        # back to ProfileAttached for the bootstrap document
+        progress.callbackContext.stage = ProfileAttached()
+    return progress
+
+def environment_gone(session: SessionProxy, environment_id: str) -> bool:
+    # True once the environment is deleted and its instance has terminated
+    cloud9_client = get_client(session, "cloud9")
+    try:
+        response = cloud9_client.describe_environments(environmentIds=[environment_id])
+        if len(response['environments']) > 0:
+            return False
+    except cloud9_client.exceptions.NotFoundException:
+        pass
+    ec2_client = get_client(session, "ec2")
+    response = ec2_client.describe_instances(
+        Filters=[
+            {'Name': 'tag:aws:cloud9:environment', 'Values': [environment_id]},
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']},
+        ]
+    )
+    return not any(reservation['Instances'] for reservation in response['Reservations'])
+
+def ignore_missing(call) -> None:
+    try:
+        call()
+    except Exception as e:
+        if getattr(e, "response", {}).get("Error", {}).get("Code") not in ("NoSuchEntity", "NotFoundException"):
+            raise
+
+def teardown_tasks(callback_context: CallbackContext, session: SessionProxy, warm_pool: bool = False):
+    iam_client = get_client(session, "iam")
+    instance_profile_name, role_name = profile_names(callback_context)
+    tasks = {
+        "DetachPolicies": (lambda: ignore_missing(lambda: reconcile_policies(iam_client, role_name, [], exclusive=True)), []),
+        "RemoveProfileRole": (lambda: ignore_missing(lambda: iam_client.remove_role_from_instance_profile(
+            InstanceProfileName=instance_profile_name,
+            RoleName=role_name
+        )), []),
+        "DeleteInstanceProfile": (lambda: ignore_missing(lambda: iam_client.delete_instance_profile(InstanceProfileName=instance_profile_name)), ["RemoveProfileRole"]),
+        "DeleteRole": (lambda: ignore_missing(lambda: iam_client.delete_role(RoleName=role_name)), ["DetachPolicies", "RemoveProfileRole"]),
+    }
+    if callback_context.instance_profile_name is not None:
+        # only pooled-era profiles are claimed (see profiles.acquire_profile)
+        tasks["ReleaseProfile"] = (lambda: claims.release(session, claims.PROFILE, instance_profile_name), ["DeleteInstanceProfile", "DeleteRole"])
+    if warm_pool:
+        # the environment may have come out of the warm pool (see pool.claim_environment)
+        environment_id = callback_context.environment_id
+        tasks["ReleaseEnvironment"] = (lambda: claims.release(session, claims.ENVIRONMENT, environment_id), [])
+    # caps a pool left larger than PROFILE_POOL_SIZE, e.g. after it was lowered
+    tasks["TrimProfiles"] = (lambda: trim_profile_pool(session), [])
+    return tasks
+
+@singledispatch
+def delete(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    if request.desiredResourceState.Arn is None:
+        # create never got as far as making an environment
         progress.status = OperationStatus.SUCCESS
-    elif response['Status'] in ['Pending', 'InProgress', 'Delayed']:
-        progress.callbackDelaySeconds=60
-    elif response['Status'] in ['Cancelled', 'TimedOut', 'Failed', 'Cancelling']:
-        progress.message = f"command {progress.callbackContext['COMMAND_ID']} did not succeed"
+        progress.resourceModel = None
+        return progress
+    environment_id = request.desiredResourceState.Arn.split(":")[-1]
+    progress.callbackContext.environment_id = environment_id
+    try:
+        # the instance names the profile to tear down once it has terminated
+        locate_instance(callback_context, session)
+    except TaskNotReady as e:
+        LOG.info(f"{e}; tearing down the profile by name")
+    cloud9_client = get_client(session, "cloud9")
+    try:
+        cloud9_client.delete_environment(environmentId=environment_id)
+    except cloud9_client.exceptions.NotFoundException:
+        LOG.info(f"environment {environment_id} is already gone")
+    progress.callbackContext.stage = EnvironmentDeleting()
+    return progress
+
+@delete.register(EnvironmentDeleting)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    if environment_gone(session, callback_context.environment_id):
+        progress.callbackContext.stage = EnvironmentDeleted()
+    else:
+        progress = reschedule(progress, obj)
+    return progress
+
+@delete.register(EnvironmentDeleted)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    # The instance has terminated, so the role and profile can go in parallel
+    tasks = teardown_tasks(callback_context, session, bool(request.desiredResourceState.WarmPool))
+    try:
+        run_tasks(tasks, callback_context)
+    except Exception as e:
+        leftovers = [name for name in tasks if callback_context.tasks.get(name) != DONE]
+        LOG.info(f"teardown incomplete ({leftovers}): {e}")
+        progress = reschedule(progress, obj)
+        progress.message = f"could not finish {', '.join(leftovers)} for {callback_context.environment_id}: {e}"
+        return progress
+    progress.status = OperationStatus.SUCCESS
+    progress.resourceModel = None
+    return progress
+
+def instance_state(session: SessionProxy, instance_id: str):
+    response = get_client(session, "ec2").describe_instances(InstanceIds=[instance_id])
+    instance = response['Reservations'][0]['Instances'][0]
+    return instance['State']['Name'], instance['InstanceType']
+
+def stop_for_resize(request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy) -> None:
+    # The instance type can only be changed while the instance is stopped
+    state, instance_type = instance_state(session, callback_context.instance_id)
+    if instance_type == request.desiredResourceState.InstanceType:
+        LOG.info(f"{callback_context.instance_id} is already {instance_type}")
+        callback_context.tasks["ModifyInstanceType"] = DONE
+        callback_context.tasks["StartInstance"] = DONE
+        return
+    if state in ('stopping', 'stopped'):
+        # Cloud9 stops idle instances; leave it stopped once it's resized
+        LOG.info(f"{callback_context.instance_id} is already {state}")
+        callback_context.tasks["StartInstance"] = DONE
+        return
+    get_client(session, "ec2").stop_instances(InstanceIds=[callback_context.instance_id])
+
+def update_tasks(plan: UpdatePlan, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    # Only the operations the plan needs. Everything but the instance resize is
+    # independent and runs side by side; the instance is stopped here and resized
+    # once it has stopped (InstanceStopping).
+    environment_id = callback_context.environment_id
+    environment_arn = request.desiredResourceState.Arn
+    tasks = {}
+    if plan.environment:
+        tasks["UpdateEnvironment"] = (lambda: get_client(session, "cloud9").update_environment(environmentId=environment_id, **plan.environment), [])
+    if plan.tags_to_set:
+        tasks["TagEnvironment"] = (lambda: get_client(session, "cloud9").tag_resource(ResourceARN=environment_arn, Tags=tag_list(plan.tags_to_set)), [])
+    if plan.tags_to_remove:
+        tasks["UntagEnvironment"] = (lambda: get_client(session, "cloud9").untag_resource(ResourceARN=environment_arn, TagKeys=plan.tags_to_remove), [])
+    # the same tag changes on the instance's EC2 resources and the role
+    tasks.update(tag_tasks(session, callback_context, plan.tags_to_set, plan.tags_to_remove, ec2_dependencies=["Instance"], iam_dependencies=["Instance"]))
+    if plan.policy_to_attach or plan.policy_to_detach:
+        # the instance's tags name the role
+        detach = plan.policy_to_detach if plan.policy_to_detach not in MANAGED_POLICIES else None
+        tasks["SwapPolicy"] = (lambda: swap_policy(get_client(session, "iam"), profile_names(callback_context)[1], plan.policy_to_attach, detach), ["Instance"])
+    if plan.volume_size or plan.instance_type or "SwapPolicy" in tasks or "TagResources" in tasks:
+        tasks["Instance"] = (lambda: locate_instance(callback_context, session), [])
+    if plan.volume_size:
+        tasks["GrowVolume"] = (lambda: get_client(session, "ec2").modify_volume(VolumeId=callback_context.volume_id, Size=plan.volume_size), ["Instance"])
+    if plan.instance_type:
+        tasks["StopInstance"] = (lambda: stop_for_resize(request, callback_context, session), ["Instance"])
+    return tasks
+
+@singledispatch
+def update(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    plan = plan_update(request.previousResourceState, request.desiredResourceState)
+    if callback_context.environment_id is None:
+        environment_id = environment_id_from_arn(request.desiredResourceState.Arn)
+        cloud9_client = get_client(session, "cloud9")
+        try:
+            response = cloud9_client.describe_environments(environmentIds=[environment_id])
+        except cloud9_client.exceptions.NotFoundException:
+            response = {'environments': []}
+        if not response['environments']:
+            raise exceptions.NotFound(TYPE_NAME, request.desiredResourceState.Arn)
+        callback_context.environment_id = environment_id
+    pending = run_tasks(update_tasks(plan, request, callback_context, session), callback_context)
+    if pending:
+        LOG.info(f"waiting on {pending}")
+        return reschedule(progress, obj)
+    if plan.instance_type and callback_context.tasks.get("ModifyInstanceType") != DONE:
+        progress.callbackContext.stage = InstanceStopping()
+        return progress
+    return update_finished(progress, plan, callback_context, session)
+
+def update_finished(progress: ProgressEvent, plan: UpdatePlan, callback_context: CallbackContext, session: SessionProxy) -> ProgressEvent:
+    # A grown volume still needs its filesystem grown, which takes a running
+    # instance; a stopped one has it grown by cloud-init when it next boots.
+    if plan.volume_size and callback_context.tasks.get("GrowFilesystem") != DONE:
+        if instance_state(session, callback_context.instance_id)[0] == 'running':
+            progress.callbackContext.stage = VolumeModifying()
+            return progress
+    progress.status = OperationStatus.SUCCESS
+    progress.message = "; ".join(plan.describe()) or "no changes"
+    return progress
+
+@update.register(InstanceStopping)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    ec2_client = get_client(session, "ec2")
+    instance_id = callback_context.instance_id
+    instance_type = request.desiredResourceState.InstanceType
+    if callback_context.tasks.get("ModifyInstanceType") != DONE and instance_state(session, instance_id)[0] != 'stopped':
+        return reschedule(progress, obj)
+    tasks = {
+        "ModifyInstanceType": (lambda: ec2_client.modify_instance_attribute(InstanceId=instance_id, InstanceType={'Value': instance_type}), []),
+        "StartInstance": (lambda: ec2_client.start_instances(InstanceIds=[instance_id]), ["ModifyInstanceType"]),
+    }
+    try:
+        run_tasks(tasks, callback_context)
+    except Exception as e:
+        if callback_context.tasks.get("ModifyInstanceType") == DONE:
+            raise
+        # Don't leave the environment stopped because the new type was refused
+        LOG.info(f"could not change {instance_id} to {instance_type}: {e}")
+        if callback_context.tasks.get("StartInstance") != DONE:
+            ec2_client.start_instances(InstanceIds=[instance_id])
         progress.status = OperationStatus.FAILED
+        progress.errorCode = HandlerErrorCode.InvalidRequest
+        progress.message = f"could not change {instance_id} to {instance_type}: {e}"
+        return progress
+    progress.callbackContext.stage = InstanceStarting()
+    return progress
+
+@update.register(InstanceStarting)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    state, instance_type = instance_state(session, callback_context.instance_id)
+    if state in ('pending', 'stopping'):
+        return reschedule(progress, obj)
+    LOG.info(f"{callback_context.instance_id} is {state} as {instance_type}")
+    return update_finished(progress, plan_update(request.previousResourceState, request.desiredResourceState), callback_context, session)
+
+@update.register(VolumeModifying)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    return wait_for_volume(obj, progress, callback_context, session)
+
+@update.register(FilesystemGrowing)
+def _(obj: ProvisioningStatus, request: ResourceHandlerRequest, callback_context: CallbackContext, session: SessionProxy):
+    progress: ProgressEvent = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        callbackDelaySeconds=15
+    )
+    if filesystem_grown(obj, progress, callback_context, session):
+        progress = update_finished(progress, plan_update(request.previousResourceState, request.desiredResourceState), callback_context, session)
     return progress
 
 @resource.handler(Action.CREATE)
@@ -431,14 +979,13 @@ def create_handler(
         status=OperationStatus.IN_PROGRESS,
         resourceModel=model,
     )
+    reset_policy_cache()
+    reset_retry_budget()
+    callback_context = CallbackContext.load(callback_context)
     try:
         if isinstance(session, SessionProxy):
-            if callback_context:
-                provisioning_state = ProvisioningStatus._deserialize(callback_context.get("LOCAL_STATUS"))
-            else:
-                provisioning_state = None
             try:
-                progress = create(provisioning_state, request, callback_context, session)
+                progress = drive(create, callback_context.stage, request, callback_context, session, CREATE_TIME_BUDGET_SECONDS)
             except Exception as e:
                 raise(e)
             LOG.info(f"returning from dispatch: {progress}")
@@ -454,16 +1001,20 @@ def update_handler(
     callback_context: MutableMapping[str, Any],
 ) -> ProgressEvent:
     model = request.desiredResourceState
-    # progress: ProgressEvent = ProgressEvent(
-    #     status=OperationStatus.IN_PROGRESS,
-    #     resourceModel=model,
-    # )
-    progress: ProgressEvent = ProgressEvent(
-        status=OperationStatus.SUCCESS,
-        resourceModel=model,
-    )
-    # TODO: put code here
-    return read_handler(session, request, callback_context)
+    previous = request.previousResourceState
+    # Arn and EnvironmentId are read-only, so carry them over from the previous model
+    if model.Arn is None and previous is not None:
+        model.Arn = previous.Arn
+        model.EnvironmentId = previous.EnvironmentId
+    if model.Arn is None:
+        raise exceptions.NotFound(TYPE_NAME, None)
+    reset_policy_cache()
+    reset_retry_budget()
+    invalidate_snapshot(model.Arn)
+    callback_context = CallbackContext.load(callback_context)
+    progress = drive(update, callback_context.stage, request, callback_context, session, CREATE_TIME_BUDGET_SECONDS)
+    LOG.info(f"returning from dispatch: {progress}")
+    return progress
 
 
 @resource.handler(Action.DELETE)
@@ -473,36 +1024,12 @@ def delete_handler(
     callback_context: MutableMapping[str, Any],
 ) -> ProgressEvent:
     model = request.desiredResourceState
-    progress: ProgressEvent = ProgressEvent(
-        status=OperationStatus.IN_PROGRESS,
-        resourceModel=None,
-    )
-    environment_id = model.Arn.split(":")[-1]
-    cloud9_client = session.client("cloud9")
-    try:
-        cloud9_client.delete_environment(environmentId=environment_id)
-    except Exception as _:
-        pass
-    try:
-        iam_client = session.client("iam")
-        role_name = f'{environment_id}-instance-role'
-        instance_profile_name = f'{environment_id}-instance-profile'
-        iam_client.remove_role_from_instance_profile(
-            InstanceProfileName=instance_profile_name,
-            RoleName=role_name
-        )
-        iam_client.delete_instance_profile(InstanceProfileName=instance_profile_name)
-        iam_response = iam_client.list_attached_role_policies(RoleName=role_name)
-        attached_policies = iam_response['AttachedPolicies']
-        for policy in attached_policies:
-            iam_client.detach_role_policy(
-                RoleName=role_name,
-                PolicyArn=policy['PolicyArn']
-            )
-        iam_client.delete_role(RoleName=role_name)
-    except Exception as e:
-        LOG.info(e)
-    progress.status = OperationStatus.SUCCESS
+    reset_policy_cache()
+    reset_retry_budget()
+    invalidate_snapshot(model.Arn)
+    callback_context = CallbackContext.load(callback_context)
+    progress = drive(delete, callback_context.stage, request, callback_context, session, CREATE_TIME_BUDGET_SECONDS)
+    LOG.info(f"returning from dispatch: {progress}")
     return progress
 
 
@@ -513,10 +1040,14 @@ def read_handler(
     callback_context: MutableMapping[str, Any],
 ) -> ProgressEvent:
     model = request.desiredResourceState
-    # TODO: put code here
+    if model is None or model.Arn is None:
+        raise exceptions.NotFound(TYPE_NAME, None)
+    snapshot = read_snapshot(session, model.Arn)
+    if snapshot is None:
+        raise exceptions.NotFound(TYPE_NAME, model.Arn)
     return ProgressEvent(
         status=OperationStatus.SUCCESS,
-        resourceModel=model,
+        resourceModel=replace(model, **snapshot),
     )
 
 
@@ -526,8 +1057,12 @@ def list_handler(
     request: ResourceHandlerRequest,
     callback_context: MutableMapping[str, Any],
 ) -> ProgressEvent:
-    # TODO: put code here
+    page, next_token = list_environments(session, request.nextToken)
     return ProgressEvent(
         status=OperationStatus.SUCCESS,
-        resourceModels=[],
+        resourceModels=[
+            ResourceModel(**{field.name: snapshot.get(field.name) for field in fields(ResourceModel)})
+            for snapshot in page
+        ],
+        nextToken=next_token,
     )
@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from time import monotonic, time
+from typing import Any, Callable, Dict, List, MutableMapping, Optional
+
+from .throttling import THROTTLING_CODES
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "Richard/Cloud9/CustomEC2")
+EMIT_METRICS = os.environ.get("EMIT_METRICS", "true").lower() == "true"
+
+# Callback context key holding {stage: [first started (epoch s), last finished
+# (epoch s), invocations, handler busy ms]} for every stage the resource went through.
+TIMELINE_KEY = "TIMELINE"
+
+# Each record is a CloudWatch Embedded Metric Format document, logged bare to
+# stdout; Lambda ships it to CloudWatch Logs, which extracts the metrics.
+METRICS_LOGGER = f"{__name__}.metrics"
+METRICS = logging.getLogger(METRICS_LOGGER)
+METRICS.setLevel(logging.INFO)
+METRICS.propagate = False
+if not METRICS.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    METRICS.addHandler(_handler)
+
+
+class StageRecorder:
+    # The API calls made while one stage runs, from whichever thread makes them
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.calls: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def record(self, call: Dict[str, Any]) -> None:
+        with self._lock:
+            self.calls.append(call)
+
+
+# Recorder of the stage running in this context; run_in_context carries it over
+# to worker threads
+_RECORDER: ContextVar[Optional[StageRecorder]] = ContextVar("stage_recorder", default=None)
+
+
+def run_in_context(pool, fn: Callable[..., Any], *args: Any):
+    # pool.submit(fn, *args), with the stage recorder (and every other context
+    # variable) of the caller
+    return pool.submit(copy_context().run, fn, *args)
+
+
+def _emit(dimensions: List[str], metrics: Dict[str, Any], units: Dict[str, str], properties: Dict[str, Any]) -> None:
+    if not EMIT_METRICS:
+        return
+    document = {
+        "_aws": {
+            "Timestamp": int(time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [dimensions],
+                "Metrics": [{"Name": name, "Unit": units[name]} for name in metrics],
+            }],
+        },
+    }
+    document.update(properties)
+    document.update(metrics)
+    METRICS.info(json.dumps(document, separators=(",", ":")))
+
+
+def record_api_call(service: str, operation: str, latency_ms: float, retries: int = 0, throttled: bool = False) -> None:
+    recorder = _RECORDER.get()
+    if recorder is None:
+        # outside any stage
+        return
+    recorder.record({
+        "Operation": f"{service}.{operation}",
+        "Latency": latency_ms,
+        "Retries": retries,
+        "Throttled": throttled,
+    })
+
+
+def _before_call(context, **_) -> None:
+    context["instrumentation_start"] = monotonic()
+
+
+def _after_call(model, context, parsed, **_) -> None:
+    started = context.get("instrumentation_start")
+    if started is None:
+        return
+    metadata = parsed.get("ResponseMetadata", {}) if isinstance(parsed, dict) else {}
+    code = parsed.get("Error", {}).get("Code") if isinstance(parsed, dict) else None
+    record_api_call(
+        model.service_model.service_name,
+        model.name,
+        (monotonic() - started) * 1000,
+        retries=metadata.get("RetryAttempts", 0),
+        throttled=code in THROTTLING_CODES,
+    )
+
+
+def instrument_client(client) -> None:
+    # Time every call made through a botocore client
+    events = getattr(getattr(client, "meta", None), "events", None)
+    if events is None:
+        return
+    events.register("before-call.*.*", _before_call)
+    events.register("after-call.*.*", _after_call)
+
+
+@contextmanager
+def timed_stage(callback_context: MutableMapping[str, Any], stage: str):
+    # Time one run of `stage`, add it to the resource's timeline and emit the stage
+    # and per-operation API metrics.
+    recorder = StageRecorder(stage)
+    token = _RECORDER.set(recorder)
+    started_at = time()
+    started = monotonic()
+    try:
+        yield
+    finally:
+        busy_ms = (monotonic() - started) * 1000
+        timeline = callback_context.setdefault(TIMELINE_KEY, {})
+        entry = timeline.setdefault(stage, [started_at, started_at, 0, 0])
+        entry[1] = time()
+        entry[2] += 1
+        entry[3] += int(busy_ms)
+        _RECORDER.reset(token)
+        calls = recorder.calls
+        poll = callback_context.get("POLL") or {}
+        _emit(
+            ["Stage"],
+            {"StageDuration": busy_ms, "ApiCalls": len(calls)},
+            {"StageDuration": "Milliseconds", "ApiCalls": "Count"},
+            {"Stage": stage, "Attempt": poll.get("Attempt", 0) if poll.get("Stage") == stage else 0},
+        )
+        by_operation: Dict[str, List[Dict[str, Any]]] = {}
+        for call in calls:
+            by_operation.setdefault(call["Operation"], []).append(call)
+        for operation, operation_calls in by_operation.items():
+            _emit(
+                ["Stage", "Operation"],
+                {
+                    "ApiLatency": sum(call["Latency"] for call in operation_calls),
+                    "ApiCalls": len(operation_calls),
+                    "Throttles": sum(1 for call in operation_calls if call["Throttled"]),
+                    "Retries": sum(call["Retries"] for call in operation_calls),
+                },
+                {"ApiLatency": "Milliseconds", "ApiCalls": "Count", "Throttles": "Count", "Retries": "Count"},
+                {"Stage": stage, "Operation": operation},
+            )
+
+
+def summary(callback_context: MutableMapping[str, Any]) -> str:
+    # "Stage 12.3s/4" per stage, in the order they ran: wall time from first start
+    # to last finish, and how many times the stage was run.
+    timeline = callback_context.get(TIMELINE_KEY) or {}
+    stages = sorted(timeline.items(), key=lambda item: item[1][0])
+    return ", ".join(f"{stage} {entry[1] - entry[0]:.1f}s/{entry[2]}" for stage, entry in stages)
+
+
+def start_span(callback_context: MutableMapping[str, Any], name: str, started: float) -> None:
+    # A timeline entry for work AWS does in the background across several stages
+    # (e.g. an EBS volume modification), closed by finish_span.
+    timeline = callback_context.setdefault(TIMELINE_KEY, {})
+    timeline.setdefault(name, [started, started, 0, 0])
+
+
+def finish_span(callback_context: MutableMapping[str, Any], name: str) -> float:
+    timeline = callback_context.setdefault(TIMELINE_KEY, {})
+    entry = timeline.setdefault(name, [time(), time(), 0, 0])
+    entry[1] = time()
+    entry[2] = 1
+    seconds = entry[1] - entry[0]
+    _emit(["Span"], {"SpanDuration": seconds * 1000}, {"SpanDuration": "Milliseconds"}, {"Span": name})
+    return seconds
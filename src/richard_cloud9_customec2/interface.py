@@ -1,9 +1,11 @@
 import logging
 from dataclasses import dataclass
 import typing
+from enum import IntEnum
 from typing import (
     Any,
     Callable,
+    ClassVar,
     Dict,
     List,
     Mapping,
@@ -15,25 +17,61 @@ from typing import (
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
 
+class Stage(IntEnum):
+    # Stable codes for the provisioning stages as stored in the callback context.
+    # Never renumber or reuse a value; in-flight resources carry them across
+    # handler upgrades.
+    ENVIRONMENT_CREATED = 1
+    ROLE_CREATED = 2
+    NEW_PROFILE_CREATED = 3
+    DEFAULT_PROFILE_DETACHED = 4
+    PROFILE_ATTACHED = 5
+    COMMAND_SENT = 6
+    INSTANCE_STABLE = 7
+    RESIZED_INSTANCE = 8
+    ENVIRONMENT_DELETING = 9
+    ENVIRONMENT_DELETED = 10
+    INSTANCE_STOPPING = 11
+    INSTANCE_STARTING = 12
+    VOLUME_MODIFYING = 13
+    FILESYSTEM_GROWING = 14
+    PROFILE_ASSOCIATING = 15
+
 @dataclass
 class ProvisioningStatus(dict):
+    STAGE: ClassVar[Stage]
     def __init__(self):
         dict.__init__(self, Type=type(self).__name__)
     def __str__(self):
-        return self.__class__
+        return type(self).__name__
     def _serialize(self) -> Mapping[str, Any]:
-        return {"Type": self.__class__}
+        return {"Type": type(self).__name__}
     @classmethod
     def _deserialize(
         cls: Type["ProvisioningStatus"], json_data: Optional[Mapping[str, Any]]
     ) -> Optional["ProvisioningStatus"]:
-        return globals()[json_data["Type"]]()
+        if not json_data:
+            return None
+        return STATUS_BY_NAME[json_data["Type"]]()
+    @classmethod
+    def from_stage(cls, stage: Union[int, Stage]) -> "ProvisioningStatus":
+        return STATUS_BY_STAGE[Stage(stage)]()
+
+class EnvironmentCreated(ProvisioningStatus): STAGE = Stage.ENVIRONMENT_CREATED
+class RoleCreated(ProvisioningStatus): STAGE = Stage.ROLE_CREATED
+class NewProfileCreated(ProvisioningStatus): STAGE = Stage.NEW_PROFILE_CREATED
+class DefaultProfileDetached(ProvisioningStatus): STAGE = Stage.DEFAULT_PROFILE_DETACHED
+class ProfileAttached(ProvisioningStatus): STAGE = Stage.PROFILE_ATTACHED
+class CommandSent(ProvisioningStatus): STAGE = Stage.COMMAND_SENT
+class InstanceStable(ProvisioningStatus): STAGE = Stage.INSTANCE_STABLE
+class ResizedInstance(ProvisioningStatus): STAGE = Stage.RESIZED_INSTANCE
+class EnvironmentDeleting(ProvisioningStatus): STAGE = Stage.ENVIRONMENT_DELETING
+class EnvironmentDeleted(ProvisioningStatus): STAGE = Stage.ENVIRONMENT_DELETED
+class InstanceStopping(ProvisioningStatus): STAGE = Stage.INSTANCE_STOPPING
+class InstanceStarting(ProvisioningStatus): STAGE = Stage.INSTANCE_STARTING
+class VolumeModifying(ProvisioningStatus): STAGE = Stage.VOLUME_MODIFYING
+class FilesystemGrowing(ProvisioningStatus): STAGE = Stage.FILESYSTEM_GROWING
+class ProfileAssociating(ProvisioningStatus): STAGE = Stage.PROFILE_ASSOCIATING
 
-class EnvironmentCreated(ProvisioningStatus): pass
-class RoleCreated(ProvisioningStatus): pass
-class NewProfileCreated(ProvisioningStatus): pass
-class DefaultProfileDetached(ProvisioningStatus): pass
-class ProfileAttached(ProvisioningStatus): pass
-class CommandSent(ProvisioningStatus): pass
-class InstanceStable(ProvisioningStatus): pass
-class ResizedInstance(ProvisioningStatus): pass
\ No newline at end of file
+STATUS_BY_NAME: Dict[str, Type[ProvisioningStatus]] = {status.__name__: status for status in ProvisioningStatus.__subclasses__()}
+STATUS_BY_STAGE: Dict[Stage, Type[ProvisioningStatus]] = {status.STAGE: status for status in ProvisioningStatus.__subclasses__()}
@@ -0,0 +1,37 @@
+import json
+import logging
+import os
+from typing import Any, Dict, Mapping
+
+import boto3
+from cloudformation_cli_python_lib import SessionProxy
+
+from .changes import MANAGED_TAG_KEY, tag_list
+from .handlers import MANAGED_POLICIES
+from .models import ResourceModel
+from .pool import pool_profile, replenish_pool
+from .profiles import replenish_profiles
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Warm pools to keep filled, as a JSON list of {"Template": <resource properties>,
+# "Size": <unclaimed environments>, "Owner": <owner ARN of the pool environments>}
+WARM_POOLS = json.loads(os.environ.get("WARM_POOLS", "[]"))
+
+
+def refill(session: SessionProxy) -> Dict[str, int]:
+    # Top the pools back up; returns how many of each were created
+    created = {"profiles": replenish_profiles(session, MANAGED_POLICIES, tag_list({MANAGED_TAG_KEY: "True"}))}
+    for warm_pool in WARM_POOLS:
+        template = ResourceModel._deserialize(warm_pool["Template"])
+        events = replenish_pool(session, template, warm_pool["Size"], warm_pool["Owner"])
+        created[f"environments:{pool_profile(template)}"] = len(events)
+    LOG.info(f"refilled pools: {created}")
+    return created
+
+
+def handler(event: Mapping[str, Any], context: Any) -> Dict[str, int]:
+    # Entry point for the scheduled MaintenanceFunction (see template.yml). Runs
+    # apart from the resource handlers so that no create waits on a refill.
+    return refill(SessionProxy(boto3.session.Session()))
@@ -44,6 +44,7 @@ class ResourceModel(BaseModel):
     Description: Optional[str]
     InstanceType: Optional[str]
     SubnetId: Optional[str]
+    SubnetIds: Optional[Sequence[str]]
     OperatingSystem: Optional[str]
     IdleTimeout: Optional[str]
     Owner: Optional[str]
@@ -51,7 +52,10 @@ class ResourceModel(BaseModel):
     PermissionsPolicy: Optional[str]
     EnvironmentId: Optional[str]
     BootstrapDocumentName: Optional[str]
+    BootstrapDocuments: Optional[Sequence["_BootstrapDocument"]]
     VolumeSize: Optional[int]
+    ReadinessProbe: Optional[str]
+    WarmPool: Optional[bool]
     Includes: Optional[Sequence[str]]
     Tags: Optional[Sequence["_Tag"]]
 
@@ -69,6 +73,7 @@ class ResourceModel(BaseModel):
             Description=json_data.get("Description"),
             InstanceType=json_data.get("InstanceType"),
             SubnetId=json_data.get("SubnetId"),
+            SubnetIds=json_data.get("SubnetIds"),
             OperatingSystem=json_data.get("OperatingSystem"),
             IdleTimeout=json_data.get("IdleTimeout"),
             Owner=json_data.get("Owner"),
@@ -76,7 +81,10 @@ class ResourceModel(BaseModel):
             PermissionsPolicy=json_data.get("PermissionsPolicy"),
             EnvironmentId=json_data.get("EnvironmentId"),
             BootstrapDocumentName=json_data.get("BootstrapDocumentName"),
+            BootstrapDocuments=deserialize_list(json_data.get("BootstrapDocuments"), BootstrapDocument),
             VolumeSize=json_data.get("VolumeSize"),
+            ReadinessProbe=json_data.get("ReadinessProbe"),
+            WarmPool=json_data.get("WarmPool"),
             Includes=json_data.get("Includes"),
             Tags=deserialize_list(json_data.get("Tags"), Tag),
         )
@@ -86,6 +94,32 @@ class ResourceModel(BaseModel):
 _ResourceModel = ResourceModel
 
 
+@dataclass
+class BootstrapDocument(BaseModel):
+    Name: Optional[str]
+    Parameters: Optional[MutableMapping[str, Sequence[str]]]
+    DependsOn: Optional[Sequence[str]]
+    TimeoutSeconds: Optional[int]
+
+    @classmethod
+    def _deserialize(
+        cls: Type["_BootstrapDocument"],
+        json_data: Optional[Mapping[str, Any]],
+    ) -> Optional["_BootstrapDocument"]:
+        if not json_data:
+            return None
+        return cls(
+            Name=json_data.get("Name"),
+            Parameters=json_data.get("Parameters"),
+            DependsOn=json_data.get("DependsOn"),
+            TimeoutSeconds=json_data.get("TimeoutSeconds"),
+        )
+
+
+# work around possible type aliasing issues when variable has same name as a model
+_BootstrapDocument = BootstrapDocument
+
+
 @dataclass
 class Tag(BaseModel):
     Key: Optional[str]
@@ -0,0 +1,112 @@
+import logging
+import threading
+from time import monotonic
+from typing import Collection, List, Mapping, MutableMapping, Optional, Sequence, Tuple
+
+from cloudformation_cli_python_lib import SessionProxy
+
+from .clients import get_client
+from .preflight import offered_zones
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Free address counts move with every launch, so subnets are described again
+# after this long; placements made since are subtracted in the meantime.
+SUBNET_TTL_SECONDS = 60
+# Placements younger than this count towards the spread across zones and subnets
+PLACEMENT_WINDOW_SECONDS = 900
+# Failure reasons (Cloud9 lifecycle or EC2 error codes) that another subnet may
+# not hit. EC2 reports an instance type its zone doesn't offer only as the generic
+# Unsupported code, so that case is matched on its message instead.
+CAPACITY_ERRORS = (
+    "InsufficientInstanceCapacity",
+    "InsufficientFreeAddressesInSubnet",
+    "InsufficientCapacity",
+    "is not supported in your requested Availability Zone",
+)
+
+# (region, subnet id) -> (availability zone, free addresses, monotonic fetch time)
+_SUBNETS: MutableMapping[Tuple[Optional[str], str], Tuple[str, int, float]] = {}
+# (monotonic time, subnet id, availability zone) of environments placed by this process
+_PLACEMENTS: List[Tuple[float, str, str]] = []
+_LOCK = threading.Lock()
+
+
+def is_capacity_error(reason: str) -> bool:
+    return any(code in reason for code in CAPACITY_ERRORS)
+
+
+def _subnets(session: SessionProxy, region: Optional[str], subnet_ids: Sequence[str]) -> Mapping[str, Tuple[str, int, float]]:
+    # Zone and free addresses of every subnet in `subnet_ids`, describing the
+    # stale ones in one call
+    now = monotonic()
+    with _LOCK:
+        known = {
+            subnet_id: _SUBNETS[(region, subnet_id)] for subnet_id in subnet_ids
+            if (region, subnet_id) in _SUBNETS and _SUBNETS[(region, subnet_id)][2] + SUBNET_TTL_SECONDS > now
+        }
+    stale = [subnet_id for subnet_id in subnet_ids if subnet_id not in known]
+    if stale:
+        response = get_client(session, "ec2").describe_subnets(SubnetIds=stale)
+        with _LOCK:
+            for subnet in response['Subnets']:
+                entry = (subnet['AvailabilityZone'], subnet['AvailableIpAddressCount'], now)
+                _SUBNETS[(region, subnet['SubnetId'])] = entry
+                known[subnet['SubnetId']] = entry
+    return known
+
+
+def rank_subnets(
+    session: SessionProxy,
+    region: Optional[str],
+    instance_type: Optional[str],
+    candidates: Sequence[str],
+    exclude: Collection[str] = (),
+) -> List[str]:
+    # Candidates that can take another `instance_type` instance, best first:
+    # zones that haven't failed this resource before zones that have, then the
+    # zone and subnet with the fewest recent placements, then the most free
+    # addresses, then the order they were given in.
+    offered = set(offered_zones(session, region, instance_type)) if instance_type else None
+    subnets = _subnets(session, region, list(candidates))
+    now = monotonic()
+    with _LOCK:
+        _PLACEMENTS[:] = [placement for placement in _PLACEMENTS if placement[0] > now - PLACEMENT_WINDOW_SECONDS]
+        recent = list(_PLACEMENTS)
+    failed_zones = {subnets[subnet_id][0] for subnet_id in exclude if subnet_id in subnets}
+    ranked = []
+    for index, subnet_id in enumerate(candidates):
+        if subnet_id in exclude or subnet_id not in subnets:
+            continue
+        zone, free, fetched = subnets[subnet_id]
+        free -= sum(1 for placed, placed_subnet, _ in recent if placed_subnet == subnet_id and placed >= fetched)
+        if free <= 0 or (offered is not None and zone not in offered):
+            continue
+        in_zone = sum(1 for _, _, placed_zone in recent if placed_zone == zone)
+        in_subnet = sum(1 for _, placed_subnet, _ in recent if placed_subnet == subnet_id)
+        ranked.append(((zone in failed_zones, in_zone, in_subnet, -free, index), subnet_id))
+    return [subnet_id for _, subnet_id in sorted(ranked)]
+
+
+def record_placement(region: Optional[str], subnet_id: str) -> None:
+    with _LOCK:
+        entry = _SUBNETS.get((region, subnet_id))
+        _PLACEMENTS.append((monotonic(), subnet_id, entry[0] if entry else ""))
+
+
+def choose_subnet(
+    session: SessionProxy,
+    region: Optional[str],
+    instance_type: Optional[str],
+    candidates: Sequence[str],
+    exclude: Collection[str] = (),
+) -> Optional[str]:
+    # The best candidate for one more environment, recorded as placed there; None
+    # when no candidate outside `exclude` has room.
+    ranked = rank_subnets(session, region, instance_type, candidates, exclude)
+    if not ranked:
+        return None
+    record_placement(region, ranked[0])
+    LOG.info(f"placing {instance_type} in {ranked[0]} (ranked {ranked})")
+    return ranked[0]
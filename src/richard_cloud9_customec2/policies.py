@@ -0,0 +1,84 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AbstractSet, Iterable, MutableMapping, Optional, Set
+
+from .instrumentation import run_in_context
+from .throttling import error_code
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+MAX_WORKERS = 4
+
+# role name -> attached policy arns, as known for the rest of this invocation.
+# Cleared by reset_policy_cache() at the start of every handler invocation.
+_ATTACHED: MutableMapping[str, Set[str]] = {}
+_LOCK = threading.Lock()
+
+
+def reset_policy_cache() -> None:
+    with _LOCK:
+        _ATTACHED.clear()
+
+
+def attached_policies(iam_client, role_name: str) -> AbstractSet[str]:
+    with _LOCK:
+        if role_name in _ATTACHED:
+            return frozenset(_ATTACHED[role_name])
+    attached = set()
+    parameters = {'RoleName': role_name}
+    while True:
+        iam_response = iam_client.list_attached_role_policies(**parameters)
+        attached.update(policy['PolicyArn'] for policy in iam_response['AttachedPolicies'])
+        if not iam_response.get('IsTruncated'):
+            break
+        parameters['Marker'] = iam_response['Marker']
+    with _LOCK:
+        _ATTACHED[role_name] = attached
+    return frozenset(attached)
+
+
+def detach_policy(iam_client, role_name: str, policy: str) -> None:
+    LOG.info(f"Detaching policy: {policy}")
+    try:
+        iam_client.detach_role_policy(RoleName=role_name, PolicyArn=policy)
+    except Exception as e:
+        if error_code(e) != "NoSuchEntity":
+            raise
+    with _LOCK:
+        _ATTACHED.setdefault(role_name, set()).discard(policy)
+
+
+def reconcile_policies(iam_client, role_name: str, desired: Iterable[str], exclusive: bool = False) -> None:
+    # Attach every policy in `desired` that isn't attached to `role_name` yet and,
+    # when `exclusive`, detach every attached policy that isn't desired. The calls
+    # for each policy run concurrently.
+    desired = list(dict.fromkeys(desired))
+    attached = attached_policies(iam_client, role_name)
+    to_attach = [policy for policy in desired if policy not in attached]
+    to_detach = [policy for policy in attached if policy not in desired] if exclusive else []
+    if not to_attach and not to_detach:
+        LOG.info(f"managed policies on {role_name} already up to date")
+        return
+
+    def attach(policy: str) -> None:
+        LOG.info(f"Attaching policy: {policy}")
+        iam_client.attach_role_policy(RoleName=role_name, PolicyArn=policy)
+        with _LOCK:
+            _ATTACHED.setdefault(role_name, set()).add(policy)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = [run_in_context(pool, attach, policy) for policy in to_attach]
+        futures += [run_in_context(pool, detach_policy, iam_client, role_name, policy) for policy in to_detach]
+    for future in futures:
+        future.result()
+
+
+def swap_policy(iam_client, role_name: str, attach: Optional[str], detach: Optional[str]) -> None:
+    # Attach the new policy before detaching the old one, so the role is never
+    # left without either.
+    if attach is not None:
+        reconcile_policies(iam_client, role_name, [attach])
+    if detach is not None and detach != attach:
+        detach_policy(iam_client, role_name, detach)
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+from dataclasses import replace
+from typing import Any, List, Mapping, MutableMapping, Optional
+from uuid import uuid4
+
+from cloudformation_cli_python_lib import (
+    OperationStatus,
+    ProgressEvent,
+    SessionProxy,
+)
+
+from . import claims
+from .changes import CLAIMED, OWNER_TAG, POOL_PROFILE_TAG, POOL_TAG, PROFILE_TAG, UNCLAIMED, tag_list
+from .clients import get_client
+from .context import CallbackContext
+from .executor import DONE, run_tasks
+from .models import ResourceHandlerRequest, ResourceModel, Tag
+from .policies import reconcile_policies
+from .profiles import profile_names
+from .tagging import instance_resources, resource_tags, tag_tasks
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+POOL_INSTANCE_STATES = ['running', 'stopped']
+# How long replenish_pool may hold a template's lock: provisioning a batch of
+# environments through bootstrap takes a while
+REPLENISH_LOCK_SECONDS = 3600
+# Only environments built from the same values for these properties are
+# interchangeable; everything else is applied when the environment is claimed.
+PROFILE_PROPERTIES = ('InstanceType', 'OperatingSystem', 'VolumeSize', 'SubnetId', 'SubnetIds', 'BootstrapDocumentName', 'BootstrapDocuments')
+# Callback context task marking that the resource holds a pool environment
+CLAIM_TASK = "ClaimEnvironment"
+
+
+def pool_profile(model: ResourceModel) -> str:
+    values = {name: getattr(model, name) for name in PROFILE_PROPERTIES}
+    if values['SubnetIds'] is None:
+        # pools replenished before SubnetIds existed keep matching
+        del values['SubnetIds']
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=lambda value: value._serialize()).encode()).hexdigest()[:16]
+
+
+def _unclaimed_instances(session: SessionProxy, profile: str) -> List[MutableMapping[str, Any]]:
+    ec2_client = get_client(session, "ec2")
+    response = ec2_client.describe_instances(
+        Filters=[
+            {'Name': f'tag:{POOL_TAG}', 'Values': [UNCLAIMED]},
+            {'Name': f'tag:{POOL_PROFILE_TAG}', 'Values': [profile]},
+            {'Name': 'instance-state-name', 'Values': POOL_INSTANCE_STATES},
+        ]
+    )
+    return [instance for reservation in response['Reservations'] for instance in reservation['Instances']]
+
+
+def _tag_value(instance, key: str) -> Optional[str]:
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+def holds_pool_environment(callback_context: CallbackContext) -> bool:
+    # True once this resource has claimed a pool environment (see claim_environment)
+    return (callback_context.tasks or {}).get(CLAIM_TASK) == DONE
+
+
+def _claim(session: SessionProxy, request: ResourceHandlerRequest, callback_context: CallbackContext) -> Optional[Mapping[str, Any]]:
+    # Claim an unclaimed pool environment matching the desired model and make it
+    # this resource's; returns the environment, or None when the pool has nothing
+    # suitable. The claim is the SSM parameter only one claimer can create (see
+    # claims).
+    model = request.desiredResourceState
+    cloud9_client = get_client(session, "cloud9")
+    for instance in _unclaimed_instances(session, pool_profile(model)):
+        environment_id = _tag_value(instance, 'aws:cloud9:environment')
+        if environment_id is None:
+            continue
+        try:
+            environment = cloud9_client.describe_environments(environmentIds=[environment_id])['environments'][0]
+        except (cloud9_client.exceptions.NotFoundException, IndexError):
+            continue
+        if not claims.claim(session, claims.ENVIRONMENT, environment_id, request.clientRequestToken):
+            continue
+        LOG.info(f"claimed pool environment {environment_id}")
+        # Recorded before anything else is done to it: a re-invocation finishes
+        # setting up this environment, and a rollback deletes it.
+        callback_context.environment_id = environment_id
+        callback_context.instance_id = instance['InstanceId']
+        callback_context.volume_id = instance['BlockDeviceMappings'][0]['Ebs']['VolumeId']
+        callback_context.resource_ids = instance_resources(instance)
+        # pool environments created before profiles were pooled have no PROFILE_TAG
+        callback_context.instance_profile_name = _tag_value(instance, PROFILE_TAG)
+        callback_context.tasks[CLAIM_TASK] = DONE
+        model.Arn = environment['arn']
+        model.EnvironmentId = environment_id
+        return environment
+    return None
+
+
+def _add_owner(session: SessionProxy, environment_id: str, owner: str, environment: Optional[Mapping[str, Any]]) -> None:
+    cloud9_client = get_client(session, "cloud9")
+    if environment is None:
+        environment = cloud9_client.describe_environments(environmentIds=[environment_id])['environments'][0]
+    if owner != environment['ownerArn']:
+        try:
+            cloud9_client.create_environment_membership(environmentId=environment_id, userArn=owner, permissions='read-write')
+        except cloud9_client.exceptions.ConflictException:
+            # added by an earlier attempt
+            pass
+
+
+def setup_tasks(session: SessionProxy, request: ResourceHandlerRequest, callback_context: CallbackContext, environment: Optional[Mapping[str, Any]] = None):
+    # What turns a claimed pool environment into the desired model's, as tasks for
+    # run_tasks so a re-invocation only repeats the ones that didn't finish.
+    model = request.desiredResourceState
+    environment_id = callback_context.environment_id
+    tags = resource_tags(model)
+    tasks = {
+        # the claim tag just keeps the instance out of later pool scans
+        "MarkClaimed": (lambda: get_client(session, "ec2").create_tags(
+            Resources=[callback_context.instance_id], Tags=[{'Key': POOL_TAG, 'Value': f'{CLAIMED}:{request.clientRequestToken}'}]
+        ), []),
+        "TagEnvironment": (lambda: get_client(session, "cloud9").tag_resource(
+            ResourceARN=model.Arn, Tags=tag_list(dict(tags, **{POOL_TAG: CLAIMED}))
+        ), []),
+    }
+    parameters = {}
+    if model.Name is not None:
+        parameters['name'] = model.Name
+    if model.Description is not None:
+        parameters['description'] = model.Description
+    if parameters:
+        tasks["UpdateEnvironment"] = (lambda: get_client(session, "cloud9").update_environment(environmentId=environment_id, **parameters), [])
+    if model.Owner is not None:
+        tasks["EnvironmentMembership"] = (lambda: _add_owner(session, environment_id, model.Owner, environment), [])
+    # the instance keeps its claim tag, and records the owner READ reports
+    ec2_tags = dict(tags, **{OWNER_TAG: model.Owner}) if model.Owner is not None else tags
+    tasks.update(tag_tasks(session, callback_context, ec2_tags, iam_tags=tags))
+    if model.PermissionsPolicy is not None:
+        tasks["PoolPolicy"] = (lambda: reconcile_policies(get_client(session, "iam"), profile_names(callback_context)[1], [model.PermissionsPolicy]), [])
+    return tasks
+
+
+def claim_environment(session: SessionProxy, request: ResourceHandlerRequest, callback_context: CallbackContext) -> Optional[ProgressEvent]:
+    # Hand over an unclaimed pool environment matching the desired model, or
+    # return None when the pool has nothing suitable. A resource that already
+    # holds one finishes setting that one up. An error is raised with the claim
+    # still held (see handlers.discard_pool_environment).
+    environment = None
+    if not holds_pool_environment(callback_context):
+        environment = _claim(session, request, callback_context)
+        if environment is None:
+            return None
+    run_tasks(setup_tasks(session, request, callback_context, environment), callback_context)
+    return ProgressEvent(
+        status=OperationStatus.SUCCESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+        message=f"claimed warm pool environment {callback_context.environment_id}",
+    )
+
+
+def _available(session: SessionProxy, profile: str) -> int:
+    # Unclaimed pool environments for `profile`, leaving out any whose claim
+    # has been made but not tagged yet
+    held = claims.claimed(session, claims.ENVIRONMENT)
+    return sum(1 for instance in _unclaimed_instances(session, profile) if _tag_value(instance, 'aws:cloud9:environment') not in held)
+
+
+def replenish_pool(session: SessionProxy, template: ResourceModel, size: int, owner: str, **fleet_options) -> List[ProgressEvent]:
+    # Top the pool for `template` up to `size` unclaimed, fully bootstrapped
+    # environments owned by `owner`. Only one caller at a time refills a given
+    # template's pool; the others return without creating anything.
+    from .fleet import provision_fleet
+
+    profile = pool_profile(template)
+    if _available(session, profile) >= size:
+        return []
+    lock, holder = f'environment-pool-{profile}', uuid4().hex
+    if not claims.acquire_lock(session, lock, holder, REPLENISH_LOCK_SECONDS):
+        LOG.info(f"warm pool {profile} is being refilled elsewhere")
+        return []
+    try:
+        missing = size - _available(session, profile)
+        if missing <= 0:
+            return []
+        tags = [tag for tag in template.Tags or [] if tag.Key not in (POOL_TAG, POOL_PROFILE_TAG)]
+        tags += [Tag(Key=POOL_TAG, Value=UNCLAIMED), Tag(Key=POOL_PROFILE_TAG, Value=profile)]
+        pool_template = replace(template, Tags=tags, PermissionsPolicy=None, WarmPool=False)
+        members = [(f'pool-{profile}-{uuid4().hex[:8]}', owner) for _ in range(missing)]
+        return provision_fleet(session, pool_template, members, **fleet_options)
+    finally:
+        claims.release_lock(session, lock, holder)
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import monotonic
+from typing import Any, Callable, List, Mapping, MutableMapping, Optional, Tuple
+
+from cloudformation_cli_python_lib import SessionProxy, exceptions
+
+from .clients import get_client
+from .documents import bootstrap_steps
+from .instrumentation import run_in_context
+from .models import ResourceModel
+from .throttling import error_code
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# OperatingSystem -> Cloud9 image alias for create_environment_ec2
+IMAGE_IDS = {
+    'AMAZON_LINUX': 'amazonlinux-1-x86_64',
+    'AMAZON_LINUX_2': 'amazonlinux-2-x86_64',
+    'UBUNTU_18_04': 'ubuntu-18.04-x86_64',
+}
+# Public parameter behind each image alias; it only exists in regions that have the image
+IMAGE_PARAMETER = "/aws/service/cloud9/amis/{}"
+
+# The resource schema. Found next to the package when it is bundled with it, or
+# at the root of a checkout; RESOURCE_SCHEMA_PATH overrides both.
+SCHEMA_FILE = "richard-cloud9-customec2.json"
+SCHEMA_PATHS = [
+    os.environ.get("RESOURCE_SCHEMA_PATH", ""),
+    str(Path(__file__).resolve().parent / SCHEMA_FILE),
+    str(Path(__file__).resolve().parents[2] / SCHEMA_FILE),
+]
+
+# Instance type offerings, image availability and subnet zones change rarely, so
+# they are kept for the life of the Lambda process up to this long.
+CAPABILITY_TTL_SECONDS = 3600
+MAX_WORKERS = 6
+
+# (lookup, region, value) -> (result, monotonic expiry)
+_CAPABILITIES: MutableMapping[Tuple[str, Optional[str], str], Tuple[Any, float]] = {}
+_LOCK = threading.Lock()
+_SCHEMA: List[Any] = []
+
+
+def _cached(lookup: str, region: Optional[str], value: str, fetch: Callable[[], Any]) -> Any:
+    key = (lookup, region, value)
+    with _LOCK:
+        cached = _CAPABILITIES.get(key)
+        if cached is not None and cached[1] > monotonic():
+            return cached[0]
+    result = fetch()
+    with _LOCK:
+        _CAPABILITIES[key] = (result, monotonic() + CAPABILITY_TTL_SECONDS)
+    return result
+
+
+def _schema() -> Optional[Mapping[str, Any]]:
+    if not _SCHEMA:
+        path = next((path for path in SCHEMA_PATHS if path and os.path.isfile(path)), None)
+        if path is None:
+            LOG.info(f"{SCHEMA_FILE} not found, skipping schema validation")
+            _SCHEMA.append(None)
+        else:
+            with open(path) as schema_file:
+                _SCHEMA.append(json.load(schema_file))
+    return _SCHEMA[0]
+
+
+def schema_problems(model: ResourceModel) -> List[str]:
+    schema = _schema()
+    if schema is None:
+        return []
+    properties = json.loads(json.dumps(model._serialize(), default=lambda value: value._serialize()))
+    schema = {key: value for key, value in schema.items() if key in ('definitions', 'properties', 'required', 'additionalProperties')}
+    try:
+        import jsonschema
+    except ImportError:
+        # Without jsonschema only required properties and enums are checked
+        problems = [f"{name} is required" for name in schema.get('required', []) if name not in properties]
+        for name, definition in schema['properties'].items():
+            if 'enum' in definition and name in properties and properties[name] not in definition['enum']:
+                problems.append(f"{name} must be one of {', '.join(definition['enum'])}, not {properties[name]}")
+        return problems
+    validator = jsonschema.Draft7Validator(schema)
+    return [
+        f"{'/'.join(str(part) for part in error.absolute_path) or 'model'}: {error.message}"
+        for error in sorted(validator.iter_errors(properties), key=lambda error: list(error.absolute_path))
+    ]
+
+
+def _image_problems(session: SessionProxy, region: Optional[str], operating_system: Optional[str]) -> List[str]:
+    image_id = IMAGE_IDS.get(operating_system)
+    if image_id is None:
+        return []
+
+    def fetch() -> bool:
+        ssm_client = get_client(session, "ssm")
+        try:
+            ssm_client.get_parameter(Name=IMAGE_PARAMETER.format(image_id))
+        except ssm_client.exceptions.ParameterNotFound:
+            return False
+        return True
+
+    if not _cached("image", region, image_id, fetch):
+        return [f"OperatingSystem {operating_system} ({image_id}) isn't available in {region}"]
+    return []
+
+
+def _subnet_zone(session: SessionProxy, region: Optional[str], subnet_id: str) -> Optional[str]:
+    def fetch() -> Optional[str]:
+        try:
+            response = get_client(session, "ec2").describe_subnets(SubnetIds=[subnet_id])
+        except Exception as e:
+            if error_code(e) != "InvalidSubnetID.NotFound":
+                raise
+            return None
+        return response['Subnets'][0]['AvailabilityZone']
+
+    return _cached("subnet", region, subnet_id, fetch)
+
+
+def offered_zones(session: SessionProxy, region: Optional[str], instance_type: str) -> List[str]:
+    # Availability zones of the region that offer `instance_type`
+    def fetch() -> List[str]:
+        ec2_client = get_client(session, "ec2")
+        zones = []
+        parameters = {
+            'LocationType': 'availability-zone',
+            'Filters': [{'Name': 'instance-type', 'Values': [instance_type]}],
+        }
+        while True:
+            response = ec2_client.describe_instance_type_offerings(**parameters)
+            zones.extend(offering['Location'] for offering in response['InstanceTypeOfferings'])
+            if not response.get('NextToken'):
+                break
+            parameters['NextToken'] = response['NextToken']
+        return sorted(zones)
+
+    return _cached("offerings", region, instance_type, fetch)
+
+
+def candidate_subnets(model: ResourceModel) -> List[str]:
+    # SubnetId first, then SubnetIds, without repeats; empty for the default VPC
+    subnets = ([model.SubnetId] if model.SubnetId else []) + list(model.SubnetIds or [])
+    return list(dict.fromkeys(subnets))
+
+
+def _instance_type_problems(session: SessionProxy, region: Optional[str], model: ResourceModel) -> List[str]:
+    subnets = candidate_subnets(model)
+    zones = {subnet_id: _subnet_zone(session, region, subnet_id) for subnet_id in subnets}
+    problems = [f"subnet {subnet_id} doesn't exist" for subnet_id, zone in zones.items() if zone is None]
+    if model.InstanceType is None or problems:
+        return problems
+    offered = offered_zones(session, region, model.InstanceType)
+    if len(zones) == 1:
+        [(subnet_id, zone)] = zones.items()
+        if zone not in offered:
+            return [f"InstanceType {model.InstanceType} isn't offered in {zone} (subnet {subnet_id})"]
+    elif zones:
+        if not set(zones.values()) & set(offered):
+            return [f"InstanceType {model.InstanceType} isn't offered in the zone of any subnet ({', '.join(sorted(set(zones.values())))})"]
+    elif not offered:
+        return [f"InstanceType {model.InstanceType} isn't offered in {region}"]
+    return []
+
+
+def _policy_problems(session: SessionProxy, policy_arn: str) -> List[str]:
+    try:
+        get_client(session, "iam").get_policy(PolicyArn=policy_arn)
+    except Exception as e:
+        if error_code(e) not in ("NoSuchEntity", "InvalidInput"):
+            raise
+        return [f"PermissionsPolicy {policy_arn} doesn't exist"]
+    return []
+
+
+def _document_problems(session: SessionProxy, name: str) -> List[str]:
+    ssm_client = get_client(session, "ssm")
+    try:
+        ssm_client.describe_document(Name=name)
+    except ssm_client.exceptions.InvalidDocument:
+        return [f"bootstrap document {name} doesn't exist"]
+    return []
+
+
+def preflight(session: SessionProxy, model: ResourceModel, region: Optional[str]) -> None:
+    # Check everything about `model` that can be checked before anything is
+    # created, and raise InvalidRequest listing every problem found. The AWS
+    # lookups run concurrently; errors other than "doesn't exist" propagate.
+    problems = schema_problems(model)
+    if model.OperatingSystem not in IMAGE_IDS and not any(problem.startswith("OperatingSystem") for problem in problems):
+        # the schema's enum normally reports this already
+        problems.append(f"OperatingSystem {model.OperatingSystem} isn't supported; use one of {', '.join(IMAGE_IDS)}")
+    try:
+        steps = bootstrap_steps(model)
+    except exceptions.InvalidRequest as e:
+        problems.append(str(e))
+        steps = []
+    checks = [
+        lambda: _image_problems(session, region, model.OperatingSystem),
+        lambda: _instance_type_problems(session, region, model),
+    ]
+    if model.PermissionsPolicy is not None:
+        checks.append(lambda: _policy_problems(session, model.PermissionsPolicy))
+    for document in sorted({step.document for step in steps}):
+        checks.append(lambda document=document: _document_problems(session, document))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = [run_in_context(pool, check) for check in checks]
+    for future in futures:
+        problems.extend(future.result())
+    if problems:
+        LOG.info(f"preflight failed: {problems}")
+        raise exceptions.InvalidRequest("; ".join(problems))
@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+from time import time
+from typing import Any, List, Mapping, Optional, Sequence, Tuple
+from uuid import uuid4
+
+from cloudformation_cli_python_lib import SessionProxy
+
+from . import claims
+from .changes import CLAIMED, PROFILE_POOL_TAG, PROFILE_TAG, UNCLAIMED
+from .clients import get_client
+from .policies import reconcile_policies
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Unclaimed profiles kept ready to bind. The maintenance job tops the pool back
+# up (see maintenance.handler), so the profile a create claims has normally
+# propagated long before. 0 creates a profile per environment instead.
+PROFILE_POOL_SIZE = int(os.environ.get("PROFILE_POOL_SIZE", "2"))
+# Name of the lock held while the pool is topped up or trimmed
+POOL_LOCK = "profile-pool"
+# Roles and instance profiles the handlers create live under this path, pooled
+# or not, and share one name per pair.
+PROFILE_PATH = "/awsqs-cloud9/"
+# Seconds to let a new instance profile propagate through IAM before associating it
+PROFILE_PROPAGATION_SECONDS = 30
+# Propagated profiles a claim looks at before giving up; once the pool is empty
+# everything left under PROFILE_PATH is in use.
+CLAIM_SCAN_LIMIT = 8
+
+EC2_TRUST_POLICY = json.dumps({
+    'Version': '2012-10-17',
+    'Statement': {
+        'Effect': 'Allow',
+        'Principal': {'Service': 'ec2.amazonaws.com'},
+        'Action': 'sts:AssumeRole'
+    }
+})
+
+
+def legacy_names(environment_id: str) -> Tuple[str, str]:
+    # (instance profile, role) of environments created by earlier handler versions
+    return f'{environment_id}-instance-profile', f'{environment_id}-instance-role'
+
+
+def profile_names(callback_context) -> Tuple[str, str]:
+    # (instance profile, role) bound to the environment in `callback_context`
+    if callback_context.instance_profile_name is not None:
+        return callback_context.instance_profile_name, callback_context.instance_profile_name
+    return legacy_names(callback_context.environment_id)
+
+
+def _tags(tags: Sequence[Mapping[str, str]], state: str) -> List[Mapping[str, str]]:
+    return [tag for tag in tags if tag["Key"] != PROFILE_POOL_TAG] + [{"Key": PROFILE_POOL_TAG, "Value": state}]
+
+
+def claimed_tag(token: str) -> Mapping[str, str]:
+    return {PROFILE_POOL_TAG: f'{CLAIMED}:{token}'}
+
+
+def new_profile_name() -> str:
+    return f"awsqs-cloud9-{uuid4().hex[:16]}"
+
+
+def create_profile(iam_client, managed_policies: Sequence[str], tags: Sequence[Mapping[str, str]], state: str = UNCLAIMED, name: Optional[str] = None) -> str:
+    # A role with `managed_policies` inside an instance profile of the same name
+    name = name or new_profile_name()
+    tags = _tags(tags, state)
+    iam_client.create_role(
+        Path=PROFILE_PATH,
+        RoleName=name,
+        AssumeRolePolicyDocument=EC2_TRUST_POLICY,
+        Description='EC2 Instance Profile Role',
+        Tags=tags,
+    )
+    reconcile_policies(iam_client, name, managed_policies)
+    iam_client.create_instance_profile(Path=PROFILE_PATH, InstanceProfileName=name, Tags=tags)
+    iam_client.add_role_to_instance_profile(InstanceProfileName=name, RoleName=name)
+    LOG.info(f"created instance profile {name} ({state})")
+    return name
+
+
+def _pooled_profiles(iam_client) -> List[Mapping[str, Any]]:
+    # Every profile under PROFILE_PATH, claimed or not, newest first
+    profiles = []
+    parameters = {'PathPrefix': PROFILE_PATH}
+    while True:
+        response = iam_client.list_instance_profiles(**parameters)
+        profiles.extend(response['InstanceProfiles'])
+        if not response.get('IsTruncated'):
+            break
+        parameters['Marker'] = response['Marker']
+    return sorted(profiles, key=lambda profile: profile['CreateDate'], reverse=True)
+
+
+def _pool_state(iam_client, name: str) -> Optional[str]:
+    response = iam_client.list_instance_profile_tags(InstanceProfileName=name)
+    return next((tag['Value'] for tag in response['Tags'] if tag['Key'] == PROFILE_POOL_TAG), None)
+
+
+def _exists(iam_client, name: str) -> bool:
+    try:
+        iam_client.get_instance_profile(InstanceProfileName=name)
+        return True
+    except iam_client.exceptions.NoSuchEntityException:
+        return False
+
+
+def _propagated(profile: Mapping[str, Any]) -> bool:
+    return time() - profile['CreateDate'].timestamp() >= PROFILE_PROPAGATION_SECONDS
+
+
+def unclaimed_profiles(session: SessionProxy, held: Optional[Mapping[str, str]] = None) -> List[Mapping[str, Any]]:
+    # Every pooled profile nobody has claimed, newest first. Only the profiles
+    # without a claim parameter have their tags read, so the cost follows the
+    # pool size rather than the number of environments. `held` is the result
+    # of claims.claimed when the caller already has it.
+    iam_client = get_client(session, "iam")
+    held = claims.claimed(session, claims.PROFILE) if held is None else held
+    unclaimed = []
+    for profile in _pooled_profiles(iam_client):
+        name = profile['InstanceProfileName']
+        if name in held:
+            continue
+        state = _pool_state(iam_client, name)
+        if state == UNCLAIMED:
+            unclaimed.append(profile)
+        elif state is not None and state.startswith(f'{CLAIMED}:'):
+            # claimed by tag alone, before claims were kept in SSM
+            claims.record_claim(session, claims.PROFILE, name, state[len(CLAIMED) + 1:])
+    return unclaimed
+
+
+def claim_profile(session: SessionProxy, token: str, held: Optional[Mapping[str, str]] = None) -> Optional[str]:
+    # Take an unclaimed, propagated profile out of the pool, or return None when
+    # there is none. The claim itself is the SSM parameter only one claimer can
+    # create (see claims); the profile is tagged as claimed along with the rest
+    # of the environment's tags afterwards.
+    candidates = [profile for profile in unclaimed_profiles(session, held) if _propagated(profile)]
+    # oldest first, the newest are the ones still propagating
+    for profile in reversed(candidates[-CLAIM_SCAN_LIMIT:]):
+        name = profile['InstanceProfileName']
+        if claims.claim(session, claims.PROFILE, name, token):
+            LOG.info(f"claimed pooled instance profile {name}")
+            return name
+    return None
+
+
+def acquire_profile(session: SessionProxy, token: str, managed_policies: Sequence[str], tags: Sequence[Mapping[str, str]], callback_context) -> None:
+    # Bind a pooled profile to the environment, or create one for it with `tags`
+    # when the pool is empty; only a new one has to wait for IAM propagation
+    # before use. A pooled profile gets the environment's tags when they are
+    # propagated (see tagging.tag_tasks).
+    held = claims.claimed(session, claims.PROFILE)
+    # an earlier attempt at this request may have got as far as the claim
+    name = next((name for name, holder in held.items() if holder == token), None)
+    if name is None and PROFILE_POOL_SIZE > 0:
+        name = claim_profile(session, token, held)
+        if name is not None:
+            callback_context.instance_profile_name = name
+            return
+    if name is None:
+        # claimed before it exists, so it never looks unclaimed to the pool
+        name = new_profile_name()
+        claims.claim(session, claims.PROFILE, name, token)
+    if not _exists(get_client(session, "iam"), name):
+        create_profile(get_client(session, "iam"), managed_policies, tags, f'{CLAIMED}:{token}', name)
+        callback_context.instance_profile_created = time()
+    callback_context.instance_profile_name = name
+
+
+def delete_profile(iam_client, name: str) -> None:
+    # Undo create_profile
+    iam_client.remove_role_from_instance_profile(InstanceProfileName=name, RoleName=name)
+    iam_client.delete_instance_profile(InstanceProfileName=name)
+    reconcile_policies(iam_client, name, [], exclusive=True)
+    iam_client.delete_role(RoleName=name)
+    LOG.info(f"deleted pooled instance profile {name}")
+
+
+def replenish_profiles(session: SessionProxy, managed_policies: Sequence[str], tags: Sequence[Mapping[str, str]] = (), size: Optional[int] = None) -> int:
+    # Create profiles until `size` (default PROFILE_POOL_SIZE) unclaimed ones are
+    # pooled; returns how many were created. Only the holder of POOL_LOCK tops
+    # up, so runs that overlap cannot both fill the same shortfall; a run that
+    # finds the lock taken creates nothing.
+    size = PROFILE_POOL_SIZE if size is None else size
+    if len(unclaimed_profiles(session)) >= size:
+        return 0
+    holder = uuid4().hex
+    if not claims.acquire_lock(session, POOL_LOCK, holder):
+        LOG.info("instance profile pool is being refilled elsewhere")
+        return 0
+    try:
+        shortfall = max(size - len(unclaimed_profiles(session)), 0)
+        iam_client = get_client(session, "iam")
+        for _ in range(shortfall):
+            create_profile(iam_client, managed_policies, tags)
+        return shortfall
+    finally:
+        claims.release_lock(session, POOL_LOCK, holder)
+
+
+def trim_profiles(session: SessionProxy, size: Optional[int] = None) -> int:
+    # Delete unclaimed profiles beyond `size` (default PROFILE_POOL_SIZE), newest
+    # first; returns how many were deleted. Each is claimed before it is deleted
+    # so that no create can take it meanwhile.
+    size = PROFILE_POOL_SIZE if size is None else size
+    if len(unclaimed_profiles(session)) <= size:
+        return 0
+    holder = uuid4().hex
+    if not claims.acquire_lock(session, POOL_LOCK, holder):
+        return 0
+    try:
+        unclaimed = unclaimed_profiles(session)
+        iam_client = get_client(session, "iam")
+        deleted = 0
+        for profile in unclaimed[:max(len(unclaimed) - size, 0)]:
+            name = profile['InstanceProfileName']
+            if not claims.claim(session, claims.PROFILE, name, f"trim:{holder}"):
+                continue
+            delete_profile(iam_client, name)
+            claims.release(session, claims.PROFILE, name)
+            deleted += 1
+        return deleted
+    finally:
+        claims.release_lock(session, POOL_LOCK, holder)
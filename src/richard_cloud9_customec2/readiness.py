@@ -0,0 +1,81 @@
+import logging
+from abc import ABC, abstractmethod
+from typing import AbstractSet, Callable, MutableMapping, Optional, Sequence
+
+from cloudformation_cli_python_lib import SessionProxy
+
+from .clients import get_client
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+DEFAULT_PROBE = "INSTANCE_INFORMATION"
+
+
+def _batches(items: Sequence[str], size: int):
+    for start in range(0, len(items), size):
+        yield list(items[start:start + size])
+
+
+class ReadinessProbe(ABC):
+    # Tells which of a set of instances are managed by SSM and can take commands.
+    @abstractmethod
+    def ready(self, instance_ids: Sequence[str]) -> AbstractSet[str]:
+        ...
+
+
+class InventoryProbe(ReadinessProbe):
+    # ssm.get_inventory; only sees an instance once its first inventory has been
+    # collected, which can lag agent registration by minutes.
+    BATCH_SIZE = 40
+
+    def __init__(self, session: SessionProxy):
+        self.session = session
+
+    def ready(self, instance_ids: Sequence[str]) -> AbstractSet[str]:
+        ssm_client = get_client(self.session, "ssm")
+        ready = set()
+        for batch in _batches(instance_ids, self.BATCH_SIZE):
+            response = ssm_client.get_inventory(
+                Filters=[{'Key': 'AWS:InstanceInformation.InstanceId', 'Values': batch, 'Type': 'Equal'}],
+            )
+            ready.update(entity['Id'] for entity in response['Entities'])
+        return ready
+
+
+class InstanceInformationProbe(ReadinessProbe):
+    # ssm.describe_instance_information filtered on PingStatus=Online; updated as
+    # soon as the agent registers and checks up to BATCH_SIZE instances per call.
+    BATCH_SIZE = 50
+
+    def __init__(self, session: SessionProxy):
+        self.session = session
+
+    def ready(self, instance_ids: Sequence[str]) -> AbstractSet[str]:
+        ssm_client = get_client(self.session, "ssm")
+        ready = set()
+        for batch in _batches(instance_ids, self.BATCH_SIZE):
+            parameters = {
+                'Filters': [
+                    {'Key': 'InstanceIds', 'Values': batch},
+                    {'Key': 'PingStatus', 'Values': ['Online']},
+                ],
+                'MaxResults': self.BATCH_SIZE,
+            }
+            while True:
+                response = ssm_client.describe_instance_information(**parameters)
+                ready.update(info['InstanceId'] for info in response['InstanceInformationList'])
+                if not response.get('NextToken'):
+                    break
+                parameters['NextToken'] = response['NextToken']
+        return ready
+
+
+PROBES: MutableMapping[str, Callable[[SessionProxy], ReadinessProbe]] = {
+    "INVENTORY": InventoryProbe,
+    "INSTANCE_INFORMATION": InstanceInformationProbe,
+}
+
+
+def probe_for(name: Optional[str], session: SessionProxy) -> ReadinessProbe:
+    return PROBES[name or DEFAULT_PROBE](session)
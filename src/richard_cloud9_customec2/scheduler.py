@@ -0,0 +1,90 @@
+import logging
+import random
+from time import time
+from typing import Any, MutableMapping, Optional
+
+from cloudformation_cli_python_lib import (
+    HandlerErrorCode,
+    OperationStatus,
+    ProgressEvent,
+)
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Callback context key holding the attempt count and start time of the stage
+# currently being polled.
+POLL_KEY = "POLL"
+
+
+class Backoff:
+    # Exponential backoff with jitter, capped per attempt, and an optional overall
+    # deadline (in seconds) after which the stage is failed instead of polled again.
+    def __init__(self, base: float, cap: float, factor: float = 2.0, jitter: float = 0.5, deadline: Optional[float] = None):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def delay(self, attempt: int) -> int:
+        delay = min(self.cap, self.base * self.factor ** attempt)
+        delay -= delay * self.jitter * random.random()
+        return max(1, int(round(delay)))
+
+    def expired(self, elapsed: float) -> bool:
+        return self.deadline is not None and elapsed >= self.deadline
+
+
+class Fixed(Backoff):
+    def __init__(self, seconds: float, deadline: Optional[float] = None):
+        super().__init__(base=seconds, cap=seconds, factor=1.0, jitter=0.0, deadline=deadline)
+
+
+DEFAULT_SCHEDULE = Backoff(base=5, cap=60, deadline=3600)
+
+STAGE_SCHEDULES: MutableMapping[str, Backoff] = {
+    # waiting for Cloud9 to launch the instance behind a new environment
+    "EnvironmentCreated": Backoff(base=2, cap=15, deadline=600),
+    "RoleCreated": Backoff(base=2, cap=15, deadline=600),
+    # SSM agent usually registers ~40s after boot
+    "ResizedInstance": Backoff(base=5, cap=30, deadline=900),
+    # profile (dis)association normally settles within seconds
+    "NewProfileCreated": Backoff(base=2, cap=15, deadline=300),
+    "DefaultProfileDetached": Backoff(base=2, cap=15, deadline=300),
+    # a single replace_iam_instance_profile_association, verified once it settles
+    "ProfileAssociating": Backoff(base=2, cap=10, deadline=300),
+    # bootstrap documents; polled often so a finished one isn't left waiting
+    "CommandSent": Backoff(base=2, cap=15, factor=1.5, deadline=3600),
+    # instance termination behind delete_environment takes a minute or two
+    "EnvironmentDeleting": Backoff(base=5, cap=30, deadline=1800),
+    "EnvironmentDeleted": Backoff(base=2, cap=30, deadline=600),
+    # an instance type change stops and restarts the instance, ~30-60s each way
+    "InstanceStopping": Backoff(base=5, cap=20, deadline=900),
+    "InstanceStarting": Backoff(base=5, cap=20, deadline=900),
+    # EBS usually moves a modification from modifying to optimizing within minutes
+    "VolumeModifying": Backoff(base=5, cap=30, deadline=1800),
+    "FilesystemGrowing": Backoff(base=2, cap=15, deadline=600),
+}
+
+
+def reschedule(progress: ProgressEvent, stage: Any) -> ProgressEvent:
+    # Record another poll of `stage` in the callback context and set the delay
+    # until the next one, or fail the stage once its deadline has passed.
+    name = stage if isinstance(stage, str) else type(stage).__name__
+    schedule = STAGE_SCHEDULES.get(name, DEFAULT_SCHEDULE)
+    now = time()
+    poll = progress.callbackContext.get(POLL_KEY)
+    if not poll or poll.get("Stage") != name:
+        poll = {"Stage": name, "Attempt": 0, "Started": now}
+    elapsed = now - poll["Started"]
+    if schedule.expired(elapsed):
+        LOG.info(f"stage {name} timed out after {poll['Attempt']} polls and {int(elapsed)}s")
+        progress.status = OperationStatus.FAILED
+        progress.errorCode = HandlerErrorCode.NotStabilized
+        progress.message = f"{name} did not stabilize within {schedule.deadline}s ({poll['Attempt']} polls)"
+        return progress
+    progress.callbackDelaySeconds = schedule.delay(poll["Attempt"])
+    poll["Attempt"] += 1
+    progress.callbackContext[POLL_KEY] = poll
+    return progress
@@ -0,0 +1,144 @@
+import logging
+import threading
+from time import monotonic
+from typing import Any, Dict, Mapping, MutableMapping, Optional, Sequence, Tuple
+
+from cloudformation_cli_python_lib import SessionProxy
+
+from .changes import CLAIMED, INTERNAL_TAG_KEYS, MANAGED_TAG_KEY, OWNER_TAG, POOL_TAG
+from .clients import get_client
+from .models import Tag
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+SNAPSHOT_TTL_SECONDS = 10
+# describe_environments accepts at most this many ids per call
+DESCRIBE_BATCH_SIZE = 25
+LIVE_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# environment arn -> (live properties, monotonic expiry)
+_SNAPSHOTS: MutableMapping[str, Tuple[Mapping[str, Any], float]] = {}
+_LOCK = threading.Lock()
+
+
+def environment_id_from_arn(arn: str) -> str:
+    return arn.split(":")[-1]
+
+
+def _user_tags(tags: Optional[Sequence[Mapping[str, str]]]):
+    return [
+        Tag(Key=tag['Key'], Value=tag['Value'])
+        for tag in tags or []
+        if not tag['Key'].startswith('aws:') and tag['Key'] not in INTERNAL_TAG_KEYS
+    ]
+
+
+def _environment_tags(session: SessionProxy, arn: str):
+    # The environment's own tags are the ones create and update set from the
+    # model; its instance also carries tags Cloud9 adds, such as Name.
+    return _user_tags(get_client(session, "cloud9").list_tags_for_resource(ResourceARN=arn).get('Tags')) or None
+
+
+def describe_environments(session: SessionProxy, environment_ids: Sequence[str], managed_only: bool = False) -> Dict[str, Mapping[str, Any]]:
+    # Live ResourceModel properties for up to DESCRIBE_BATCH_SIZE environments,
+    # keyed by environment id, from one call each to cloud9.describe_environments,
+    # ec2.describe_instances and ec2.describe_volumes, and one call to
+    # cloud9.list_tags_for_resource per environment. With `managed_only`, only
+    # environments whose instance carries the AWSQS-ENVIRONMENT tag are returned,
+    # leaving out warm pool environments nobody has claimed yet.
+    if not environment_ids:
+        return {}
+    cloud9_client = get_client(session, "cloud9")
+    ec2_client = get_client(session, "ec2")
+    try:
+        environments = cloud9_client.describe_environments(environmentIds=list(environment_ids))['environments']
+    except cloud9_client.exceptions.NotFoundException:
+        return {}
+    if not environments:
+        return {}
+    filters = [
+        {'Name': 'tag:aws:cloud9:environment', 'Values': [environment['id'] for environment in environments]},
+        {'Name': 'instance-state-name', 'Values': LIVE_INSTANCE_STATES},
+    ]
+    if managed_only:
+        filters.append({'Name': f'tag:{MANAGED_TAG_KEY}', 'Values': ['True']})
+    instances = {}
+    paginator = ec2_client.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+                if managed_only and POOL_TAG in tags and not tags[POOL_TAG].startswith(CLAIMED):
+                    continue
+                instances[tags.get('aws:cloud9:environment')] = instance
+    volume_ids = [
+        instance['BlockDeviceMappings'][0]['Ebs']['VolumeId']
+        for instance in instances.values()
+        if instance.get('BlockDeviceMappings')
+    ]
+    volumes = {}
+    if volume_ids:
+        for volume in ec2_client.describe_volumes(VolumeIds=volume_ids)['Volumes']:
+            volumes[volume['VolumeId']] = volume
+
+    snapshots = {}
+    now = monotonic()
+    for environment in environments:
+        properties = {
+            'Arn': environment['arn'],
+            'EnvironmentId': environment['id'],
+            'Name': environment.get('name'),
+            # update sets an empty description when the model's is removed
+            'Description': environment.get('description') or None,
+            'Owner': environment.get('ownerArn'),
+        }
+        instance = instances.get(environment['id'])
+        if managed_only and instance is None:
+            continue
+        properties['Tags'] = _environment_tags(session, environment['arn'])
+        if instance is not None:
+            properties['InstanceType'] = instance['InstanceType']
+            properties['SubnetId'] = instance.get('SubnetId')
+            # a claimed warm pool environment still belongs to the pool's owner
+            properties['Owner'] = next((tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == OWNER_TAG), properties['Owner'])
+            if instance.get('BlockDeviceMappings'):
+                volume = volumes.get(instance['BlockDeviceMappings'][0]['Ebs']['VolumeId'])
+                if volume is not None:
+                    properties['VolumeSize'] = volume['Size']
+        snapshots[environment['id']] = properties
+        with _LOCK:
+            _SNAPSHOTS[environment['arn']] = (properties, now + SNAPSHOT_TTL_SECONDS)
+    return snapshots
+
+
+def list_environments(session: SessionProxy, next_token: Optional[str] = None) -> Tuple[Sequence[Mapping[str, Any]], Optional[str]]:
+    # One page of environments created by this resource type, and the token for
+    # the next page. Pages are requested DESCRIBE_BATCH_SIZE at a time so each one
+    # is normally described with a single batch.
+    cloud9_client = get_client(session, "cloud9")
+    parameters = {'maxResults': DESCRIBE_BATCH_SIZE}
+    if next_token:
+        parameters['nextToken'] = next_token
+    response = cloud9_client.list_environments(**parameters)
+    environment_ids = response.get('environmentIds', [])
+    snapshots = {}
+    for start in range(0, len(environment_ids), DESCRIBE_BATCH_SIZE):
+        snapshots.update(describe_environments(session, environment_ids[start:start + DESCRIBE_BATCH_SIZE], managed_only=True))
+    page = [snapshots[environment_id] for environment_id in environment_ids if environment_id in snapshots]
+    return page, response.get('nextToken')
+
+
+def read_snapshot(session: SessionProxy, arn: str) -> Optional[Mapping[str, Any]]:
+    # Live properties for the environment `arn`, or None if it doesn't exist.
+    # Served from the in-process cache while it is younger than SNAPSHOT_TTL_SECONDS.
+    with _LOCK:
+        cached = _SNAPSHOTS.get(arn)
+        if cached is not None and cached[1] > monotonic():
+            return cached[0]
+    return describe_environments(session, [environment_id_from_arn(arn)]).get(environment_id_from_arn(arn))
+
+
+def invalidate_snapshot(arn: Optional[str]) -> None:
+    with _LOCK:
+        _SNAPSHOTS.pop(arn, None)
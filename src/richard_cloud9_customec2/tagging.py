@@ -0,0 +1,86 @@
+import logging
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+from cloudformation_cli_python_lib import SessionProxy
+
+from .changes import MANAGED_TAG_KEY, PROFILE_TAG, tag_list
+from .clients import get_client
+from .executor import Task, TaskNotReady
+from .models import ResourceModel
+from .profiles import profile_names
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+
+def resource_tags(model: Optional[ResourceModel]) -> Dict[str, str]:
+    # The tags everything created for `model` carries
+    tags = {tag.Key: tag.Value for tag in (model.Tags if model is not None and model.Tags else [])}
+    tags[MANAGED_TAG_KEY] = "True"
+    return tags
+
+
+def instance_resources(instance: Mapping[str, Any]) -> List[str]:
+    # The instance and the EC2 resources Cloud9 created along with it: volumes,
+    # network interfaces and security groups
+    resource_ids = [instance['InstanceId']]
+    resource_ids += [mapping['Ebs']['VolumeId'] for mapping in instance.get('BlockDeviceMappings', []) if 'Ebs' in mapping]
+    resource_ids += [interface['NetworkInterfaceId'] for interface in instance.get('NetworkInterfaces', [])]
+    resource_ids += [group['GroupId'] for group in instance.get('SecurityGroups', [])]
+    return list(dict.fromkeys(resource_ids))
+
+
+def _tag_ec2(session: SessionProxy, callback_context, tags_to_set: Mapping[str, str], tags_to_remove: Sequence[str], record_profile: bool) -> None:
+    if not callback_context.resource_ids:
+        raise TaskNotReady(f"no EC2 resources found yet for environment {callback_context.environment_id}")
+    ec2_client = get_client(session, "ec2")
+    if record_profile:
+        # lets update and delete find the role (see handlers.locate_instance)
+        tags_to_set = dict(tags_to_set, **{PROFILE_TAG: profile_names(callback_context)[0]})
+    if tags_to_set:
+        ec2_client.create_tags(Resources=callback_context.resource_ids, Tags=tag_list(tags_to_set))
+    if tags_to_remove:
+        ec2_client.delete_tags(Resources=callback_context.resource_ids, Tags=[{"Key": key} for key in tags_to_remove])
+    LOG.info(f"tagged {callback_context.resource_ids}")
+
+
+def _tag_role(session: SessionProxy, role_name: str, tags_to_set: Mapping[str, str], tags_to_remove: Sequence[str]) -> None:
+    iam_client = get_client(session, "iam")
+    if tags_to_set:
+        iam_client.tag_role(RoleName=role_name, Tags=tag_list(tags_to_set))
+    if tags_to_remove:
+        iam_client.untag_role(RoleName=role_name, TagKeys=list(tags_to_remove))
+
+
+def _tag_instance_profile(session: SessionProxy, profile_name: str, tags_to_set: Mapping[str, str], tags_to_remove: Sequence[str]) -> None:
+    iam_client = get_client(session, "iam")
+    if tags_to_set:
+        iam_client.tag_instance_profile(InstanceProfileName=profile_name, Tags=tag_list(tags_to_set))
+    if tags_to_remove:
+        iam_client.untag_instance_profile(InstanceProfileName=profile_name, TagKeys=list(tags_to_remove))
+
+
+def tag_tasks(
+    session: SessionProxy,
+    callback_context,
+    tags_to_set: Mapping[str, str],
+    tags_to_remove: Sequence[str] = (),
+    ec2_dependencies: Sequence[str] = (),
+    iam_dependencies: Sequence[str] = (),
+    iam_tags: Optional[Mapping[str, str]] = None,
+    record_profile: bool = False,
+) -> Dict[str, Task]:
+    # Tasks for run_tasks that set `tags_to_set` and remove `tags_to_remove` on the
+    # environment's EC2 resources (callback_context.resource_ids, one call for all
+    # of them) and on its role and instance profile, which get `iam_tags` instead
+    # of `tags_to_set` when given. The three are independent and run side by side.
+    # With `record_profile` the EC2 resources are also tagged with the name of the
+    # environment's instance profile.
+    iam_tags = tags_to_set if iam_tags is None else iam_tags
+    if not tags_to_set and not tags_to_remove:
+        return {}
+    return {
+        "TagResources": (lambda: _tag_ec2(session, callback_context, tags_to_set, tags_to_remove, record_profile), list(ec2_dependencies)),
+        "TagRole": (lambda: _tag_role(session, profile_names(callback_context)[1], iam_tags, tags_to_remove), list(iam_dependencies)),
+        "TagInstanceProfile": (lambda: _tag_instance_profile(session, profile_names(callback_context)[0], iam_tags, tags_to_remove), list(iam_dependencies)),
+    }
@@ -0,0 +1,163 @@
+import logging
+import random
+import threading
+from time import monotonic, sleep, time
+from typing import Any, Callable, MutableMapping, Tuple
+
+from botocore.config import Config
+from cloudformation_cli_python_lib import (
+    HandlerErrorCode,
+    OperationStatus,
+    ProgressEvent,
+)
+
+from .scheduler import Backoff
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+THROTTLING_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException")
+
+# (requests per second, burst) per service, shared by every resource handled in
+# this process. IAM and Cloud9 allow far fewer requests than EC2 and SSM.
+RATE_LIMITS: MutableMapping[str, Tuple[float, int]] = {
+    "iam": (5.0, 10),
+    "cloud9": (5.0, 5),
+    "ec2": (20.0, 40),
+    "ssm": (10.0, 20),
+}
+DEFAULT_RATE_LIMIT = (10.0, 10)
+
+MAX_ATTEMPTS = 5
+# call_with_retry is the only retry layer: botocore makes each request once, so
+# a throttled call costs at most MAX_ATTEMPTS requests rather than that squared.
+CLIENT_CONFIG = Config(retries={"total_max_attempts": 1, "mode": "standard"})
+# Seconds one invocation may spend sleeping before retrying throttled calls; once
+# it's used up the throttling error ends the invocation and the stage is retried
+# in a later one.
+RETRY_BUDGET_SECONDS = 10.0
+
+# Callback context key holding the attempt count and start time of the current
+# run of throttled invocations.
+THROTTLED_KEY = "THROTTLED"
+THROTTLE_SCHEDULE = Backoff(base=5, cap=120, deadline=1800)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        # Take a token, sleeping until it's available. Tokens are reserved in
+        # order, so concurrent callers queue up instead of retrying.
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+
+_BUCKETS: MutableMapping[str, TokenBucket] = {}
+_LOCK = threading.Lock()
+_budget = [RETRY_BUDGET_SECONDS]
+
+
+def bucket(service_name: str) -> TokenBucket:
+    with _LOCK:
+        if service_name not in _BUCKETS:
+            _BUCKETS[service_name] = TokenBucket(*RATE_LIMITS.get(service_name, DEFAULT_RATE_LIMIT))
+        return _BUCKETS[service_name]
+
+
+def reset_retry_budget() -> None:
+    with _LOCK:
+        _budget[0] = RETRY_BUDGET_SECONDS
+
+
+def _spend(delay: float) -> bool:
+    with _LOCK:
+        if _budget[0] < delay:
+            return False
+        _budget[0] -= delay
+        return True
+
+
+def error_code(error: Exception) -> str:
+    return getattr(error, "response", {}).get("Error", {}).get("Code", "")
+
+
+def is_throttle(error: Exception) -> bool:
+    return error_code(error) in THROTTLING_CODES
+
+
+def call_with_retry(call: Callable[[], Any], service_name: str) -> Any:
+    for attempt in range(MAX_ATTEMPTS):
+        bucket(service_name).acquire()
+        try:
+            return call()
+        except Exception as e:
+            if not is_throttle(e) or attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = min(8, 0.5 * 2 ** attempt) * (0.5 + random.random() / 2)
+            if not _spend(delay):
+                LOG.info(f"{service_name} throttled ({error_code(e)}) and the retry budget is used up")
+                raise
+            LOG.info(f"{service_name} throttled ({error_code(e)}), retrying in {delay:.1f}s")
+            sleep(delay)
+
+
+class ThrottledClient:
+    # Every API call made through the wrapped client first waits for its service's
+    # token bucket and is retried, within the invocation's budget, when throttled.
+    # So is every page a paginator fetches.
+    PASSTHROUGH = ("get_waiter", "can_paginate", "close")
+
+    def __init__(self, client, service_name: str):
+        self._client = client
+        self._service_name = service_name
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._client, name)
+        if name.startswith("_") or name in self.PASSTHROUGH or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            return call_with_retry(lambda: attribute(*args, **kwargs), self._service_name)
+        return call
+
+    def get_paginator(self, operation_name: str):
+        paginator = self._client.get_paginator(operation_name)
+        method = paginator._method
+        paginator._method = lambda **kwargs: call_with_retry(lambda: method(**kwargs), self._service_name)
+        return paginator
+
+
+def throttled(request, callback_context: MutableMapping[str, Any], error: Exception) -> ProgressEvent:
+    # Hand a stage that was throttled back to CloudFormation to be retried after a
+    # backoff, or fail it once it has been throttled for longer than the deadline.
+    now = time()
+    state = callback_context.get(THROTTLED_KEY) or {"Attempt": 0, "Started": now}
+    progress = ProgressEvent(
+        status=OperationStatus.IN_PROGRESS,
+        resourceModel=request.desiredResourceState,
+        callbackContext=callback_context,
+    )
+    elapsed = now - state["Started"]
+    if THROTTLE_SCHEDULE.expired(elapsed):
+        progress.status = OperationStatus.FAILED
+        progress.errorCode = HandlerErrorCode.Throttling
+        progress.message = f"still throttled ({error_code(error)}) after {int(elapsed)}s: {error}"
+        return progress
+    progress.callbackDelaySeconds = THROTTLE_SCHEDULE.delay(state["Attempt"])
+    progress.message = f"throttled ({error_code(error)}), retrying in {progress.callbackDelaySeconds}s"
+    state["Attempt"] += 1
+    callback_context[THROTTLED_KEY] = state
+    return progress
@@ -0,0 +1,61 @@
+import logging
+from typing import Any, Mapping, Optional
+
+from cloudformation_cli_python_lib import SessionProxy
+
+from .clients import get_client
+from .throttling import error_code
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Modification states in which the new size can already be used by the instance
+RESIZED_STATES = ("optimizing", "completed")
+
+GROW_FILESYSTEM_DOCUMENT = "AWS-RunShellScript"
+# Grow the root partition and filesystem to fill the volume. growpart exits 1
+# with NOCHANGE when the partition already fills the disk, e.g. when cloud-init
+# grew it at boot because the modification had already finished.
+GROW_FILESYSTEM_COMMANDS = [
+    "set -eu",
+    'source=$(findmnt -n -o SOURCE /)',
+    'fstype=$(findmnt -n -o FSTYPE /)',
+    'partition=/sys/class/block/$(basename "$source")/partition',
+    'if [ -e "$partition" ]; then growpart "/dev/$(lsblk -no PKNAME "$source")" "$(cat "$partition")" || true; fi',
+    'case "$fstype" in',
+    '  xfs) xfs_growfs -d / ;;',
+    '  ext2|ext3|ext4) resize2fs "$source" ;;',
+    '  *) echo "not growing $fstype filesystem on $source" >&2 ;;',
+    'esac',
+    'df -h /',
+]
+GROW_FILESYSTEM_TIMEOUT_SECONDS = 300
+
+
+def volume_modification(session: SessionProxy, volume_id: str) -> Optional[Mapping[str, Any]]:
+    # The most recent modification of the volume, or None if it has never been modified
+    ec2_client = get_client(session, "ec2")
+    try:
+        response = ec2_client.describe_volumes_modifications(VolumeIds=[volume_id])
+    except Exception as e:
+        if error_code(e) != "InvalidVolumeModification.NotFound":
+            raise
+        return None
+    modifications = response.get('VolumesModifications') or []
+    if not modifications:
+        return None
+    # a modification without a StartTime sorts first; datetimes don't compare with 0
+    return max(modifications, key=lambda modification: modification['StartTime'].timestamp() if modification.get('StartTime') else 0.0)
+
+
+def send_grow_filesystem(session: SessionProxy, instance_id: str) -> str:
+    response = get_client(session, "ssm").send_command(
+        InstanceIds=[instance_id],
+        DocumentName=GROW_FILESYSTEM_DOCUMENT,
+        Comment="grow the root filesystem to fill its volume",
+        TimeoutSeconds=GROW_FILESYSTEM_TIMEOUT_SECONDS,
+        Parameters={"commands": GROW_FILESYSTEM_COMMANDS},
+    )
+    command_id = response['Command']['CommandId']
+    LOG.info(f"growing the root filesystem of {instance_id} with command {command_id}")
+    return command_id
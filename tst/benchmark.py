@@ -0,0 +1,274 @@
+"""Offline create/update/delete benchmark for Richard::Cloud9::CustomEC2.
+
+Drives create_handler, update_handler and delete_handler the way CloudFormation does (callback
+context round-tripped through JSON, callbackDelaySeconds honoured) against the
+in-process backend in fake_aws.py, and reports invocations per resource,
+simulated wall time, AWS API calls and handler CPU time.
+
+    python tst/benchmark.py --resources 10 --concurrency 5 --budget 0
+    python tst/benchmark.py --json --max-invocations 40 --max-api-calls 60
+    python tst/benchmark.py --update InstanceType=t3.large --update VolumeSize=40
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from cloudformation_cli_python_lib import OperationStatus  # noqa: E402
+from cloudformation_cli_python_lib.utils import KitchenSinkEncoder  # noqa: E402
+
+from fake_aws import DEFAULT_TIMINGS, FakeBackend, ScaledClock  # noqa: E402
+from richard_cloud9_customec2 import (  # noqa: E402
+    clients,
+    documents,
+    executor,
+    fleet,
+    handlers,
+    instrumentation,
+    policies,
+    placement,
+    pool,
+    preflight,
+    profiles,
+    readiness,
+    scheduler,
+    bootstrap,
+    claims,
+    changes,
+    snapshot,
+    throttling,
+    volumes,
+)
+from richard_cloud9_customec2.models import BootstrapDocument, ResourceHandlerRequest, ResourceModel, Tag  # noqa: E402
+
+PACKAGE_MODULES = (bootstrap, claims, clients, documents, executor, fleet, handlers, instrumentation, placement, policies, pool, preflight, profiles, readiness, scheduler, snapshot, throttling, volumes)
+OWNER = "arn:aws:iam::123456789012:user/benchmark"
+
+
+def template(args) -> ResourceModel:
+    model = ResourceModel(**{field.name: None for field in fields(ResourceModel)})
+    model.InstanceType = args.instance_type
+    model.OperatingSystem = "AMAZON_LINUX_2"
+    model.Owner = OWNER
+    model.VolumeSize = args.volume_size
+    model.BootstrapDocumentName = args.document
+    model.BootstrapDocuments = [bootstrap_document(spec) for spec in args.bootstrap_document] or None
+    model.ReadinessProbe = args.readiness_probe
+    model.WarmPool = args.warm_pool > 0
+    model.SubnetIds = [spec.split(":")[0] for spec in args.subnet] or None
+    model.Tags = [Tag(Key="benchmark", Value="true")]
+    return model
+
+
+def bootstrap_document(spec: str) -> BootstrapDocument:
+    # NAME runs after the document before it, NAME: alongside the others and
+    # NAME:A+B after documents A and B
+    name, _, depends_on = spec.partition(":")
+    return BootstrapDocument(
+        Name=name,
+        Parameters={"commands": [f"echo {name}"]},
+        DependsOn=[dependency for dependency in depends_on.split("+") if dependency] if ":" in spec else None,
+        TimeoutSeconds=None,
+    )
+
+
+def make_request(model: ResourceModel, token: str, previous: ResourceModel = None) -> ResourceHandlerRequest:
+    values = {field.name: None for field in fields(ResourceHandlerRequest)}
+    values.update(
+        clientRequestToken=token,
+        desiredResourceState=model,
+        previousResourceState=previous,
+        awsAccountId="123456789012",
+        region="us-east-1",
+        logicalResourceIdentifier="Environment",
+    )
+    return ResourceHandlerRequest(**values)
+
+
+def updated(model: ResourceModel, changes) -> ResourceModel:
+    # A copy of `model` with the --update NAME=VALUE changes applied; Tags is a
+    # comma-separated list of key:value pairs.
+    values = model._serialize()
+    for change in changes:
+        name, value = change.split("=", 1)
+        if name == "Tags":
+            values[name] = [{"Key": key, "Value": tag_value} for key, tag_value in (tag.split(":", 1) for tag in value.split(",") if tag)]
+        elif name == "VolumeSize":
+            values[name] = int(value)
+        else:
+            values[name] = value or None
+    return ResourceModel._deserialize(values)
+
+
+def invoke_until_done(handler, backend: FakeBackend, request: ResourceHandlerRequest):
+    # One resource operation: keep re-invoking the handler with the JSON
+    # round-tripped callback context after waiting callbackDelaySeconds.
+    clock = backend.clock
+    callback_context = {}
+    invocations = 0
+    cpu = 0.0
+    started = clock.monotonic()
+    while True:
+        invocations += 1
+        cpu_started = time.process_time()
+        try:
+            progress = handler(backend.session(), request, callback_context)
+        except Exception as e:  # the library turns these into FAILED events
+            return {"status": "FAILED", "message": f"{type(e).__name__}: {e}", "invocations": invocations,
+                    "seconds": clock.monotonic() - started, "cpu": cpu + time.process_time() - cpu_started, "model": None}
+        cpu += time.process_time() - cpu_started
+        if progress.status != OperationStatus.IN_PROGRESS:
+            return {"status": progress.status.name, "message": progress.message, "invocations": invocations,
+                    "seconds": clock.monotonic() - started, "cpu": cpu, "model": progress.resourceModel}
+        callback_context = json.loads(json.dumps(progress.callbackContext, cls=KitchenSinkEncoder))
+        clock.sleep(progress.callbackDelaySeconds or 0)
+
+
+def run_phase(name, handler, backend: FakeBackend, requests, concurrency: int):
+    calls_before = Counter(backend.calls)
+    throttles_before = sum(backend.throttles.values())
+    started = backend.clock.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool_executor:
+        results = list(pool_executor.map(lambda request: invoke_until_done(handler, backend, request), requests))
+    calls = Counter(backend.calls)
+    calls.subtract(calls_before)
+    calls = +calls
+    return {
+        "phase": name,
+        "resources": len(results),
+        "succeeded": sum(1 for result in results if result["status"] == "SUCCESS"),
+        "failures": [result["message"] for result in results if result["status"] != "SUCCESS"],
+        "invocations": sum(result["invocations"] for result in results),
+        "max_invocations": max((result["invocations"] for result in results), default=0),
+        "simulated_seconds": backend.clock.monotonic() - started,
+        "mean_resource_seconds": sum(result["seconds"] for result in results) / max(len(results), 1),
+        "handler_cpu_seconds": sum(result["cpu"] for result in results),
+        "api_calls": sum(calls.values()),
+        "throttles": sum(backend.throttles.values()) - throttles_before,
+        "operations": dict(calls.most_common()),
+        "models": [result["model"] for result in results],
+    }
+
+
+def report(phase) -> None:
+    resources = max(phase["resources"], 1)
+    print(f"== {phase['phase']}: {phase['succeeded']}/{phase['resources']} succeeded")
+    print(f"   invocations      {phase['invocations']} ({phase['invocations'] / resources:.1f}/resource, max {phase['max_invocations']})")
+    print(f"   simulated time   {phase['simulated_seconds']:.0f}s total, {phase['mean_resource_seconds']:.0f}s/resource")
+    print(f"   handler cpu      {phase['handler_cpu_seconds']:.3f}s ({1000 * phase['handler_cpu_seconds'] / resources:.1f}ms/resource)")
+    print(f"   api calls        {phase['api_calls']} ({phase['api_calls'] / resources:.1f}/resource, {phase['throttles']} throttled)")
+    for operation, count in phase["operations"].items():
+        print(f"      {count:6d}  {operation}")
+    for failure in phase["failures"]:
+        print(f"   FAILED: {failure}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--resources", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=5, help="resources in flight at once")
+    parser.add_argument("--budget", type=float, default=handlers.CREATE_TIME_BUDGET_SECONDS, help="CREATE_TIME_BUDGET_SECONDS for the run")
+    parser.add_argument("--scale", type=float, default=0.01, help="real seconds per simulated second")
+    parser.add_argument("--latency", type=float, default=0.1, help="simulated seconds per API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of API calls throttled")
+    parser.add_argument("--timing", action="append", default=[], metavar="NAME=SECONDS", help=f"override one of {', '.join(DEFAULT_TIMINGS)}, or command:<document>")
+    parser.add_argument("--instance-type", default="t3.small")
+    parser.add_argument("--volume-size", type=int, default=20)
+    parser.add_argument("--document", default="bootstrap", help="BootstrapDocumentName; empty to skip the command stage")
+    parser.add_argument("--bootstrap-document", action="append", default=[], metavar="NAME[:A+B]",
+                        help="add a BootstrapDocuments entry; NAME: has no dependencies, NAME:A+B waits for A and B")
+    parser.add_argument("--readiness-probe", default=None)
+    parser.add_argument("--subnet", action="append", default=[], metavar="ID:ZONE:FREE", help="candidate subnet (SubnetIds) with its zone and free addresses")
+    parser.add_argument("--zone-capacity", action="append", default=[], metavar="ZONE=N", help="instances that can still be launched in ZONE")
+    parser.add_argument("--warm-pool", type=int, default=0, help="pre-provision this many pool environments and claim from them")
+    parser.add_argument("--profile-pool", type=int, default=profiles.PROFILE_POOL_SIZE, help="PROFILE_POOL_SIZE for the run; the pool is filled and propagated before CREATE")
+    parser.add_argument("--bootstrap-cache", default="memory", help="BOOTSTRAP_CACHE for the run")
+    parser.add_argument("--update", action="append", default=[], metavar="NAME=VALUE", help="run UPDATE on every resource with this property changed")
+    parser.add_argument("--skip-delete", action="store_true")
+    parser.add_argument("--metrics", action="store_true", help="print the handlers' EMF metric lines")
+    parser.add_argument("--verbose", action="store_true", help="show the handlers' log output")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--max-invocations", type=float, help="fail if create needs more invocations per resource")
+    parser.add_argument("--max-api-calls", type=float, help="fail if create makes more API calls per resource")
+    parser.add_argument("--max-seconds", type=float, help="fail if a create takes more simulated seconds on average")
+    args = parser.parse_args(argv)
+    args.document = args.document or None
+
+    logging.basicConfig()
+    if not args.verbose:
+        # the package's loggers are at DEBUG; quiet them where they are handled,
+        # which leaves the metrics logger (its own handler) alone
+        logging.getLogger().handlers[0].setLevel(logging.WARNING)
+    clock = ScaledClock(args.scale)
+    clock.install(*PACKAGE_MODULES)
+    if not args.metrics:
+        logging.getLogger(instrumentation.METRICS_LOGGER).disabled = True
+    handlers.CREATE_TIME_BUDGET_SECONDS = args.budget
+    bootstrap.BOOTSTRAP_CACHE = args.bootstrap_cache
+    profiles.PROFILE_POOL_SIZE = args.profile_pool
+    timings = {name: float(value) for name, value in (timing.split("=", 1) for timing in args.timing)}
+    subnets = {subnet_id: (zone, int(free)) for subnet_id, zone, free in (spec.split(":") for spec in args.subnet)}
+    zone_capacity = {zone: int(count) for zone, count in (spec.split("=", 1) for spec in args.zone_capacity)}
+    backend = FakeBackend(clock=clock, latency=args.latency, timings=timings, subnets=subnets, zone_capacity=zone_capacity)
+
+    model = template(args)
+    if args.warm_pool:
+        pool.replenish_pool(backend.session(), model, args.warm_pool, OWNER)
+    if args.profile_pool:
+        profiles.replenish_profiles(backend.session(), handlers.MANAGED_POLICIES)
+        clock.sleep(profiles.PROFILE_PROPAGATION_SECONDS)
+    backend.throttle_rate = args.throttle_rate
+    requests = [make_request(ResourceModel._deserialize(model._serialize()) or model, f"token-{index}") for index in range(args.resources)]
+    for index, request in enumerate(requests):
+        request.desiredResourceState.Name = f"benchmark-{index:03d}"
+
+    phases = [run_phase("CREATE", handlers.create_handler, backend, requests, args.concurrency)]
+    models = [created_model for created_model in phases[0]["models"] if created_model is not None]
+    if args.update:
+        changed = [make_request(updated(created_model, args.update), f"update-{index}", created_model) for index, created_model in enumerate(models)]
+        phases.append(run_phase("UPDATE", handlers.update_handler, backend, changed, args.concurrency))
+        models = [request.desiredResourceState for request in changed]
+    if not args.skip_delete:
+        deletes = [make_request(created_model, f"delete-{index}") for index, created_model in enumerate(models)]
+        phases.append(run_phase("DELETE", handlers.delete_handler, backend, deletes, args.concurrency))
+
+    for phase in phases:
+        del phase["models"]
+    if args.json:
+        print(json.dumps(phases, indent=2))
+    else:
+        for phase in phases:
+            report(phase)
+        if args.subnet:
+            placed = Counter(instance["SubnetId"] for instance in backend.instances.values())
+            print(f"== placement: {', '.join(f'{subnet_id} ({backend.subnets[subnet_id][0]}) {placed[subnet_id]}' for subnet_id in subnets)}")
+        if not args.skip_delete:
+            pooled = sum(1 for profile in backend.instance_profiles.values() if {"Key": changes.PROFILE_POOL_TAG, "Value": changes.UNCLAIMED} in profile["tags"])
+            held = sum(1 for name in backend.parameters if name.startswith(f"{claims.CLAIM_PATH}/"))
+            print(f"== leftovers: {len(backend.environments)} environments, {len(backend.roles) - 1 - pooled} roles, {len(backend.instance_profiles) - pooled} instance profiles ({pooled} pooled), {held} claims")
+
+    create = phases[0]
+    resources = max(create["resources"], 1)
+    failed = any(phase["succeeded"] != phase["resources"] for phase in phases)
+    if args.max_invocations is not None and create["invocations"] / resources > args.max_invocations:
+        print(f"create used {create['invocations'] / resources:.1f} invocations/resource, limit {args.max_invocations}", file=sys.stderr)
+        failed = True
+    if args.max_api_calls is not None and create["api_calls"] / resources > args.max_api_calls:
+        print(f"create made {create['api_calls'] / resources:.1f} API calls/resource, limit {args.max_api_calls}", file=sys.stderr)
+        failed = True
+    if args.max_seconds is not None and create["mean_resource_seconds"] > args.max_seconds:
+        print(f"create took {create['mean_resource_seconds']:.0f}s/resource, limit {args.max_seconds}", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Cold-start profile for the Richard::Cloud9::CustomEC2 handler package.
+
+Prints the slowest imports behind `richard_cloud9_customec2.handlers` (from
+`python -X importtime`), then times cold and warm invocations: each cold sample
+is a fresh interpreter that imports the handlers, builds the four service
+clients from a new boto3 session and runs one create stage against the
+in-process backend in fake_aws.py; warm samples repeat the clients and stage in
+the same process with new credentials, as a reused Lambda container would.
+
+    python tst/coldstart.py --runs 5 --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+SERVICES = ("iam", "cloud9", "ec2", "ssm")
+
+
+def _environment():
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join([str(ROOT / "src"), str(ROOT / "tst"), environment.get("PYTHONPATH", "")])
+    environment["EMIT_METRICS"] = "false"
+    return environment
+
+
+def import_profile(top: int):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import richard_cloud9_customec2.handlers"],
+        env=_environment(), stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        entries.append((name.strip(), int(own), int(cumulative)))
+    total = next(cumulative for name, _, cumulative in reversed(entries) if name == "richard_cloud9_customec2.handlers")
+    package = [entry for entry in entries if entry[0].startswith("richard_cloud9_customec2")]
+    print(f"== import richard_cloud9_customec2.handlers: {total / 1000:.1f}ms")
+    print(f"   package modules (self): {sum(own for _, own, _ in package) / 1000:.1f}ms")
+    for name, own, cumulative in sorted(entries, key=lambda entry: entry[2], reverse=True)[:top]:
+        print(f"   {cumulative / 1000:8.1f}ms cumulative {own / 1000:7.1f}ms self  {name}")
+
+
+def _session(index: int):
+    import boto3
+    from cloudformation_cli_python_lib import SessionProxy
+
+    return SessionProxy(boto3.Session(
+        aws_access_key_id=f"AKIDBENCHMARK{index:04d}",
+        aws_secret_access_key="secret",
+        aws_session_token=f"token-{index}",
+        region_name="us-east-1",
+    ))
+
+
+def _invocation(handlers, backend, request, index: int):
+    # Client construction for a new set of credentials, then one create stage
+    from richard_cloud9_customec2.clients import get_client
+
+    started = time.perf_counter()
+    session = _session(index)
+    for service in SERVICES:
+        get_client(session, service)
+    clients = time.perf_counter() - started
+    started = time.perf_counter()
+    handlers.create_handler(backend.session(), request, {})
+    return clients, time.perf_counter() - started
+
+
+def child(warm_runs: int) -> None:
+    started = time.perf_counter()
+    from richard_cloud9_customec2 import handlers
+    imported = time.perf_counter() - started
+
+    import logging
+    from benchmark import make_request, template
+    from fake_aws import FakeBackend, ScaledClock
+
+    logging.disable(logging.INFO)
+    handlers.CREATE_TIME_BUDGET_SECONDS = 0
+    backend = FakeBackend(clock=ScaledClock(1.0), latency=0.0)
+    options = argparse.Namespace(instance_type="t3.small", volume_size=None, document=None, bootstrap_document=[], readiness_probe=None, warm_pool=0, subnet=[])
+    request = make_request(template(options), "coldstart")
+    cold = _invocation(handlers, backend, request, 0)
+    warm = [_invocation(handlers, backend, request, index) for index in range(1, warm_runs + 1)]
+    print(json.dumps({"import": imported, "cold": cold, "warm": warm}))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="cold interpreter samples")
+    parser.add_argument("--warm-runs", type=int, default=5, help="warm samples per interpreter")
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to list")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        child(args.warm_runs)
+        return 0
+
+    import_profile(args.top)
+    samples = []
+    for _ in range(args.runs):
+        result = subprocess.run(
+            [sys.executable, __file__, "--child", "--warm-runs", str(args.warm_runs)],
+            env=_environment(), stdout=subprocess.PIPE, universal_newlines=True, check=True,
+        )
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    def median_ms(values):
+        return statistics.median(values) * 1000
+
+    imported = median_ms([sample["import"] for sample in samples])
+    cold_clients = median_ms([sample["cold"][0] for sample in samples])
+    cold_stage = median_ms([sample["cold"][1] for sample in samples])
+    warm_clients = median_ms([warm[0] for sample in samples for warm in sample["warm"]])
+    warm_stage = median_ms([warm[1] for sample in samples for warm in sample["warm"]])
+    print(f"== cold invocation (median of {args.runs}): {imported + cold_clients + cold_stage:.1f}ms")
+    print(f"   import handlers  {imported:8.1f}ms")
+    print(f"   build clients    {cold_clients:8.1f}ms ({', '.join(SERVICES)})")
+    print(f"   first stage      {cold_stage:8.1f}ms")
+    print(f"== warm invocation, new credentials (median of {args.runs * args.warm_runs}): {warm_clients + warm_stage:.1f}ms")
+    print(f"   build clients    {warm_clients:8.1f}ms")
+    print(f"   first stage      {warm_stage:8.1f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,32 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    # A fresh stand-in AWS (see fake_aws) on a fast clock, with the package's
+    # process-wide caches emptied so nothing carries over from another test.
+    from benchmark import PACKAGE_MODULES
+    from fake_aws import FakeBackend, ScaledClock
+    from richard_cloud9_customec2 import bootstrap, instrumentation, placement, policies, preflight, snapshot, throttling
+
+    clock = ScaledClock(0.001)
+    for module in PACKAGE_MODULES:
+        for name, replacement in (("time", clock.time), ("monotonic", clock.monotonic), ("sleep", clock.sleep)):
+            if getattr(module, name, None) is getattr(time, name):
+                monkeypatch.setattr(module, name, replacement)
+    monkeypatch.setattr(bootstrap, "_MEMORY", bootstrap.MemoryCache())
+    monkeypatch.setattr(placement, "_SUBNETS", {})
+    monkeypatch.setattr(placement, "_PLACEMENTS", [])
+    monkeypatch.setattr(policies, "_ATTACHED", {})
+    monkeypatch.setattr(preflight, "_CAPABILITIES", {})
+    monkeypatch.setattr(snapshot, "_SNAPSHOTS", {})
+    monkeypatch.setattr(throttling, "_BUCKETS", {})
+    monkeypatch.setattr(instrumentation, "EMIT_METRICS", False)
+    return FakeBackend(clock=clock, latency=0.01)
@@ -0,0 +1,788 @@
+"""In-process stand-in for the AWS APIs the Richard::Cloud9::CustomEC2 handlers call.
+
+The backend keeps just enough state (roles, instance profiles, environments,
+instances, volumes, profile associations, SSM commands) to walk the handlers
+through every provisioning stage. It models per-API latency, eventual
+consistency (instances launching, SSM registration, association changes,
+commands running, environments terminating) and throttling, all on a scaled
+clock so minutes of AWS time pass in seconds.
+"""
+import itertools
+import random
+import threading
+import time as _time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Mapping, MutableMapping, Optional, Tuple
+
+from botocore.exceptions import ClientError
+from cloudformation_cli_python_lib import SessionProxy
+
+THROTTLING_CODES = {
+    "iam": "Throttling",
+    "ec2": "RequestLimitExceeded",
+    "ssm": "ThrottlingException",
+    "cloud9": "ThrottlingException",
+}
+
+DEFAULT_TIMINGS = {
+    # seconds of simulated time
+    "instance_launch": 20,
+    "ssm_registration": 40,
+    "inventory_lag": 120,
+    "association": 5,
+    # a new instance profile can't be associated until IAM has propagated it
+    "profile_propagation": 10,
+    "command": 30,
+    "volume_modification": 10,
+    "volume_optimization": 60,
+    "environment_delete": 60,
+    "instance_stop": 30,
+    "instance_start": 15,
+}
+
+
+class ScaledClock:
+    # Simulated time that runs 1/scale times faster than real time, so
+    # concurrent work overlaps exactly as it would against AWS.
+    def __init__(self, scale: float = 0.01):
+        self.scale = scale
+        self._epoch = _time.time()
+        self._started = _time.perf_counter()
+
+    def monotonic(self) -> float:
+        return (_time.perf_counter() - self._started) / self.scale
+
+    def time(self) -> float:
+        return self._epoch + self.monotonic()
+
+    def sleep(self, seconds: float) -> None:
+        if seconds > 0:
+            _time.sleep(seconds * self.scale)
+
+    def install(self, *modules) -> None:
+        # Point the time functions the given modules imported at this clock
+        for module in modules:
+            for name, replacement in (("time", self.time), ("monotonic", self.monotonic), ("sleep", self.sleep)):
+                if getattr(module, name, None) is getattr(_time, name):
+                    setattr(module, name, replacement)
+
+
+def _error(code: str, operation: str, exception_class=ClientError, message: Optional[str] = None) -> ClientError:
+    return exception_class({"Error": {"Code": code, "Message": message or code}}, operation)
+
+
+class _Exceptions:
+    # client.exceptions: one ClientError subclass per error code, named the way
+    # botocore names them for the service (IAM appends "Exception", SSM doesn't).
+    def __init__(self, codes, suffix="Exception"):
+        self.ClientError = ClientError
+        self.by_code = {}
+        for code in codes:
+            name = code if code.endswith(suffix) else f"{code}{suffix}"
+            self.by_code[code] = type(name, (ClientError,), {})
+            setattr(self, name, self.by_code[code])
+
+
+class _Paginator:
+    # One page; the method is kept where botocore's Paginator keeps it
+    def __init__(self, method):
+        self._method = method
+
+    def paginate(self, **parameters):
+        yield self._method(**parameters)
+
+
+class FakeClient:
+    def __init__(self, backend: "FakeBackend", service: str):
+        self._backend = backend
+        self._service = service
+        self.exceptions = backend.exceptions[service]
+
+    def get_paginator(self, operation: str) -> _Paginator:
+        return _Paginator(getattr(self, operation))
+
+    def __getattr__(self, operation: str):
+        implementation = getattr(self._backend, f"_{self._service}_{operation}", None)
+        if implementation is None:
+            raise AttributeError(f"{self._service}.{operation} is not simulated")
+
+        def call(**parameters):
+            return self._backend.call(self._service, operation, implementation, parameters)
+        return call
+
+
+class FakeSession:
+    def __init__(self, backend: "FakeBackend", region_name: str = "us-east-1"):
+        self._backend = backend
+        self.region_name = region_name
+
+    def client(self, service_name: str, **_) -> FakeClient:
+        return FakeClient(self._backend, service_name)
+
+    def resource(self, service_name: str, **_):
+        raise NotImplementedError("resources are not simulated")
+
+
+class FakeBackend:
+    def __init__(
+        self,
+        clock: Optional[ScaledClock] = None,
+        latency: float = 0.05,
+        latencies: Optional[Mapping[str, float]] = None,
+        timings: Optional[Mapping[str, float]] = None,
+        throttle_rate: float = 0.0,
+        documents: Optional[List[str]] = None,
+        policies: Optional[List[str]] = None,
+        instance_types: Optional[List[str]] = None,
+        subnets: Optional[Mapping[str, Tuple[str, int]]] = None,
+        zone_capacity: Optional[Mapping[str, int]] = None,
+        account_id: str = "123456789012",
+        region: str = "us-east-1",
+        seed: int = 0,
+    ):
+        self.clock = clock or ScaledClock()
+        self.latency = latency
+        self.latencies = dict(latencies or {})
+        self.timings = dict(DEFAULT_TIMINGS, **(timings or {}))
+        self.throttle_rate = throttle_rate
+        # None: every document, policy or instance type exists
+        self.documents = documents
+        self.policies = policies
+        self.instance_types = instance_types
+        # subnet id -> [availability zone, free IP addresses]; instances use one
+        # address each. zone -> instances that can still be launched there; zones
+        # not listed have unlimited capacity.
+        self.subnets: Dict[str, List[Any]] = {
+            subnet_id: list(subnet)
+            for subnet_id, subnet in dict({"subnet-default": (f"{region}a", 4000)}, **(subnets or {})).items()
+        }
+        self.zone_capacity: Dict[str, int] = dict(zone_capacity or {})
+        self.account_id = account_id
+        self.region = region
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.throttles: Counter = Counter()
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self.exceptions = {
+            "iam": _Exceptions(["EntityAlreadyExists", "NoSuchEntity", "DeleteConflict", "LimitExceeded"]),
+            "cloud9": _Exceptions(["NotFoundException", "ConflictException", "BadRequestException"]),
+            "ec2": _Exceptions([]),
+            "ssm": _Exceptions(["InvalidDocument", "InvocationDoesNotExist", "ParameterNotFound", "ParameterAlreadyExists"], suffix=""),
+            "sts": _Exceptions([]),
+        }
+        self.roles: Dict[str, Dict[str, Any]] = {}
+        self.instance_profiles: Dict[str, Dict[str, Any]] = {}
+        self.environments: Dict[str, Dict[str, Any]] = {}
+        self.instances: Dict[str, Dict[str, Any]] = {}
+        self.volumes: Dict[str, Dict[str, Any]] = {}
+        # network interface and security group id -> {"tags": [...]}
+        self.ec2_tags: Dict[str, Dict[str, Any]] = {}
+        self.associations: Dict[str, Dict[str, Any]] = {}
+        self.commands: Dict[str, Dict[str, Any]] = {}
+        self.parameters: Dict[str, str] = {
+            f"/aws/service/cloud9/amis/{image}": "ami-0123456789abcdef0"
+            for image in ("amazonlinux-2-x86_64", "ubuntu-18.04-x86_64")
+        }
+
+    def session(self) -> SessionProxy:
+        return SessionProxy(FakeSession(self, self.region))
+
+    # plumbing
+
+    def call(self, service: str, operation: str, implementation, parameters: MutableMapping[str, Any]):
+        name = f"{service}.{operation}"
+        self.calls[name] += 1
+        self.clock.sleep(self.latencies.get(name, self.latency))
+        with self._lock:
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                self.throttles[name] += 1
+                raise _error(THROTTLING_CODES.get(service, "Throttling"), operation)
+            return implementation(**parameters)
+
+    def _new_id(self, prefix: str) -> str:
+        return f"{prefix}{next(self._ids):08x}"
+
+    def _now(self) -> float:
+        return self.clock.monotonic()
+
+    def _raise(self, service: str, code: str, operation: str, message: Optional[str] = None):
+        exception_class = self.exceptions[service].by_code.get(code, ClientError)
+        raise _error(code, operation, exception_class, message)
+
+    # iam
+
+    def _iam_create_role(self, RoleName, Tags=(), **_):
+        if RoleName in self.roles:
+            self._raise("iam", "EntityAlreadyExists", "CreateRole")
+        self.roles[RoleName] = {"policies": [], "tags": list(Tags)}
+        return {"Role": {"RoleName": RoleName, "Arn": f"arn:aws:iam::{self.account_id}:role/{RoleName}"}}
+
+    def _iam_get_role(self, RoleName):
+        if RoleName not in self.roles:
+            self._raise("iam", "NoSuchEntity", "GetRole")
+        return {"Role": {"RoleName": RoleName, "Arn": f"arn:aws:iam::{self.account_id}:role/{RoleName}", "Tags": self.roles[RoleName]["tags"]}}
+
+    def _iam_delete_role(self, RoleName):
+        role = self.roles.get(RoleName)
+        if role is None:
+            self._raise("iam", "NoSuchEntity", "DeleteRole")
+        if role["policies"] or any(RoleName in profile["roles"] for profile in self.instance_profiles.values()):
+            self._raise("iam", "DeleteConflict", "DeleteRole")
+        del self.roles[RoleName]
+        return {}
+
+    def _iam_tag_role(self, RoleName, Tags):
+        if RoleName not in self.roles:
+            self._raise("iam", "NoSuchEntity", "TagRole")
+        self.roles[RoleName]["tags"] = _merge_tags(self.roles[RoleName]["tags"], Tags)
+        return {}
+
+    def _iam_untag_role(self, RoleName, TagKeys):
+        if RoleName not in self.roles:
+            self._raise("iam", "NoSuchEntity", "UntagRole")
+        self.roles[RoleName]["tags"] = [tag for tag in self.roles[RoleName]["tags"] if tag["Key"] not in TagKeys]
+        return {}
+
+    def _iam_list_attached_role_policies(self, RoleName, Marker=None, MaxItems=2):
+        if RoleName not in self.roles:
+            self._raise("iam", "NoSuchEntity", "ListAttachedRolePolicies")
+        policies = self.roles[RoleName]["policies"]
+        start = int(Marker or 0)
+        page = policies[start:start + MaxItems]
+        response = {"AttachedPolicies": [{"PolicyArn": arn, "PolicyName": arn.split("/")[-1]} for arn in page], "IsTruncated": start + MaxItems < len(policies)}
+        if response["IsTruncated"]:
+            response["Marker"] = str(start + MaxItems)
+        return response
+
+    def _iam_attach_role_policy(self, RoleName, PolicyArn):
+        if RoleName not in self.roles:
+            self._raise("iam", "NoSuchEntity", "AttachRolePolicy")
+        if PolicyArn not in self.roles[RoleName]["policies"]:
+            self.roles[RoleName]["policies"].append(PolicyArn)
+        return {}
+
+    def _iam_detach_role_policy(self, RoleName, PolicyArn):
+        if RoleName not in self.roles or PolicyArn not in self.roles[RoleName]["policies"]:
+            self._raise("iam", "NoSuchEntity", "DetachRolePolicy")
+        self.roles[RoleName]["policies"].remove(PolicyArn)
+        return {}
+
+    def _iam_get_policy(self, PolicyArn):
+        if self.policies is not None and PolicyArn not in self.policies:
+            self._raise("iam", "NoSuchEntity", "GetPolicy")
+        return {"Policy": {"Arn": PolicyArn, "PolicyName": PolicyArn.split("/")[-1]}}
+
+    def _instance_profile(self, name):
+        profile = self.instance_profiles[name]
+        return {
+            "Path": profile["path"],
+            "InstanceProfileName": name,
+            "InstanceProfileId": profile["id"],
+            "Arn": f"arn:aws:iam::{self.account_id}:instance-profile{profile['path']}{name}",
+            "CreateDate": datetime.fromtimestamp(profile["created"], tz=timezone.utc),
+            "Roles": [{"RoleName": role} for role in profile["roles"]],
+            "Tags": profile["tags"],
+        }
+
+    def _iam_create_instance_profile(self, InstanceProfileName, Path="/", Tags=(), **_):
+        if InstanceProfileName in self.instance_profiles:
+            self._raise("iam", "EntityAlreadyExists", "CreateInstanceProfile")
+        self.instance_profiles[InstanceProfileName] = {"id": self._new_id("AIPA"), "path": Path, "created": self.clock.time(), "roles": [], "tags": list(Tags)}
+        return {"InstanceProfile": self._instance_profile(InstanceProfileName)}
+
+    def _iam_get_instance_profile(self, InstanceProfileName):
+        if InstanceProfileName not in self.instance_profiles:
+            self._raise("iam", "NoSuchEntity", "GetInstanceProfile")
+        return {"InstanceProfile": self._instance_profile(InstanceProfileName)}
+
+    def _iam_list_instance_profiles(self, PathPrefix="/", Marker=None, **_):
+        # like IAM, the listing leaves out the tags
+        profiles = [self._instance_profile(name) for name, profile in self.instance_profiles.items() if profile["path"].startswith(PathPrefix)]
+        return {"InstanceProfiles": [dict(profile, Tags=[]) for profile in profiles], "IsTruncated": False}
+
+    def _iam_list_instance_profile_tags(self, InstanceProfileName, **_):
+        if InstanceProfileName not in self.instance_profiles:
+            self._raise("iam", "NoSuchEntity", "ListInstanceProfileTags")
+        return {"Tags": list(self.instance_profiles[InstanceProfileName]["tags"]), "IsTruncated": False}
+
+    def _iam_tag_instance_profile(self, InstanceProfileName, Tags):
+        if InstanceProfileName not in self.instance_profiles:
+            self._raise("iam", "NoSuchEntity", "TagInstanceProfile")
+        profile = self.instance_profiles[InstanceProfileName]
+        profile["tags"] = _merge_tags(profile["tags"], Tags)
+        return {}
+
+    def _iam_untag_instance_profile(self, InstanceProfileName, TagKeys):
+        profile = self.instance_profiles[InstanceProfileName]
+        profile["tags"] = [tag for tag in profile["tags"] if tag["Key"] not in TagKeys]
+        return {}
+
+    def _iam_add_role_to_instance_profile(self, InstanceProfileName, RoleName):
+        if InstanceProfileName not in self.instance_profiles or RoleName not in self.roles:
+            self._raise("iam", "NoSuchEntity", "AddRoleToInstanceProfile")
+        if self.instance_profiles[InstanceProfileName]["roles"]:
+            self._raise("iam", "LimitExceeded", "AddRoleToInstanceProfile")
+        self.instance_profiles[InstanceProfileName]["roles"].append(RoleName)
+        return {}
+
+    def _iam_remove_role_from_instance_profile(self, InstanceProfileName, RoleName):
+        profile = self.instance_profiles.get(InstanceProfileName)
+        if profile is None or RoleName not in profile["roles"]:
+            self._raise("iam", "NoSuchEntity", "RemoveRoleFromInstanceProfile")
+        profile["roles"].remove(RoleName)
+        return {}
+
+    def _iam_delete_instance_profile(self, InstanceProfileName):
+        profile = self.instance_profiles.get(InstanceProfileName)
+        if profile is None:
+            self._raise("iam", "NoSuchEntity", "DeleteInstanceProfile")
+        if profile["roles"]:
+            self._raise("iam", "DeleteConflict", "DeleteInstanceProfile")
+        del self.instance_profiles[InstanceProfileName]
+        return {}
+
+    # cloud9
+
+    def _cloud9_create_environment_ec2(self, name, instanceType, ownerArn=None, tags=(), subnetId=None, description=None, **_):
+        subnet_id = subnetId or "subnet-default"
+        if subnet_id not in self.subnets:
+            self._raise("cloud9", "BadRequestException", "CreateEnvironmentEC2", f"subnet {subnet_id} does not exist")
+        environment_id = self._new_id("")
+        instance_id = self._new_id("i-")
+        volume_id = self._new_id("vol-")
+        now = self._now()
+        zone = self.subnets[subnet_id][0]
+        failure = None
+        if self.subnets[subnet_id][1] <= 0:
+            failure = f"InsufficientFreeAddressesInSubnet: no free addresses in {subnet_id}"
+        elif self.zone_capacity.get(zone, 1) <= 0:
+            failure = f"InsufficientInstanceCapacity: insufficient {instanceType} capacity in {zone}"
+        if failure is not None:
+            # Cloud9 accepts the request; the environment fails once its stack does
+            self.environments[environment_id] = {
+                "id": environment_id,
+                "arn": f"arn:aws:cloud9:{self.region}:{self.account_id}:environment:{environment_id}",
+                "name": name, "description": description, "ownerArn": ownerArn or f"arn:aws:iam::{self.account_id}:root",
+                "type": "ec2", "connectionType": "CONNECT_SSM", "tags": list(tags), "members": [],
+                "instanceId": None, "failure": failure, "failsAt": now + self.timings["instance_launch"],
+            }
+            return {"environmentId": environment_id}
+        self.subnets[subnet_id][1] -= 1
+        if zone in self.zone_capacity:
+            self.zone_capacity[zone] -= 1
+        self.environments[environment_id] = {
+            "id": environment_id,
+            "arn": f"arn:aws:cloud9:{self.region}:{self.account_id}:environment:{environment_id}",
+            "name": name,
+            "description": description,
+            "ownerArn": ownerArn or f"arn:aws:iam::{self.account_id}:root",
+            "type": "ec2",
+            "connectionType": "CONNECT_SSM",
+            "tags": list(tags),
+            "members": [],
+            "instanceId": instance_id,
+        }
+        self.instances[instance_id] = {
+            "InstanceId": instance_id,
+            "InstanceType": instanceType,
+            "SubnetId": subnet_id,
+            "VolumeId": volume_id,
+            "environmentId": environment_id,
+            "launchAt": now + self.timings["instance_launch"],
+            "terminateAt": None,
+            # Cloud9 names the instance after the environment
+            "tags": [{"Key": "aws:cloud9:environment", "Value": environment_id}, {"Key": "Name", "Value": f"aws-cloud9-{name}-{environment_id}"}] + [tag for tag in tags],
+        }
+        self.volumes[volume_id] = {"VolumeId": volume_id, "Size": 10, "modification": None, "tags": []}
+        association_id = self._new_id("iip-assoc-")
+        self.associations[association_id] = {
+            "AssociationId": association_id,
+            "InstanceId": instance_id,
+            "Profile": "AWSCloud9SSMInstanceProfile",
+            "state": "associated",
+            "target": "associated",
+            "changesAt": now,
+        }
+        return {"environmentId": environment_id}
+
+    def _environment(self, environment_id):
+        environment = self.environments[environment_id]
+        lifecycle = {"status": "DELETING" if environment.get("deleting") else "READY"}
+        if environment["instanceId"] is None and not environment.get("deleting"):
+            if self._now() >= environment["failsAt"]:
+                lifecycle = {"status": "CREATE_FAILED", "reason": environment["failure"], "failureResource": "Instance"}
+            else:
+                lifecycle = {"status": "CREATING"}
+        return {key: environment[key] for key in ("id", "arn", "name", "description", "ownerArn", "type", "connectionType")} | {"lifecycle": lifecycle}
+
+    def _cloud9_describe_environments(self, environmentIds):
+        self._reap()
+        found = [self._environment(environment_id) for environment_id in environmentIds if environment_id in self.environments]
+        if not found:
+            self._raise("cloud9", "NotFoundException", "DescribeEnvironments")
+        return {"environments": found}
+
+    def _cloud9_list_environments(self, nextToken=None, maxResults=25):
+        self._reap()
+        ids = sorted(self.environments)
+        start = int(nextToken or 0)
+        response = {"environmentIds": ids[start:start + maxResults]}
+        if start + maxResults < len(ids):
+            response["nextToken"] = str(start + maxResults)
+        return response
+
+    def _cloud9_update_environment(self, environmentId, name=None, description=None):
+        environment = self.environments[environmentId]
+        if name is not None:
+            environment["name"] = name
+        if description is not None:
+            environment["description"] = description
+        return {}
+
+    def _cloud9_create_environment_membership(self, environmentId, userArn, permissions):
+        self.environments[environmentId]["members"].append((userArn, permissions))
+        return {"membership": {"environmentId": environmentId, "userArn": userArn, "permissions": permissions}}
+
+    def _cloud9_tag_resource(self, ResourceARN, Tags):
+        environment = self.environments[ResourceARN.split(":")[-1]]
+        environment["tags"] = _merge_tags(environment["tags"], Tags)
+        return {}
+
+    def _cloud9_untag_resource(self, ResourceARN, TagKeys):
+        environment = self.environments[ResourceARN.split(":")[-1]]
+        environment["tags"] = [tag for tag in environment["tags"] if tag["Key"] not in TagKeys]
+        return {}
+
+    def _cloud9_list_tags_for_resource(self, ResourceARN):
+        return {"Tags": self.environments[ResourceARN.split(":")[-1]]["tags"]}
+
+    def _cloud9_delete_environment(self, environmentId):
+        self._reap()
+        environment = self.environments.get(environmentId)
+        if environment is None:
+            self._raise("cloud9", "NotFoundException", "DeleteEnvironment")
+        environment["deleting"] = True
+        if environment["instanceId"] is None:
+            return {}
+        instance = self.instances[environment["instanceId"]]
+        instance["terminateAt"] = self._now() + self.timings["environment_delete"]
+        return {}
+
+    def _reap(self):
+        now = self._now()
+        for environment_id, environment in list(self.environments.items()):
+            if environment["instanceId"] is None:
+                if environment.get("deleting"):
+                    del self.environments[environment_id]
+                continue
+            instance = self.instances[environment["instanceId"]]
+            if instance["terminateAt"] is not None and instance["terminateAt"] <= now:
+                del self.environments[environment_id]
+                if not instance.get("released"):
+                    instance["released"] = True
+                    self.subnets[instance["SubnetId"]][1] += 1
+
+    # ec2
+
+    def _instance_state(self, instance) -> Optional[str]:
+        now = self._now()
+        if now < instance["launchAt"]:
+            return None
+        if instance["terminateAt"] is not None:
+            return "terminated" if now >= instance["terminateAt"] else "shutting-down"
+        transition = instance.get("transition")
+        if transition is not None:
+            # (state while changing, final state, simulated time it settles)
+            return transition[1] if now >= transition[2] else transition[0]
+        return "running"
+
+    def _instance(self, instance, state):
+        return {
+            "InstanceId": instance["InstanceId"],
+            "InstanceType": instance["InstanceType"],
+            "SubnetId": instance["SubnetId"],
+            "Placement": {"AvailabilityZone": f"{self.region}a"},
+            "State": {"Name": state},
+            "Tags": instance["tags"],
+            "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"VolumeId": instance["VolumeId"]}}],
+            "NetworkInterfaces": [{"NetworkInterfaceId": instance["InstanceId"].replace("i-", "eni-")}],
+            "SecurityGroups": [{"GroupId": "sg-" + instance["environmentId"]}],
+        }
+
+    def _ec2_describe_instances(self, Filters=(), InstanceIds=None, **_):
+        matches = []
+        for instance in self.instances.values():
+            state = self._instance_state(instance)
+            if state is None:
+                continue
+            if InstanceIds is not None and instance["InstanceId"] not in InstanceIds:
+                continue
+            tags = {tag["Key"]: tag["Value"] for tag in instance["tags"]}
+            keep = True
+            for instance_filter in Filters:
+                name, values = instance_filter["Name"], instance_filter["Values"]
+                if name.startswith("tag:"):
+                    keep = tags.get(name[4:]) in values
+                elif name == "instance-state-name":
+                    keep = state in values
+                elif name == "instance-id":
+                    keep = instance["InstanceId"] in values
+                elif name == "instance-type":
+                    keep = instance["InstanceType"] in values
+                if not keep:
+                    break
+            if keep:
+                matches.append(self._instance(instance, state))
+        return {"Reservations": [{"Instances": [instance]} for instance in matches]}
+
+    def _taggable(self, resource_id) -> Dict[str, Any]:
+        # instances and volumes keep their tags with them; network interfaces and
+        # security groups only exist as tags
+        if resource_id in self.instances:
+            return self.instances[resource_id]
+        if resource_id in self.volumes:
+            return self.volumes[resource_id]
+        return self.ec2_tags.setdefault(resource_id, {"tags": []})
+
+    def _ec2_create_tags(self, Resources, Tags):
+        for resource_id in Resources:
+            resource = self._taggable(resource_id)
+            resource["tags"] = _merge_tags(resource["tags"], Tags)
+        return {}
+
+    def _ec2_delete_tags(self, Resources, Tags):
+        keys = {tag["Key"] for tag in Tags}
+        for resource_id in Resources:
+            resource = self._taggable(resource_id)
+            resource["tags"] = [tag for tag in resource["tags"] if tag["Key"] not in keys]
+        return {}
+
+    def _ec2_stop_instances(self, InstanceIds):
+        for instance_id in InstanceIds:
+            instance = self.instances[instance_id]
+            if self._instance_state(instance) in ("running", "pending"):
+                instance["transition"] = ("stopping", "stopped", self._now() + self.timings["instance_stop"])
+        return {"StoppingInstances": [{"InstanceId": instance_id} for instance_id in InstanceIds]}
+
+    def _ec2_start_instances(self, InstanceIds):
+        for instance_id in InstanceIds:
+            instance = self.instances[instance_id]
+            if self._instance_state(instance) != "stopped":
+                self._raise("ec2", "IncorrectInstanceState", "StartInstances")
+            instance["transition"] = ("pending", "running", self._now() + self.timings["instance_start"])
+        return {"StartingInstances": [{"InstanceId": instance_id} for instance_id in InstanceIds]}
+
+    def _ec2_modify_instance_attribute(self, InstanceId, InstanceType=None, **_):
+        if InstanceType is not None:
+            if self._instance_state(self.instances[InstanceId]) != "stopped":
+                self._raise("ec2", "IncorrectInstanceState", "ModifyInstanceAttribute")
+            self.instances[InstanceId]["InstanceType"] = InstanceType["Value"]
+        return {}
+
+    def _ec2_modify_volume(self, VolumeId, Size):
+        volume = self.volumes[VolumeId]
+        now = self._now()
+        volume["modification"] = {"start": now, "target": Size, "optimizedAt": now + self.timings["volume_optimization"]}
+        volume["Size"] = Size
+        return {"VolumeModification": {"VolumeId": VolumeId, "ModificationState": "modifying", "TargetSize": Size}}
+
+    def _ec2_describe_volumes(self, VolumeIds):
+        return {"Volumes": [{"VolumeId": volume_id, "Size": self.volumes[volume_id]["Size"]} for volume_id in VolumeIds if volume_id in self.volumes]}
+
+    def _ec2_describe_volumes_modifications(self, VolumeIds):
+        modifications = []
+        for volume_id in VolumeIds:
+            modification = self.volumes[volume_id]["modification"]
+            if modification is None:
+                continue
+            elapsed = self._now() - modification["start"]
+            if self._now() >= modification["optimizedAt"]:
+                state, progress = "completed", 100
+            elif elapsed >= self.timings["volume_modification"]:
+                state, progress = "optimizing", int(100 * elapsed / (modification["optimizedAt"] - modification["start"]))
+            else:
+                state, progress = "modifying", 0
+            modifications.append({
+                "VolumeId": volume_id,
+                "ModificationState": state,
+                "Progress": progress,
+                "TargetSize": modification["target"],
+                "StartTime": datetime.fromtimestamp(self.clock.time() - (self._now() - modification["start"]), tz=timezone.utc),
+            })
+        return {"VolumesModifications": modifications}
+
+    def _association(self, association):
+        if association["state"] != association["target"] and self._now() >= association["changesAt"]:
+            association["state"] = association["target"]
+        path = self.instance_profiles.get(association["Profile"], {}).get("path", "/")
+        return {
+            "AssociationId": association["AssociationId"],
+            "InstanceId": association["InstanceId"],
+            "IamInstanceProfile": {"Arn": f"arn:aws:iam::{self.account_id}:instance-profile{path}{association['Profile']}"},
+            "State": association["state"],
+        }
+
+    def _ec2_describe_iam_instance_profile_associations(self, AssociationIds=None, Filters=()):
+        if AssociationIds is not None:
+            missing = [association_id for association_id in AssociationIds if association_id not in self.associations]
+            if missing:
+                self._raise("ec2", "InvalidAssociationID.NotFound", "DescribeIamInstanceProfileAssociations")
+            return {"IamInstanceProfileAssociations": [self._association(self.associations[association_id]) for association_id in AssociationIds]}
+        instance_ids = next((instance_filter["Values"] for instance_filter in Filters if instance_filter["Name"] == "instance-id"), None)
+        associations = [
+            self._association(association) for association in self.associations.values()
+            if (instance_ids is None or association["InstanceId"] in instance_ids)
+        ]
+        return {"IamInstanceProfileAssociations": [association for association in associations if association["State"] != "disassociated"]}
+
+    def _ec2_disassociate_iam_instance_profile(self, AssociationId):
+        association = self.associations[AssociationId]
+        association["state"], association["target"] = "disassociating", "disassociated"
+        association["changesAt"] = self._now() + self.timings["association"]
+        return {"IamInstanceProfileAssociation": self._association(association)}
+
+    def _ec2_associate_iam_instance_profile(self, IamInstanceProfile, InstanceId):
+        name = IamInstanceProfile["Name"]
+        profile = self.instance_profiles.get(name)
+        if profile is None or self.clock.time() - profile["created"] < self.timings["profile_propagation"]:
+            self._raise("ec2", "InvalidParameterValue", "AssociateIamInstanceProfile", f"Invalid IAM Instance Profile name {name}")
+        association_id = self._new_id("iip-assoc-")
+        self.associations[association_id] = {
+            "AssociationId": association_id,
+            "InstanceId": InstanceId,
+            "Profile": name,
+            "state": "associating",
+            "target": "associated",
+            "changesAt": self._now() + self.timings["association"],
+        }
+        return {"IamInstanceProfileAssociation": self._association(self.associations[association_id])}
+
+    def _ec2_replace_iam_instance_profile_association(self, IamInstanceProfile, AssociationId):
+        old = self.associations[AssociationId]
+        response = self._ec2_associate_iam_instance_profile(IamInstanceProfile, old["InstanceId"])
+        old["state"] = old["target"] = "disassociated"
+        return response
+
+    def _ec2_describe_instance_type_offerings(self, LocationType="region", Filters=(), **_):
+        types = next((instance_filter["Values"] for instance_filter in Filters if instance_filter["Name"] == "instance-type"), ["t3.micro"])
+        types = [instance_type for instance_type in types if self.instance_types is None or instance_type in self.instance_types]
+        return {"InstanceTypeOfferings": [
+            {"InstanceType": instance_type, "LocationType": LocationType, "Location": f"{self.region}{zone}"}
+            for instance_type in types for zone in "abc"
+        ]}
+
+    def _ec2_describe_subnets(self, SubnetIds=None, **_):
+        subnet_ids = SubnetIds or list(self.subnets)
+        if any(subnet_id not in self.subnets for subnet_id in subnet_ids):
+            self._raise("ec2", "InvalidSubnetID.NotFound", "DescribeSubnets")
+        return {"Subnets": [
+            {"SubnetId": subnet_id, "AvailabilityZone": self.subnets[subnet_id][0], "AvailableIpAddressCount": self.subnets[subnet_id][1]}
+            for subnet_id in subnet_ids
+        ]}
+
+    # ssm
+
+    def _ssm_online(self, instance_id, lag=0.0) -> bool:
+        instance = self.instances.get(instance_id)
+        if instance is None or self._instance_state(instance) != "running":
+            return False
+        return self._now() >= instance["launchAt"] + self.timings["ssm_registration"] + lag
+
+    def _ssm_get_inventory(self, Filters=(), **_):
+        instance_ids = Filters[0]["Values"] if Filters else list(self.instances)
+        return {"Entities": [{"Id": instance_id} for instance_id in instance_ids if self._ssm_online(instance_id, self.timings["inventory_lag"])]}
+
+    def _ssm_describe_instance_information(self, Filters=(), MaxResults=50, NextToken=None, **_):
+        instance_ids = next((instance_filter["Values"] for instance_filter in Filters if instance_filter["Key"] == "InstanceIds"), list(self.instances))
+        return {"InstanceInformationList": [
+            {"InstanceId": instance_id, "PingStatus": "Online"} for instance_id in instance_ids if self._ssm_online(instance_id)
+        ]}
+
+    def _ssm_describe_document(self, Name, **_):
+        if self.documents is not None and Name not in self.documents:
+            self._raise("ssm", "InvalidDocument", "DescribeDocument")
+        return {"Document": {"Name": Name, "Status": "Active", "DocumentType": "Command"}}
+
+    def _ssm_send_command(self, InstanceIds, DocumentName, Parameters=None, **_):
+        command_id = self._new_id("cmd-")
+        # "command:<document>" in timings overrides how long one document runs
+        duration = self.timings.get(f"command:{DocumentName}", self.timings["command"])
+        self.commands[command_id] = {
+            "InstanceIds": list(InstanceIds),
+            "DocumentName": DocumentName,
+            "Parameters": Parameters,
+            "startedAt": self._now(),
+            "doneAt": self._now() + duration,
+            "cancelled": False,
+        }
+        return {"Command": {"CommandId": command_id, "DocumentName": DocumentName, "Status": "Pending"}}
+
+    def _ssm_get_command_invocation(self, CommandId, InstanceId, **_):
+        command = self.commands.get(CommandId)
+        if command is None:
+            self._raise("ssm", "InvocationDoesNotExist", "GetCommandInvocation")
+        now = self._now()
+        done = now >= command["doneAt"]
+        # one line of output every 5 simulated seconds; documents named fail* fail
+        steps = int((min(now, command["doneAt"]) - command["startedAt"]) // 5)
+        stdout = f"ran {command['DocumentName']}\n" + "".join(f"step {step + 1}\n" for step in range(steps))
+        stderr = ""
+        if command["cancelled"]:
+            status = "Cancelled"
+        elif not done:
+            status = "InProgress"
+        elif command["DocumentName"].startswith("fail"):
+            status, stderr = "Failed", "error: simulated failure\n"
+        else:
+            status, stdout = "Success", stdout + "done\n"
+        return {
+            "CommandId": CommandId,
+            "InstanceId": InstanceId,
+            "DocumentName": command["DocumentName"],
+            "Status": status,
+            "StatusDetails": status,
+            "StandardOutputContent": stdout,
+            "StandardErrorContent": stderr,
+        }
+
+    def _ssm_cancel_command(self, CommandId, InstanceIds=None):
+        self.commands[CommandId]["cancelled"] = True
+        return {}
+
+    def _ssm_get_parameter(self, Name, **_):
+        if Name not in self.parameters:
+            self._raise("ssm", "ParameterNotFound", "GetParameter")
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name], "Type": "String"}}
+
+    def _ssm_put_parameter(self, Name, Value, Overwrite=False, **_):
+        if Name in self.parameters and not Overwrite:
+            self._raise("ssm", "ParameterAlreadyExists", "PutParameter")
+        self.parameters[Name] = Value
+        return {"Version": 1}
+
+    def _ssm_get_parameters_by_path(self, Path, Recursive=False, MaxResults=10, NextToken=None):
+        path = Path.rstrip("/") + "/"
+        names = sorted(name for name in self.parameters if name.startswith(path) and (Recursive or "/" not in name[len(path):]))
+        start = int(NextToken or 0)
+        response = {"Parameters": [{"Name": name, "Type": "String", "Value": self.parameters[name]} for name in names[start:start + MaxResults]]}
+        if start + MaxResults < len(names):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+    def _ssm_delete_parameter(self, Name):
+        if self.parameters.pop(Name, None) is None:
+            self._raise("ssm", "ParameterNotFound", "DeleteParameter")
+        return {}
+
+    # sts
+
+    def _sts_get_caller_identity(self):
+        return {"Account": self.account_id, "Arn": f"arn:aws:iam::{self.account_id}:root", "UserId": self.account_id}
+
+
+def _merge_tags(existing, new):
+    merged = {tag["Key"]: tag["Value"] for tag in existing}
+    merged.update({tag["Key"]: tag["Value"] for tag in new})
+    return [{"Key": key, "Value": value} for key, value in merged.items()]
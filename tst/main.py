@@ -1,4 +1,3 @@
-import subprocess
 import json
 from os import listdir
 from os.path import isfile, join
@@ -6,6 +5,8 @@ import requests
 import random
 import string
 
+import runner
+
 def setup():
     response = requests.get('http://169.254.169.254/latest/meta-data/iam/security-credentials/AWSCloud9SSMAccessRole')
     credential_object = response.json()
@@ -36,12 +37,8 @@ def main():
     except Exception as e:
         print(e)
         raise(e)
-    process = subprocess.run(['sam', 'local', 'invoke', 'TestEntrypoint', '--event', 'sam-tests/00_create.json'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    output = process.stdout
-    parsed_output = json.loads(output)
-    environment_id = parsed_output['callbackContext']['ENVIRONMENT_ID']
-    environment_arn = parsed_output['resourceModel']['Arn']
-    print(f'\n\n\n{environment_id}')
+    # follows the create to completion in-process instead of one `sam local invoke` per step
+    return runner.main(['--aws', '--timeline', 'sam-tests/00_create.json'])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    raise SystemExit(main())
\ No newline at end of file
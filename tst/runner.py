@@ -0,0 +1,300 @@
+"""Runs handler test events in-process, following them to completion the way CloudFormation does.
+
+Replaces `sam local invoke` for the edit-run loop. Each event file is passed to
+`test_entrypoint` directly, and the returned resourceModel and callbackContext
+are fed back in after callbackDelaySeconds until the event is no longer
+IN_PROGRESS. By default this runs against the stand-in backend in fake_aws.py
+on a compressed clock.
+Events run concurrently in a process pool, and each run's stage timeline is
+reported.
+
+A directory is run as one sequence, with its files in name order:
+- sam-tests style events (credentials/action/request) are used as they are
+- contract test inputs (example_inputs/inputs_<n>_create|update|invalid.json)
+  are wrapped in CREATE, UPDATE and DELETE events
+
+Each step gets the Arn and EnvironmentId of the resource the step before it
+created.
+
+    python tst/runner.py
+    python tst/runner.py --copies 20 --workers 8 sam-tests/00_create.json
+    python tst/runner.py --timeline --timing ssm_registration=90 sam-tests
+    python tst/runner.py --aws sam-tests/00_create.json
+"""
+import argparse
+import copy
+import json
+import logging
+import re
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, MutableMapping, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_PATHS = [ROOT / "sam-tests", ROOT / "example_inputs"]
+CONTRACT_INPUT = re.compile(r"inputs_(\d+)_(create|update|invalid)\.json$")
+PLACEHOLDER_CREDENTIALS = {"accessKeyId": "local", "secretAccessKey": "local", "sessionToken": "local"}
+READ_ONLY_PROPERTIES = ("Arn", "EnvironmentId")
+BAR_WIDTH = 40
+
+# Set up once per worker process by _start_worker
+_WORKER: Dict[str, Any] = {}
+
+
+def _read(path: Path) -> Optional[MutableMapping[str, Any]]:
+    text = path.read_text()
+    return json.loads(text) if text.strip() else None
+
+
+def _event(action: str, model: Optional[Mapping[str, Any]], token: str, region: str) -> MutableMapping[str, Any]:
+    return {
+        "credentials": dict(PLACEHOLDER_CREDENTIALS),
+        "action": action,
+        "region": region,
+        "request": {"clientRequestToken": token, "desiredResourceState": model, "region": region},
+        "callbackContext": None,
+    }
+
+
+def load_sequences(paths: List[Path], region: str) -> List[Tuple[str, List[Tuple[str, MutableMapping[str, Any], bool]]]]:
+    # [(name, [(step name, event, expected to succeed)])]; files that are neither
+    # events nor contract test inputs are skipped
+    sequences = []
+    for path in paths:
+        files = sorted(path.glob("*.json")) if path.is_dir() else [path]
+        steps = []
+        contract: Dict[str, Dict[str, Mapping[str, Any]]] = {}
+        for file in files:
+            content = _read(file)
+            if content is None:
+                print(f"empty file: {file}", file=sys.stderr)
+            elif "action" in content and "request" in content:
+                steps.append((file.name, content, True))
+            elif CONTRACT_INPUT.search(file.name):
+                number, kind = CONTRACT_INPUT.search(file.name).groups()
+                contract.setdefault(number, {})[kind] = content
+            else:
+                print(f"not a test event: {file}", file=sys.stderr)
+        if steps:
+            directory = path if path.is_dir() else path.parent
+            sequences.append((str(directory.relative_to(ROOT) if directory.is_relative_to(ROOT) else directory), steps))
+        for number, inputs in sorted(contract.items()):
+            if "create" in inputs:
+                name = f"inputs_{number}"
+                steps = [(f"{name}_create", _event("CREATE", inputs["create"], f"{name}-create", region), True)]
+                if "update" in inputs:
+                    steps.append((f"{name}_update", _event("UPDATE", inputs["update"], f"{name}-update", region), True))
+                steps.append((f"{name}_delete", _event("DELETE", None, f"{name}-delete", region), True))
+                sequences.append((name, steps))
+            if "invalid" in inputs:
+                name = f"inputs_{number}_invalid"
+                sequences.append((name, [(name, _event("CREATE", inputs["invalid"], name, region), False)]))
+    return sequences
+
+
+def _chain(event: MutableMapping[str, Any], model: Optional[Mapping[str, Any]], copy_index: int) -> MutableMapping[str, Any]:
+    # The event for one copy of one step, pointed at the resource the step before created
+    event = copy.deepcopy(event)
+    request = event["request"]
+    if copy_index:
+        request["clientRequestToken"] = f"{request.get('clientRequestToken', 'token')}-{copy_index}"
+        if (request.get("desiredResourceState") or {}).get("Name"):
+            request["desiredResourceState"]["Name"] += f"-{copy_index}"
+    if model is not None:
+        desired = request.get("desiredResourceState") or dict(model)
+        for name in READ_ONLY_PROPERTIES:
+            if name in model:
+                desired.setdefault(name, model[name])
+        request["desiredResourceState"] = desired
+        if event["action"] == "UPDATE":
+            request.setdefault("previousResourceState", dict(model))
+    return event
+
+
+def _start_worker(options: Mapping[str, Any]) -> None:
+    from fake_aws import FakeBackend, ScaledClock
+    from benchmark import PACKAGE_MODULES
+    from richard_cloud9_customec2 import handlers, instrumentation
+    import cloudformation_cli_python_lib.resource as resource_module
+
+    logging.basicConfig()
+    if not options["verbose"]:
+        # failures are reported with the run's results
+        logging.getLogger().handlers[0].setLevel(logging.CRITICAL)
+    if not options["metrics"]:
+        logging.getLogger(instrumentation.METRICS_LOGGER).disabled = True
+    if options["budget"] is not None:
+        handlers.CREATE_TIME_BUDGET_SECONDS = options["budget"]
+    _WORKER["handlers"] = handlers
+    if options["aws"]:
+        # real calls with the events' credentials; only callback delays are compressed
+        _WORKER["clock"] = None
+        _WORKER["backend"] = None
+        return
+    clock = ScaledClock(options["scale"])
+    clock.install(*PACKAGE_MODULES)
+    backend = FakeBackend(clock=clock, latency=options["latency"], timings=options["timings"], region=options["region"])
+    backend.throttle_rate = options["throttle_rate"]
+    # the test entrypoint builds its session from the event's credentials
+    resource_module._get_boto_session = lambda credentials, region=None: backend.session()
+    _WORKER["clock"] = clock
+    _WORKER["backend"] = backend
+
+
+def _timeline(response: Mapping[str, Any], started: float) -> List[List[Any]]:
+    # [[stage, start, end, invocations, handler ms]] from the context's TIMELINE,
+    # in seconds from the start of the event
+    from richard_cloud9_customec2.context import CallbackContext
+
+    timeline = CallbackContext.load(response.get("callbackContext")).timeline or {}
+    return [
+        [stage, entry[0] - started, entry[1] - started, entry[2], entry[3]]
+        for stage, entry in sorted(timeline.items(), key=lambda item: item[1][0])
+    ]
+
+
+def invoke_until_done(event: MutableMapping[str, Any], options: Mapping[str, Any]) -> Tuple[Mapping[str, Any], Dict[str, Any]]:
+    # One event to completion: (last response, run statistics)
+    handlers = _WORKER["handlers"]
+    clock = _WORKER["clock"]
+    now = clock.time if clock is not None else time.time
+    sleep = clock.sleep if clock is not None else lambda seconds: time.sleep(seconds * options["scale"])
+    started = now()
+    real_started = time.perf_counter()
+    invocations = 0
+    context = None
+    while True:
+        invocations += 1
+        response = handlers.test_entrypoint(event, None)
+        context = response.get("callbackContext") or context
+        if response.get("status") != "IN_PROGRESS":
+            break
+        # CloudFormation re-invokes with the model and context the handler returned
+        event["callbackContext"] = response.get("callbackContext")
+        if response.get("resourceModel") is not None:
+            event["request"]["desiredResourceState"] = response["resourceModel"]
+        sleep(response.get("callbackDelaySeconds") or 0)
+    statistics = {
+        "status": response.get("status"),
+        "errorCode": response.get("errorCode"),
+        "message": response.get("message"),
+        "invocations": invocations,
+        "seconds": now() - started,
+        "real_seconds": time.perf_counter() - real_started,
+        "timeline": _timeline({"callbackContext": context}, started),
+    }
+    return response, statistics
+
+
+def run_sequence(work: Tuple[str, List[Tuple[str, MutableMapping[str, Any], bool]], int], options: Mapping[str, Any]) -> Dict[str, Any]:
+    name, steps, copy_index = work
+    backend = _WORKER["backend"]
+    model = None
+    results = []
+    for step, event, expect_success in steps:
+        calls_before = Counter(backend.calls) if backend is not None else Counter()
+        response, statistics = invoke_until_done(_chain(event, model, copy_index), options)
+        if backend is not None:
+            calls = Counter(backend.calls)
+            calls.subtract(calls_before)
+            statistics["api_calls"] = sum(calls.values())
+        statistics.update(step=step, action=event["action"], expected=expect_success)
+        statistics["passed"] = (statistics["status"] == "SUCCESS") == expect_success
+        results.append(statistics)
+        if statistics["status"] != "SUCCESS":
+            break
+        model = response.get("resourceModel") or model
+    return {"sequence": name, "copy": copy_index, "steps": results}
+
+
+def _bar(start: float, end: float, total: float) -> str:
+    scale = BAR_WIDTH / max(total, 1e-9)
+    left = int(start * scale)
+    return " " * left + "#" * max(1, int(end * scale) - left)
+
+
+def report(runs: List[Dict[str, Any]], show_timelines: bool) -> None:
+    by_step: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for run in runs:
+        for step in run["steps"]:
+            by_step.setdefault((run["sequence"], step["step"]), []).append(step)
+            if show_timelines:
+                print(f"-- {run['sequence']}/{step['step']} copy {run['copy']}: {step['status']} in {step['seconds']:.0f}s, {step['invocations']} invocations")
+                width = max((len(entry[0]) for entry in step["timeline"]), default=0)
+                for stage, start, end, invocations, busy_ms in step["timeline"]:
+                    print(f"   {stage:{width}s} {start:7.1f}s {end:7.1f}s {invocations:3d}x {busy_ms:6d}ms |{_bar(start, end, step['seconds']):{BAR_WIDTH}s}|")
+    for (sequence, step_name), steps in by_step.items():
+        passed = sum(1 for step in steps if step["passed"])
+        seconds = [step["seconds"] for step in steps]
+        print(f"== {sequence}/{step_name} ({steps[0]['action']}): {passed}/{len(steps)} passed")
+        print(f"   time          {sum(seconds) / len(seconds):.0f}s mean, {max(seconds):.0f}s max ({max(step['real_seconds'] for step in steps):.1f}s real)")
+        print(f"   invocations   {sum(step['invocations'] for step in steps) / len(steps):.1f} mean")
+        if "api_calls" in steps[0]:
+            print(f"   api calls     {sum(step['api_calls'] for step in steps) / len(steps):.1f} mean")
+        stages: Dict[str, List[float]] = {}
+        for step in steps:
+            for stage, start, end, _, _ in step["timeline"]:
+                stages.setdefault(stage, []).append(end - start)
+        width = max((len(stage) for stage in stages), default=0)
+        for stage, durations in stages.items():
+            print(f"      {stage:{width}s} {sum(durations) / len(durations):7.1f}s mean")
+        for message in sorted({step["message"] for step in steps if not step["passed"]}):
+            print(f"   FAILED: {message}")
+
+
+def main(argv=None) -> int:
+    from fake_aws import DEFAULT_TIMINGS
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", type=Path, help="event files or directories (default: sam-tests and example_inputs)")
+    parser.add_argument("--copies", type=int, default=1, help="run every sequence this many times")
+    parser.add_argument("--workers", type=int, default=4, help="processes running sequences at once")
+    parser.add_argument("--aws", action="store_true", help="call AWS with the events' credentials instead of the stand-in backend")
+    parser.add_argument("--scale", type=float, default=None, help="real seconds per simulated second (default 0.01; 1 with --aws)")
+    parser.add_argument("--latency", type=float, default=0.1, help="simulated seconds per API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of API calls throttled")
+    parser.add_argument("--timing", action="append", default=[], metavar="NAME=SECONDS", help=f"override one of {', '.join(DEFAULT_TIMINGS)}")
+    parser.add_argument("--budget", type=float, default=None, help="CREATE_TIME_BUDGET_SECONDS for the run")
+    parser.add_argument("--region", default="us-east-1", help="region of contract test input events")
+    parser.add_argument("--timeline", action="store_true", help="print every run's stage timeline")
+    parser.add_argument("--metrics", action="store_true", help="print the handlers' EMF metric lines")
+    parser.add_argument("--verbose", action="store_true", help="show the handlers' log output")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    paths = args.paths or [path for path in DEFAULT_PATHS if path.exists()]
+    sequences = load_sequences([path.resolve() for path in paths], args.region)
+    if not sequences:
+        print("no test events found", file=sys.stderr)
+        return 1
+    options = {
+        "aws": args.aws,
+        "scale": args.scale if args.scale is not None else (1.0 if args.aws else 0.01),
+        "latency": args.latency,
+        "throttle_rate": args.throttle_rate,
+        "timings": {name: float(value) for name, value in (timing.split("=", 1) for timing in args.timing)},
+        "budget": args.budget,
+        "region": args.region,
+        "metrics": args.metrics,
+        "verbose": args.verbose,
+    }
+    work = [(name, steps, copy_index) for copy_index in range(args.copies) for name, steps in sequences]
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_start_worker, initargs=(options,)) as pool:
+        runs = list(pool.map(run_sequence, work, [options] * len(work)))
+    if args.json:
+        print(json.dumps(runs, indent=2))
+    else:
+        report(runs, args.timeline)
+        print(f"== {len(runs)} runs in {time.perf_counter() - started:.1f}s")
+    return 0 if all(step["passed"] for run in runs for step in run["steps"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+import pytest
+from cloudformation_cli_python_lib import exceptions
+
+from richard_cloud9_customec2.changes import MANAGED_TAG_KEY, OWNER_TAG, PROFILE_TAG, plan_update, tag_list
+from richard_cloud9_customec2.models import ResourceModel
+
+BASE = {
+    "Name": "dev",
+    "Description": "workspace",
+    "InstanceType": "t3.small",
+    "VolumeSize": 10,
+    "PermissionsPolicy": "arn:aws:iam::aws:policy/ReadOnlyAccess",
+    "Tags": [{"Key": "team", "Value": "a"}, {"Key": "cost", "Value": "1"}],
+}
+
+
+def model(**changes):
+    properties = dict(BASE, **changes)
+    return ResourceModel._deserialize({key: value for key, value in properties.items() if value is not None})
+
+
+def test_no_changes():
+    plan = plan_update(model(), model())
+    assert plan.describe() == []
+
+
+def test_environment_properties():
+    plan = plan_update(model(), model(Name="prod", Description=None))
+    assert plan.environment == {"name": "prod", "description": ""}
+    assert plan.instance_type is None
+    assert plan.volume_size is None
+
+
+def test_instance_type_and_volume():
+    plan = plan_update(model(), model(InstanceType="m5.large", VolumeSize=20))
+    assert plan.environment == {}
+    assert plan.instance_type == "m5.large"
+    assert plan.volume_size == 20
+
+
+def test_unset_properties_are_left_alone():
+    plan = plan_update(model(), model(Name=None, InstanceType=None, VolumeSize=None))
+    assert plan.environment == {}
+    assert plan.instance_type is None
+    assert plan.volume_size is None
+
+
+def test_volume_never_shrinks():
+    with pytest.raises(exceptions.InvalidRequest):
+        plan_update(model(), model(VolumeSize=8))
+
+
+def test_tags():
+    desired = model(Tags=[{"Key": "team", "Value": "b"}, {"Key": "new", "Value": "x"}])
+    plan = plan_update(model(), desired)
+    assert plan.tags_to_set == {"team": "b", "new": "x"}
+    assert plan.tags_to_remove == ["cost"]
+
+
+def test_internal_tags_are_never_removed():
+    previous = model(Tags=tag_list({"team": "a", MANAGED_TAG_KEY: "true", PROFILE_TAG: "p", OWNER_TAG: "o"}))
+    plan = plan_update(previous, model(Tags=[{"Key": "team", "Value": "a"}]))
+    assert plan.tags_to_set == {}
+    assert plan.tags_to_remove == []
+
+
+def test_policy_swap():
+    plan = plan_update(model(), model(PermissionsPolicy="arn:aws:iam::aws:policy/PowerUserAccess"))
+    assert plan.policy_to_attach == "arn:aws:iam::aws:policy/PowerUserAccess"
+    assert plan.policy_to_detach == "arn:aws:iam::aws:policy/ReadOnlyAccess"
+    plan = plan_update(model(), model(PermissionsPolicy=None))
+    assert plan.policy_to_attach is None
+    assert plan.policy_to_detach == "arn:aws:iam::aws:policy/ReadOnlyAccess"
+
+
+def test_without_previous_model():
+    plan = plan_update(None, model())
+    assert plan.environment == {"name": "dev", "description": "workspace"}
+    assert plan.instance_type == "t3.small"
+    assert plan.volume_size == 10
+    assert plan.tags_to_set == {"team": "a", "cost": "1"}
+    assert plan.policy_to_attach == "arn:aws:iam::aws:policy/ReadOnlyAccess"
+    assert plan.policy_to_detach is None
@@ -0,0 +1,37 @@
+from collections import OrderedDict
+
+import boto3
+from cloudformation_cli_python_lib import SessionProxy
+
+from richard_cloud9_customec2 import clients
+
+
+def _session(index: int) -> SessionProxy:
+    return SessionProxy(boto3.Session(
+        aws_access_key_id=f"AKIDTEST{index:04d}",
+        aws_secret_access_key="secret",
+        aws_session_token=f"token-{index}",
+        region_name="us-east-1",
+    ))
+
+
+def test_cache_is_capped(monkeypatch):
+    monkeypatch.setattr(clients, "_CLIENTS", OrderedDict())
+    monkeypatch.setattr(clients, "MAX_CLIENTS", 3)
+    sessions = [_session(index) for index in range(5)]
+    for session in sessions:
+        clients.get_client(session, "ssm")
+    assert len(clients._CLIENTS) == 3
+
+
+def test_least_recently_used_is_evicted(monkeypatch):
+    monkeypatch.setattr(clients, "_CLIENTS", OrderedDict())
+    monkeypatch.setattr(clients, "MAX_CLIENTS", 2)
+    first, second, third = (_session(index) for index in range(3))
+    first_client = clients.get_client(first, "ssm")
+    second_client = clients.get_client(second, "ssm")
+    # using the first client again makes the second the least recently used
+    assert clients.get_client(first, "ssm") is first_client
+    clients.get_client(third, "ssm")
+    assert clients.get_client(first, "ssm") is first_client
+    assert clients.get_client(second, "ssm") is not second_client
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from richard_cloud9_customec2.context import CONTEXT_VERSION, VERSION_KEY, CallbackContext
+from richard_cloud9_customec2.executor import DONE
+from richard_cloud9_customec2.interface import CommandSent, EnvironmentCreated
+
+LEGACY = {
+    "LOCAL_STATUS": {"Type": "CommandSent"},
+    "ENVIRONMENT_ID": "env-1",
+    "INSTANCE_ID": "i-1",
+    "COMMAND_ID": "cmd-1",
+    "DOCUMENTS": ["doc-a", "doc-b"],
+    "TASKS": {"TagInstance": DONE, "AttachPolicy": DONE},
+    "POLL": {"Stage": "CommandSent", "Attempt": 3, "Started": 1700000000.0},
+    "TIMELINE": {
+        "EnvironmentCreated": [1700000000.0, 1700000012.5, 2, 140],
+        "CommandSent": [1700000013.0, 1700000030.0, 3, 90],
+    },
+    "SOMETHING_ELSE": {"kept": True},
+}
+
+
+def test_legacy_context_is_migrated():
+    context = CallbackContext.load(LEGACY)
+    assert isinstance(context.stage, CommandSent)
+    assert context.environment_id == "env-1"
+    assert context.instance_id == "i-1"
+    assert context.command_id == "cmd-1"
+    assert context.documents == ["doc-a", "doc-b"]
+    assert context.tasks == {"AttachPolicy": DONE, "TagInstance": DONE}
+    assert context.poll == LEGACY["POLL"]
+    assert context.timeline == LEGACY["TIMELINE"]
+    assert context.extra == {"SOMETHING_ELSE": {"kept": True}}
+
+
+def test_legacy_context_mid_create_keeps_its_role():
+    assert CallbackContext.load(LEGACY).legacy_profile is True
+    # nothing had been created yet, so there is no role to finish on
+    assert CallbackContext.load({"TASKS": {}}).legacy_profile is None
+
+
+def test_migrated_context_round_trips():
+    context = CallbackContext.load(LEGACY)
+    encoded = json.loads(json.dumps(context._serialize()))
+    assert encoded[VERSION_KEY] == CONTEXT_VERSION
+    assert "LOCAL_STATUS" not in encoded
+    reloaded = CallbackContext.load(encoded)
+    assert dict(reloaded) == dict(context)
+    assert reloaded._serialize() == context._serialize()
+
+
+def test_mapping_interface_uses_legacy_keys():
+    context = CallbackContext()
+    context["LOCAL_STATUS"] = {"Type": "EnvironmentCreated"}
+    context["ENVIRONMENT_ID"] = "env-1"
+    assert isinstance(context.stage, EnvironmentCreated)
+    assert set(context) == {"LOCAL_STATUS", "ENVIRONMENT_ID"}
+    del context["ENVIRONMENT_ID"]
+    assert "ENVIRONMENT_ID" not in context
+    with pytest.raises(KeyError):
+        context["ENVIRONMENT_ID"]
+
+
+def test_only_done_tasks_are_stored():
+    context = CallbackContext(tasks={"TagInstance": DONE, "AttachPolicy": "FAILED"})
+    assert CallbackContext.load(context._serialize()).tasks == {"TagInstance": DONE}
+
+
+def test_empty_context_loads():
+    assert len(CallbackContext.load(None)) == 0
+    assert len(CallbackContext.load({})) == 0
+
+
+def test_newer_version_is_rejected():
+    with pytest.raises(ValueError):
+        CallbackContext.load({VERSION_KEY: CONTEXT_VERSION + 1})
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from richard_cloud9_customec2.executor import DONE, TASKS_KEY, TaskNotReady, run_tasks
+
+
+class Recorder:
+    def __init__(self):
+        self.ran = []
+        self._lock = threading.Lock()
+
+    def task(self, name, error=None):
+        def run():
+            with self._lock:
+                self.ran.append(name)
+            if error is not None:
+                raise error
+        return run
+
+
+def test_dependencies_run_first():
+    recorder = Recorder()
+    tasks = {
+        "tag": (recorder.task("tag"), ["instance"]),
+        "instance": (recorder.task("instance"), []),
+        "attach": (recorder.task("attach"), ["instance", "profile"]),
+        "profile": (recorder.task("profile"), []),
+    }
+    callback_context = {}
+    assert run_tasks(tasks, callback_context) == []
+    assert sorted(recorder.ran) == sorted(tasks)
+    assert recorder.ran.index("tag") > recorder.ran.index("instance")
+    assert recorder.ran.index("attach") > max(recorder.ran.index("instance"), recorder.ran.index("profile"))
+    assert callback_context[TASKS_KEY] == {name: DONE for name in tasks}
+
+
+def test_independent_tasks_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    tasks = {"a": (barrier.wait, []), "b": (barrier.wait, [])}
+    assert run_tasks(tasks, {}) == []
+
+
+def test_done_tasks_are_skipped():
+    recorder = Recorder()
+    tasks = {
+        "instance": (recorder.task("instance"), []),
+        "tag": (recorder.task("tag"), ["instance"]),
+    }
+    callback_context = {TASKS_KEY: {"instance": DONE}}
+    assert run_tasks(tasks, callback_context) == []
+    assert recorder.ran == ["tag"]
+
+
+def test_error_is_raised_after_independent_tasks_finish():
+    recorder = Recorder()
+    tasks = {
+        "broken": (recorder.task("broken", RuntimeError("boom")), []),
+        "after_broken": (recorder.task("after_broken"), ["broken"]),
+        "independent": (recorder.task("independent"), []),
+        "after_independent": (recorder.task("after_independent"), ["independent"]),
+    }
+    callback_context = {}
+    with pytest.raises(RuntimeError, match="boom"):
+        run_tasks(tasks, callback_context)
+    assert "after_broken" not in recorder.ran
+    assert callback_context[TASKS_KEY] == {"independent": DONE, "after_independent": DONE}
+    # the next invocation only retries what didn't finish
+    recorder.ran.clear()
+    tasks["broken"] = (recorder.task("broken"), [])
+    assert run_tasks(tasks, callback_context) == []
+    assert sorted(recorder.ran) == ["after_broken", "broken"]
+
+
+def test_not_ready_blocks_dependents():
+    recorder = Recorder()
+    tasks = {
+        "instance": (recorder.task("instance", TaskNotReady("no instance yet")), []),
+        "tag": (recorder.task("tag"), ["instance"]),
+        "resize": (recorder.task("resize"), ["tag"]),
+        "profile": (recorder.task("profile"), []),
+    }
+    callback_context = {}
+    assert run_tasks(tasks, callback_context) == ["instance", "tag", "resize"]
+    assert sorted(recorder.ran) == ["instance", "profile"]
+    assert callback_context[TASKS_KEY] == {"profile": DONE}
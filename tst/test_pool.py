@@ -0,0 +1,90 @@
+import json
+from dataclasses import fields
+
+import pytest
+from cloudformation_cli_python_lib import OperationStatus
+from cloudformation_cli_python_lib.utils import KitchenSinkEncoder
+
+from benchmark import OWNER, invoke_until_done, make_request
+from fake_aws import _error
+from richard_cloud9_customec2 import claims, handlers, pool, profiles
+from richard_cloud9_customec2.models import ResourceModel, Tag
+
+TOKEN = "token-0"
+
+
+def _model() -> ResourceModel:
+    model = ResourceModel(**{field.name: None for field in fields(ResourceModel)})
+    model.Name = "claimed"
+    model.InstanceType = "t3.small"
+    model.OperatingSystem = "AMAZON_LINUX_2"
+    model.Owner = OWNER
+    model.WarmPool = True
+    model.Tags = [Tag(Key="team", Value="a")]
+    return model
+
+
+@pytest.fixture
+def warm_pool(backend):
+    profiles.replenish_profiles(backend.session(), handlers.MANAGED_POLICIES)
+    backend.clock.sleep(profiles.PROFILE_PROPAGATION_SECONDS)
+    events = pool.replenish_pool(backend.session(), _model(), 1, OWNER)
+    assert [event.status for event in events] == [OperationStatus.SUCCESS]
+    return next(iter(backend.environments))
+
+
+def _fail(backend, operation, error, times=None):
+    # Make `operation` ("service.name") raise `error` the next `times` calls, or always
+    service, name = operation.split(".")
+    implementation = getattr(backend, f"_{service}_{name}")
+    remaining = [times]
+
+    def failing(**parameters):
+        if remaining[0] is None or remaining[0] > 0:
+            if remaining[0] is not None:
+                remaining[0] -= 1
+            raise error
+        return implementation(**parameters)
+    setattr(backend, f"_{service}_{name}", failing)
+
+
+def _claims(backend, kind=""):
+    prefix = f"{claims.CLAIM_PATH}/{kind}"
+    return {name: holder for name, holder in backend.parameters.items() if name.startswith(prefix)}
+
+
+def test_claim_resumes_after_throttling(backend, warm_pool):
+    # throttled past every retry of the first invocation
+    _fail(backend, "cloud9.update_environment", _error("ThrottlingException", "UpdateEnvironment"), times=10)
+    request = make_request(_model(), TOKEN)
+    progress = handlers.create_handler(backend.session(), request, {})
+    assert progress.status == OperationStatus.IN_PROGRESS
+    # a rollback from here deletes the claimed environment
+    assert progress.resourceModel.Arn.endswith(f":{warm_pool}")
+    while progress.status == OperationStatus.IN_PROGRESS:
+        callback_context = json.loads(json.dumps(progress.callbackContext, cls=KitchenSinkEncoder))
+        progress = handlers.create_handler(backend.session(), request, callback_context)
+    assert progress.status == OperationStatus.SUCCESS
+    assert progress.resourceModel.EnvironmentId == warm_pool
+    assert list(backend.environments) == [warm_pool]
+    assert backend.environments[warm_pool]["name"] == "claimed"
+    assert _claims(backend, claims.ENVIRONMENT) == {f"{claims.CLAIM_PATH}/{claims.ENVIRONMENT}/{warm_pool}": TOKEN}
+
+    deleted = invoke_until_done(handlers.delete_handler, backend, make_request(progress.resourceModel, "delete-0"))
+    assert deleted["status"] == "SUCCESS"
+    assert _claims(backend) == {}
+
+
+def test_failed_claim_deletes_environment(backend, warm_pool):
+    _fail(backend, "cloud9.create_environment_membership", _error("BadRequestException", "CreateEnvironmentMembership"))
+    model = _model()
+    # the pool environment belongs to OWNER, so another owner is made a member
+    model.Owner = "arn:aws:iam::123456789012:user/someone-else"
+    result = invoke_until_done(handlers.create_handler, backend, make_request(model, TOKEN))
+    assert result["status"] == "FAILED"
+    assert result["model"].Arn is None
+    assert backend.environments[warm_pool].get("deleting")
+    assert _claims(backend) == {}
+    # a rollback delete has nothing left to do
+    deleted = invoke_until_done(handlers.delete_handler, backend, make_request(result["model"], "delete-0"))
+    assert deleted["status"] == "SUCCESS"
@@ -0,0 +1,71 @@
+import pytest
+from cloudformation_cli_python_lib import HandlerErrorCode, OperationStatus, ProgressEvent
+
+from richard_cloud9_customec2 import scheduler
+from richard_cloud9_customec2.scheduler import POLL_KEY, Backoff, Fixed, reschedule
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(scheduler.random, "random", lambda: 0.0)
+
+
+@pytest.fixture
+def full_jitter(monkeypatch):
+    monkeypatch.setattr(scheduler.random, "random", lambda: 1.0)
+
+
+def test_delay_grows_by_factor(no_jitter):
+    backoff = Backoff(base=2, cap=1000, factor=3)
+    assert [backoff.delay(attempt) for attempt in range(4)] == [2, 6, 18, 54]
+
+
+def test_delay_is_capped(no_jitter):
+    backoff = Backoff(base=5, cap=60)
+    assert [backoff.delay(attempt) for attempt in range(6)] == [5, 10, 20, 40, 60, 60]
+    assert backoff.delay(50) == 60
+
+
+def test_jitter_only_shortens_delay(full_jitter):
+    backoff = Backoff(base=5, cap=60, jitter=0.5)
+    assert backoff.delay(0) == 2
+    assert backoff.delay(10) == 30
+
+
+def test_delay_is_at_least_one_second(full_jitter):
+    assert Backoff(base=1, cap=1, jitter=1.0).delay(0) == 1
+
+
+def test_fixed_never_varies():
+    backoff = Fixed(7)
+    assert {backoff.delay(attempt) for attempt in range(10)} == {7}
+
+
+def test_expired():
+    assert not Backoff(base=1, cap=1).expired(10 ** 9)
+    backoff = Backoff(base=1, cap=1, deadline=60)
+    assert not backoff.expired(59.9)
+    assert backoff.expired(60)
+
+
+def _progress(callback_context):
+    return ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackContext=callback_context)
+
+
+def test_reschedule_counts_attempts(no_jitter, monkeypatch):
+    monkeypatch.setitem(scheduler.STAGE_SCHEDULES, "Waiting", Backoff(base=2, cap=8, deadline=600))
+    callback_context = {}
+    delays = [reschedule(_progress(callback_context), "Waiting").callbackDelaySeconds for _ in range(4)]
+    assert delays == [2, 4, 8, 8]
+    assert callback_context[POLL_KEY]["Attempt"] == 4
+    # a new stage starts over
+    assert reschedule(_progress(callback_context), "Other").callbackDelaySeconds == scheduler.DEFAULT_SCHEDULE.base
+    assert callback_context[POLL_KEY]["Stage"] == "Other"
+
+
+def test_reschedule_fails_after_deadline(monkeypatch):
+    monkeypatch.setitem(scheduler.STAGE_SCHEDULES, "Waiting", Backoff(base=2, cap=8, deadline=600))
+    callback_context = {POLL_KEY: {"Stage": "Waiting", "Attempt": 12, "Started": scheduler.time() - 601}}
+    progress = reschedule(_progress(callback_context), "Waiting")
+    assert progress.status == OperationStatus.FAILED
+    assert progress.errorCode == HandlerErrorCode.NotStabilized
@@ -0,0 +1,45 @@
+from dataclasses import fields, replace
+
+from cloudformation_cli_python_lib import OperationStatus
+
+from benchmark import OWNER, invoke_until_done, make_request
+from richard_cloud9_customec2 import handlers
+from richard_cloud9_customec2.models import ResourceModel, Tag
+
+
+def _model(**values) -> ResourceModel:
+    model = ResourceModel(**{field.name: None for field in fields(ResourceModel)})
+    return replace(
+        model, Name="dev", InstanceType="t3.small", OperatingSystem="AMAZON_LINUX_2", Owner=OWNER, **values
+    )
+
+
+def _create(backend, model: ResourceModel) -> ResourceModel:
+    result = invoke_until_done(handlers.create_handler, backend, make_request(model, "create-0"))
+    assert result["status"] == "SUCCESS", result["message"]
+    return result["model"]
+
+
+def _read(backend, model: ResourceModel) -> ResourceModel:
+    progress = handlers.read_handler(backend.session(), make_request(model, "read-0"), {})
+    assert progress.status == OperationStatus.SUCCESS
+    return progress.resourceModel
+
+
+def test_read_reports_description(backend):
+    created = _create(backend, _model(Description="my desc"))
+    assert _read(backend, created).Description == "my desc"
+
+
+def test_read_reports_only_declared_tags(backend):
+    created = _create(backend, _model(Tags=[Tag(Key="team", Value="a")]))
+    # the instance also has Cloud9's Name tag and the handlers' own tags
+    assert _read(backend, created).Tags == [Tag(Key="team", Value="a")]
+    listed = handlers.list_handler(backend.session(), make_request(None, "list-0"), {}).resourceModels
+    assert [model.Tags for model in listed] == [[Tag(Key="team", Value="a")]]
+
+
+def test_read_without_tags_or_description(backend):
+    read = _read(backend, _create(backend, _model()))
+    assert read.Description is None
+    assert read.Tags is None